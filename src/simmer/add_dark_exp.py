@@ -8,15 +8,16 @@ the end of a night. This module adds these frames to the log sheet.
 # Created: 2/11/19
 # Updated: 2/11/19
 
-import glob
 import os
 from ast import literal_eval
 
-import astropy.io.fits as pyfits
 import numpy as np
 import pandas as pd
 from openpyxl import load_workbook
 
+from . import header_catalog as hc
+from . import utils as u
+
 
 def add_dark_exp(inst, log, raw_dir, tab=None):
     """Adds dark exposures to the end of log sheet if not specified.
@@ -198,11 +199,12 @@ def find_itimes(inst, raw_dir):
     # Set directories
     outdir = raw_dir
 
-    files = glob.glob(raw_dir + inst.file_prefix + "*.fits")
+    files = u.find_fits(raw_dir + inst.file_prefix + "*")
+    catalog = hc.load_catalog(raw_dir)
     with open(outdir + "_dark_itimes.txt", "w") as outfile:
         for file in files:
-            # load in header:
-            head = pyfits.getheader(file)
+            # catalog keywords of the header:
+            head = hc.header(catalog, file)
 
             hkeys = np.array(list(head.keys()))
 
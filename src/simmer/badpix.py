@@ -0,0 +1,250 @@
+"""
+Module for finding a night's bad pixels from its calibration frames and
+repairing them in science frames. Hot and unstable pixels are found from
+the raw dark stacks, dead pixels from the master flats. The mask is stored
+bit-packed in the reduction directory, and science frames are repaired
+from the good pixels around each bad one rather than with a full-frame
+median filter.
+"""
+
+import os
+from glob import glob
+
+import astropy.io.fits as pyfits
+import numpy as np
+from numba import njit
+
+from . import darks
+from . import manifest as mf
+from . import night_store as ns
+from . import utils as u
+
+import logging
+logger = logging.getLogger('simmer')
+
+mask_name = "badpix_mask.npz"
+
+default_thresholds = {
+    "hot_sigma": 5.0,  # dark level above the frame median, in robust sigma
+    "unstable_sigma": 5.0,  # frame-to-frame dark scatter, in robust sigma
+    "dead_fraction": 0.3,  # minimum flat response relative to the median
+}
+
+_loaded = {}
+
+
+def _outliers(image, nsigma):
+    """
+    Flags pixels more than nsigma robust standard deviations above the
+    median of an image.
+    """
+    median = np.nanmedian(image)
+    sigma = 1.4826 * np.nanmedian(np.abs(image - median))
+    with np.errstate(invalid="ignore"):
+        return image > median + nsigma * sigma
+
+
+def dark_statistics(darkfiles, inst):
+    """
+    Computes the per-pixel mean and standard deviation of a stack of darks
+    in a single pass (Welford's algorithm), reading one frame at a time.
+
+    Inputs:
+        :darkfiles: (list of str) paths to darks with the same exposure time.
+        :inst: (Instrument object) instrument for which data is being reduced.
+
+    Outputs:
+        :mean: (2D array) mean dark.
+        :std: (2D array) frame-to-frame standard deviation of each pixel.
+    """
+    for n, darkfile in enumerate(darkfiles, start=1):
+        frame = u.read_frames([darkfile], inst)[0][0]
+        frame = frame.astype(float)
+        if n == 1:
+            mean = frame.copy()
+            m2 = np.zeros(frame.shape)
+            continue
+        delta = frame - mean
+        mean += delta / n
+        m2 += delta * (frame - mean)
+    std = np.sqrt(m2 / max(len(darkfiles) - 1, 1))
+    return mean, std
+
+
+def find_bad_pixels(raw_dir, reddir, config, inst, thresholds=None):
+    """
+    Finds hot, unstable and dead pixels for a night.
+
+    Inputs:
+        :raw_dir: (string) directory for the raw data
+        :reddir: (string) directory for the reduced data, holding the flats.
+        :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :thresholds: (dict) overrides for default_thresholds.
+
+    Outputs:
+        :masks: (dict) boolean "hot", "unstable", "dead" and "static" masks.
+                "static" holds the instrument's known bad pixels, if any.
+        :inputs: (list of str) files the masks were made from.
+    """
+    limits = dict(default_thresholds)
+    if thresholds:
+        unknown = set(thresholds) - set(default_thresholds)
+        if unknown:
+            raise ValueError(f"Unknown bad pixel thresholds: {unknown}.")
+        limits.update(thresholds)
+
+    masks = {}
+    inputs = []
+    for darklist in darks.dark_lists(config).values():
+        darkfiles = u.make_filelist(raw_dir, darklist, inst)
+        inputs += darkfiles
+        mean, std = dark_statistics(darkfiles, inst)
+        hot = _outliers(mean, limits["hot_sigma"])
+        masks["hot"] = masks.get("hot", False) | hot
+        if len(darkfiles) > 2:
+            unstable = _outliers(std, limits["unstable_sigma"])
+            masks["unstable"] = masks.get("unstable", False) | unstable
+
+    flatfiles = sorted(glob(reddir + "flat_*.fits"))
+    inputs += flatfiles
+    for flatfile in flatfiles:
+        flat = pyfits.getdata(flatfile)
+        with np.errstate(invalid="ignore"):
+            dead = ~(flat > limits["dead_fraction"] * np.nanmedian(flat))
+        masks["dead"] = masks.get("dead", False) | dead
+
+    static = inst.static_bad_pixels()
+    if static is not None:
+        masks["static"] = static
+
+    if not masks:
+        raise ValueError("No darks or flats to find bad pixels from.")
+    shape = next(np.shape(m) for m in masks.values() if np.ndim(m) == 2)
+    for key in ["hot", "unstable", "dead", "static"]:
+        masks[key] = np.broadcast_to(masks.get(key, False), shape).copy()
+    return masks, inputs
+
+
+def mask_driver(
+    raw_dir, reddir, config, inst, thresholds=None, force=False, pack=None
+):
+    """
+    Finds the night's bad pixels and writes them, bit-packed, to
+    badpix_mask.npz in the reduction directory. Should run after the flats.
+
+    Inputs:
+        :raw_dir: (string) directory for the raw data
+        :reddir: (string) directory for the reduced data
+        :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :thresholds: (dict) overrides for default_thresholds.
+        :force: (bool) if True, the mask is remade even if its manifest shows
+                it is up to date.
+        :pack: (str) directory of a pack of the night's raw frames, made
+                with night_store.pack_night, to read raw frames and headers
+                from rather than their FITS files.
+
+    Outputs:
+        :mask_file: (str) path to the mask.
+    """
+    with ns.using(pack):
+        mask_file = reddir + mask_name
+        darkfiles = []
+        for darklist in darks.dark_lists(config).values():
+            darkfiles += u.make_filelist(raw_dir, darklist, inst)
+        inputs = darkfiles + sorted(glob(reddir + "flat_*.fits"))
+        if not force and mf.is_current(mask_file, inputs, inst):
+            return mask_file
+
+        masks, inputs = find_bad_pixels(raw_dir, reddir, config, inst, thresholds)
+        shape = masks["hot"].shape
+        np.savez(
+            mask_file,
+            shape=np.array(shape),
+            **{key: np.packbits(mask) for key, mask in masks.items()},
+        )
+        mf.record(mask_file, inputs, inst)
+
+        counts = {key: int(np.count_nonzero(mask)) for key, mask in masks.items()}
+        logger.info(f"Bad pixels: {counts}")
+        return mask_file
+
+
+def load_mask(reddir, shape):
+    """
+    Reads a night's bad pixel mask, keeping it in memory for later calls.
+
+    Inputs:
+        :reddir: (string) directory for the reduced data
+        :shape: (tuple) shape of the frames the mask will be applied to.
+
+    Outputs:
+        :mask: (2D boolean array) True for every bad pixel, or None if there
+                is no mask for frames of that shape.
+    """
+    mask_file = reddir + mask_name
+    if not os.path.exists(mask_file):
+        return None
+    key = (mask_file, tuple(shape), os.stat(mask_file).st_mtime_ns)
+    if key not in _loaded:
+        packed = np.load(mask_file)
+        if tuple(packed["shape"]) != tuple(shape):
+            logger.warning(
+                f"{mask_file} doesn't match frames of shape {shape}; ignoring it."
+            )
+            return None
+        npix = int(np.prod(shape))
+        mask = np.zeros(npix, dtype=bool)
+        for name in ["hot", "unstable", "dead", "static"]:
+            mask |= np.unpackbits(packed[name], count=npix).astype(bool)
+        mask = mask.reshape(shape)
+        mask.setflags(write=False)
+        _loaded[key] = mask
+    return _loaded[key]
+
+
+def repair(image, mask, radius=3):
+    """
+    Replaces bad and NaN pixels with the median of the good pixels in the
+    (2 * radius + 1)-pixel box around each one. Pixels with no good
+    neighbors stay NaN.
+
+    Inputs:
+        :image: (2D array) frame to repair.
+        :mask: (2D boolean array) True for bad pixels.
+        :radius: (int) half-width of the box, in pixels.
+
+    Outputs:
+        :repaired: (2D array) copy of image with the bad pixels replaced.
+    """
+    bad = mask | np.isnan(image)
+    rows, cols = np.nonzero(bad)
+    repaired = image.copy()
+    _repair(repaired, bad, rows, cols, radius)
+    return repaired
+
+
+@njit(cache=True)
+def _repair(image, bad, rows, cols, radius):
+    """
+    Fills each listed pixel from the good pixels around it. Neighbors are
+    taken from the unrepaired values, since repaired pixels are never used.
+    """
+    nrows, ncols = image.shape
+    values = np.empty((2 * radius + 1) ** 2, dtype=np.float64)
+    fills = np.empty(len(rows), dtype=np.float64)
+    for k in range(len(rows)):
+        i0 = max(rows[k] - radius, 0)
+        i1 = min(rows[k] + radius + 1, nrows)
+        j0 = max(cols[k] - radius, 0)
+        j1 = min(cols[k] + radius + 1, ncols)
+        n = 0
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                if not bad[i, j]:
+                    values[n] = image[i, j]
+                    n += 1
+        fills[k] = np.median(values[:n]) if n > 0 else np.nan
+    for k in range(len(rows)):
+        image[rows[k], cols[k]] = fills[k]
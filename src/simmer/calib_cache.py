@@ -0,0 +1,163 @@
+"""
+Module for a process-wide, in-memory cache of calibration products. Master
+darks, flats and skies are read by several stages and for every star; the
+cache serves each file from memory after its first read, as a read-only
+array, and evicts the least recently used products once their total size
+exceeds a limit.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+import logging
+logger = logging.getLogger('simmer')
+
+max_bytes = 512 * 1024 ** 2
+
+_cache = OrderedDict()
+_nbytes = 0
+_lock = threading.Lock()
+_flat_files = {}
+
+
+def set_max_bytes(nbytes):
+    """
+    Sets the memory limit of the cache, evicting products if needed.
+
+    Inputs:
+        :nbytes: (int) total size of cached arrays, in bytes. 0 disables
+                caching.
+    """
+    global max_bytes
+    if nbytes < 0:
+        raise ValueError("The cache size can't be negative.")
+    with _lock:
+        max_bytes = int(nbytes)
+        _evict()
+
+
+def clear():
+    """
+    Empties the cache, including the resolved flat file names.
+    """
+    global _nbytes
+    with _lock:
+        _cache.clear()
+        _nbytes = 0
+        _flat_files.clear()
+
+
+def _key(filename):
+    """
+    Identifies a file by path, modification time and size, so that a
+    product rewritten on disk is never served from a stale entry.
+    """
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+def _evict():
+    """
+    Drops least recently used entries until the cache fits its limit.
+    Must be called with the lock held.
+    """
+    global _nbytes
+    while _cache and _nbytes > max_bytes:
+        key, data = _cache.popitem(last=False)
+        _nbytes -= data.nbytes
+        logger.debug(f"Evicted {key[0]} from the calibration cache.")
+
+
+def _insert(key, data):
+    """
+    Stores a read-only array under key. Must be called with the lock held.
+    """
+    global _nbytes
+    if key in _cache:
+        _nbytes -= _cache.pop(key).nbytes
+    data.setflags(write=False)
+    _cache[key] = data
+    _nbytes += data.nbytes
+    _evict()
+
+
+def get(filename):
+    """
+    Returns the primary data of a calibration product, reading it from disk
+    only if it isn't cached.
+
+    Inputs:
+        :filename: (str) path to a FITS calibration product.
+
+    Outputs:
+        :data: (array) read-only data of the file. Copy it before modifying.
+    """
+    key = _key(filename)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    data = np.asarray(pyfits.getdata(filename))
+    with _lock:
+        _insert(key, data)
+    return data
+
+
+def put(filename, data):
+    """
+    Caches a product that was just written to disk, so that later stages
+    don't read it back.
+
+    Inputs:
+        :filename: (str) path the product was written to.
+        :data: (array) data written to filename.
+    """
+    data = np.array(data)
+    with _lock:
+        _insert(_key(filename), data)
+
+
+def flat_file(reddir, filt, inst):
+    """
+    Finds the master flat to use for a filter, falling back to a flat in a
+    related filter where the instrument has none: PHARO never has Br-gamma
+    flats, and ShARCS BrG-2.16 and J+Ch4-1.2 data may lack their own.
+    Resolved names are remembered once the flat exists, unless they are a
+    fallback, since the filter's own flat may still be made later.
+
+    Inputs:
+        :reddir: (str) directory for the reduced data.
+        :filt: (str) filter of the frames to be flattened.
+        :inst: (Instrument object) instrument for which data is being reduced.
+
+    Outputs:
+        :flatfile: (str) path to the flat.
+    """
+    key = (reddir, filt, inst.name)
+    if key in _flat_files:
+        return _flat_files[key]
+
+    flatfile = reddir + f"flat_{filt}.fits"
+    if inst.name == "PHARO" and filt == "Br-gamma":
+        flatfile = reddir + "flat_K_short.fits"  # no BrG flats in Palomar data
+
+    fallback = False
+    #For ShARCS, use Ks flat instead of BrG-2.16 if necessary
+    if (inst.name == "ShARCS" and filt == "BrG-2.16"):
+        if os.path.exists(flatfile) == False:
+            flatfile = reddir + 'flat_Ks.fits'
+            fallback = True
+
+    #For ShARCS, use J flat instead of J+Ch4-1.2 if necessary
+    if (inst.name == "ShARCS" and filt == "J+Ch4-1.2"):
+        if os.path.exists(flatfile) == False:
+            flatfile = reddir + 'flat_J.fits'
+            fallback = True
+
+    if os.path.exists(flatfile) and not fallback:
+        _flat_files[key] = flatfile
+    return flatfile
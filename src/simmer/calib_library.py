@@ -0,0 +1,178 @@
+"""
+Module for a calibration library shared across nights. Master darks and
+flats made for a night are published to it, and a night that lacks one can
+use the product from the nearest night instead, or reuse it rather than
+combining its own frames.
+
+The library is a directory tree indexed by instrument, product and night:
+``<library_dir>/<instrument>/<product>/<YYYY-MM-DD>.fits``, where the
+product is the name SImMER gives it in a reduction directory, e.g.
+``dark_10sec`` or ``flat_K_short``, so exposure time and filter are part of
+the key.
+"""
+
+import datetime
+import os
+import shutil
+from glob import glob
+
+from . import manifest as mf
+
+import logging
+logger = logging.getLogger('simmer')
+
+
+def _parse_night(night):
+    """
+    Converts a night given as "YYYY-MM-DD" or "YYYY_MM_DD" into a date.
+    """
+    return datetime.date.fromisoformat(str(night).replace("_", "-"))
+
+
+class CalibrationLibrary:
+    """
+    Master darks and flats from every reduced night of one or more
+    instruments.
+    """
+
+    def __init__(self, library_dir, max_days=None, reuse=False):
+        """
+        Inputs:
+            :library_dir: (str) directory holding the library; created if
+                    needed.
+            :max_days: (int) products from nights more than this many days
+                    away are never used. None allows any night.
+            :reuse: (bool) if True, the drivers restore products from the
+                    library instead of making them, whenever one is found.
+                    Otherwise the library is only used for products that a
+                    night can't make.
+        """
+        self.library_dir = os.path.join(library_dir, "")
+        self.max_days = max_days
+        self.reuse = reuse
+        os.makedirs(self.library_dir, exist_ok=True)
+
+    def _product_dir(self, inst, product):
+        return self.library_dir + f"{inst.name}/{product}/"
+
+    def nights(self, inst, product):
+        """
+        Lists the nights for which the library has a product.
+
+        Inputs:
+            :inst: (Instrument object) instrument of the product.
+            :product: (str) product name, e.g. "dark_10sec" or "flat_K_short".
+
+        Outputs:
+            :nights: (list of str) nights, as "YYYY-MM-DD", in order.
+        """
+        files = glob(self._product_dir(inst, product) + "*.fits")
+        return sorted(os.path.basename(f)[:-5] for f in files)
+
+    def publish(self, product_file, inst, night):
+        """
+        Adds a product to the library, replacing the copy for the same night
+        if the product has changed since it was published.
+
+        Inputs:
+            :product_file: (str) path to a master dark or flat.
+            :inst: (Instrument object) instrument of the product.
+            :night: (str) night of the product, as "YYYY-MM-DD".
+        """
+        night = _parse_night(night).isoformat()
+        product = os.path.basename(product_file)[:-5]
+        target = self._product_dir(inst, product) + f"{night}.fits"
+        if os.path.exists(target) and os.path.getmtime(
+            target
+        ) >= os.path.getmtime(product_file):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # copy next to the target and rename, so that readers never see a
+        # partial file
+        shutil.copy2(product_file, target + ".tmp")
+        os.replace(target + ".tmp", target)
+        logger.info(f"Published {product} for {night} to the library.")
+
+    def publish_night(self, reddir, inst, night):
+        """
+        Publishes every master dark, dark model and flat made in a reduction
+        directory.
+        Products that were restored from the library, which have no
+        manifest, aren't published back.
+
+        Inputs:
+            :reddir: (str) directory for the reduced data.
+            :inst: (Instrument object) instrument for which data is being reduced.
+            :night: (str) night of the reduction, as "YYYY-MM-DD". If None,
+                    nothing is published.
+        """
+        if night is None:
+            logger.warning("No night given; not publishing to the library.")
+            return
+        for pattern in ["dark_*sec.fits", "dark_model.fits", "flat_*.fits"]:
+            for product_file in sorted(glob(reddir + pattern)):
+                if os.path.exists(mf.manifest_file(product_file)):
+                    self.publish(product_file, inst, night)
+
+    def find(self, inst, product, night=None):
+        """
+        Finds the copy of a product from the night closest to the given one.
+
+        Inputs:
+            :inst: (Instrument object) instrument of the product.
+            :product: (str) product name, e.g. "dark_10sec" or "flat_K_short".
+            :night: (str) night that needs the product, as "YYYY-MM-DD". If
+                    None, the most recent copy is used.
+
+        Outputs:
+            :product_file: (str) path to the product in the library, or None
+                    if there's none within max_days.
+        """
+        nights = self.nights(inst, product)
+        if not nights:
+            return None
+        if night is None:
+            return self._product_dir(inst, product) + f"{nights[-1]}.fits"
+
+        target = _parse_night(night)
+        distances = [abs((_parse_night(n) - target).days) for n in nights]
+        best = min(range(len(nights)), key=lambda k: distances[k])
+        if self.max_days is not None and distances[best] > self.max_days:
+            return None
+        return self._product_dir(inst, product) + f"{nights[best]}.fits"
+
+    def restore(self, inst, product, reddir, night=None):
+        """
+        Copies the nearest copy of a product into a reduction directory,
+        under the name the reduction expects, unless it's there already.
+
+        Inputs:
+            :inst: (Instrument object) instrument of the product.
+            :product: (str) product name, e.g. "dark_10sec" or "flat_K_short".
+            :reddir: (str) directory for the reduced data.
+            :night: (str) night that needs the product, as "YYYY-MM-DD".
+
+        Outputs:
+            :restored: (bool) whether a product was found and copied.
+        """
+        source = self.find(inst, product, night)
+        if source is None:
+            return False
+        target = reddir + f"{product}.fits"
+        # the copy keeps the library's modification time, and isn't redone
+        # on later runs, so products made from it stay current
+        stat = os.stat(source)
+        if not (
+            os.path.exists(target)
+            and os.path.getsize(target) == stat.st_size
+            and os.stat(target).st_mtime_ns == stat.st_mtime_ns
+        ):
+            shutil.copy2(source, target)
+        # a restored product wasn't made from this night's frames
+        if os.path.exists(mf.manifest_file(target)):
+            os.remove(mf.manifest_file(target))
+        logger.warning(
+            f"Using {product} from {os.path.basename(source)[:-5]} "
+            "from the calibration library."
+        )
+        return True
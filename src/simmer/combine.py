@@ -0,0 +1,266 @@
+"""
+Module for combining stacks of frames along the frame axis. The median and
+percentile reductions here replace np.median/np.nanmedian in the reduction
+stages: with the numba backend, each pixel's values are found by selection
+(rather than a full sort) and pixels are processed in parallel.
+"""
+
+import warnings
+
+import numpy as np
+from numba import njit, prange
+
+from . import utils as u
+
+import logging
+logger = logging.getLogger('simmer')
+
+valid_backends = ["numba", "numpy"]
+backend = "numba"
+
+
+def set_backend(name):
+    """
+    Sets the backend used for all stack reductions.
+
+    Inputs:
+        :name: (str) either "numba" (parallel, compiled) or "numpy".
+    """
+    global backend
+    if name not in valid_backends:
+        raise ValueError(
+            f"Stack reduction backend must be one of {valid_backends}."
+        )
+    backend = name
+
+
+def median(cube):
+    """
+    Takes the median of a stack of frames along the frame axis. As with
+    np.median, any pixel that is NaN in one frame is NaN in the output.
+
+    Inputs:
+        :cube: (3D array) stack of frames, shape (nims, xpix, ypix).
+
+    Outputs:
+        :combined: (2D array) median frame.
+    """
+    if backend == "numpy":
+        return np.median(cube, axis=0)
+    return _reduce(cube, 50.0, False)
+
+
+def nanmedian(cube):
+    """
+    Takes the median of a stack of frames along the frame axis, ignoring
+    NaNs. Pixels that are NaN in every frame are NaN in the output.
+
+    Inputs:
+        :cube: (3D array) stack of frames, shape (nims, xpix, ypix).
+
+    Outputs:
+        :combined: (2D array) median frame.
+    """
+    if backend == "numpy":
+        return np.nanmedian(cube, axis=0)
+    return _reduce(cube, 50.0, True)
+
+
+def nanpercentile(cube, q):
+    """
+    Takes a percentile of a stack of frames along the frame axis, ignoring
+    NaNs. Uses linear interpolation between ranks, as np.nanpercentile does.
+
+    Inputs:
+        :cube: (3D array) stack of frames, shape (nims, xpix, ypix).
+        :q: (float) percentile to compute, between 0 and 100.
+
+    Outputs:
+        :combined: (2D array) percentile frame.
+    """
+    if not 0.0 <= q <= 100.0:
+        raise ValueError("Percentiles must be in the range [0, 100].")
+    if backend == "numpy":
+        return np.nanpercentile(cube, q, axis=0)
+    return _reduce(cube, float(q), True)
+
+
+def leave_one_out_median(cube):
+    """
+    For each frame of a stack, takes the median of all the other frames,
+    ignoring NaNs. Each pixel's values are sorted once, and every frame's
+    median is read from that order with its own value left out, so the
+    whole cube costs about as much as a single median rather than one
+    median per frame.
+
+    Inputs:
+        :cube: (3D array) stack of frames, shape (nims, xpix, ypix).
+
+    Outputs:
+        :medians: (3D array) median of the other frames, for each frame.
+                Pixels with no finite value in the other frames are NaN.
+    """
+    cube = np.asarray(cube)
+    if cube.ndim != 3:
+        raise ValueError("Stack reductions require a 3D array of frames.")
+    nims = cube.shape[0]
+    dtype = u.as_float(cube[:0]).dtype
+    if backend == "numpy":
+        medians = np.empty(cube.shape, dtype=dtype)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for k in range(nims):
+                others = np.delete(cube, k, axis=0)
+                medians[k] = np.nanmedian(others, axis=0)
+        return medians
+    flat = np.ascontiguousarray(cube.reshape(nims, -1), dtype=dtype)
+    return _leave_one_out_columns(flat).reshape(cube.shape)
+
+
+def _reduce(cube, q, ignore_nan):
+    """
+    Reshapes the stack so that each pixel is a column and runs the
+    compiled reduction.
+    """
+    cube = np.asarray(cube)
+    if cube.ndim != 3:
+        raise ValueError("Stack reductions require a 3D array of frames.")
+    nims = cube.shape[0]
+    # single precision stacks stay single precision; the interpolation
+    # between ranks is the only arithmetic, so nothing needs upcasting
+    dtype = u.as_float(cube[:0]).dtype
+    flat = np.ascontiguousarray(cube.reshape(nims, -1), dtype=dtype)
+    combined = _percentile_columns(flat, q, ignore_nan)
+    return combined.reshape(cube.shape[1:])
+
+
+@njit(cache=True)
+def _select(buf, n, k):
+    """
+    Partially orders buf[:n] in place so that buf[k] holds the k-th smallest
+    value, with smaller values before it and larger values after it.
+    """
+    lo = 0
+    hi = n - 1
+    while hi > lo:
+        # median-of-three pivot keeps nearly sorted pixels from going quadratic
+        mid = (lo + hi) // 2
+        if buf[mid] < buf[lo]:
+            buf[mid], buf[lo] = buf[lo], buf[mid]
+        if buf[hi] < buf[lo]:
+            buf[hi], buf[lo] = buf[lo], buf[hi]
+        if buf[hi] < buf[mid]:
+            buf[hi], buf[mid] = buf[mid], buf[hi]
+        pivot = buf[mid]
+
+        i = lo
+        j = hi
+        while i <= j:
+            while buf[i] < pivot:
+                i += 1
+            while buf[j] > pivot:
+                j -= 1
+            if i <= j:
+                buf[i], buf[j] = buf[j], buf[i]
+                i += 1
+                j -= 1
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            break
+    return buf[k]
+
+
+@njit(cache=True)
+def _percentile_1d(buf, n, q):
+    """
+    Computes the q-th percentile of buf[:n], reordering buf in place.
+    """
+    if n == 1:
+        return buf[0]
+    rank = q / 100.0 * (n - 1)
+    k = int(np.floor(rank))
+    frac = rank - k
+    low = _select(buf, n, k)
+    if frac == 0.0:
+        return low
+    # after selection, everything past k is >= low; its minimum is rank k+1
+    high = buf[k + 1]
+    for i in range(k + 2, n):
+        if buf[i] < high:
+            high = buf[i]
+    if q == 50.0:
+        return 0.5 * (low + high)
+    return low + (high - low) * frac
+
+
+@njit(parallel=True, cache=True)
+def _percentile_columns(flat, q, ignore_nan):
+    """
+    Reduces every column of a (nims, npix) array to its q-th percentile.
+    Pixels are split into chunks, each with its own scratch buffer.
+    """
+    nims, npix = flat.shape
+    out = np.empty(npix, dtype=flat.dtype)
+    chunk = 4096
+    nchunks = (npix + chunk - 1) // chunk
+    for c in prange(nchunks):
+        buf = np.empty(nims, dtype=flat.dtype)
+        start = c * chunk
+        stop = min(start + chunk, npix)
+        for j in range(start, stop):
+            n = 0
+            has_nan = False
+            for i in range(nims):
+                val = flat[i, j]
+                if np.isnan(val):
+                    has_nan = True
+                else:
+                    buf[n] = val
+                    n += 1
+            if n == 0 or (has_nan and not ignore_nan):
+                out[j] = np.nan
+            else:
+                out[j] = _percentile_1d(buf, n, q)
+    return out
+
+
+@njit(parallel=True, cache=True)
+def _leave_one_out_columns(flat):
+    """
+    Computes, for every column of a (nims, npix) array and every row, the
+    median of the column's other finite values. With the m finite values
+    sorted, leaving out the one at rank r shifts the ranks above r down by
+    one, so each median is one or two lookups in the sorted values.
+    """
+    nims, npix = flat.shape
+    out = np.empty((nims, npix), dtype=flat.dtype)
+    for j in prange(npix):
+        column = flat[:, j]
+        order = np.argsort(column)  # NaNs sort last
+        m = 0
+        for i in range(nims):
+            if not np.isnan(column[i]):
+                m += 1
+        ranks = np.empty(nims, dtype=np.int64)
+        for r in range(nims):
+            ranks[order[r]] = r
+        for i in range(nims):
+            r = ranks[i]
+            if r >= m:
+                # a NaN frame leaves every finite value in
+                n = m
+                r = n
+            else:
+                n = m - 1
+            if n == 0:
+                out[i, j] = np.nan
+                continue
+            lo = (n - 1) // 2
+            hi = n // 2
+            a = column[order[lo if lo < r else lo + 1]]
+            b = column[order[hi if hi < r else hi + 1]]
+            out[i, j] = 0.5 * (a + b) if lo != hi else a
+    return out
@@ -0,0 +1,123 @@
+"""
+Module for a per-pixel linear model of the dark frames of a night,
+bias + rate * exposure time. The model is fit in a single pass over every
+dark, whatever its exposure time, and gives a master dark for any
+exposure time without a stack of darks taken at exactly that time.
+"""
+
+import numpy as np
+from tqdm import tqdm
+
+from . import darks
+from . import manifest as mf
+from . import night_store as ns
+from . import utils as u
+from . import writer as wr
+
+import logging
+logger = logging.getLogger('simmer')
+
+model_name = "dark_model.fits"
+
+
+def fit_dark_model(darkfiles, inst):
+    """
+    Fits bias + rate * t to every pixel by least squares. Frames are read
+    and accumulated one at a time, so the darks are never held in memory
+    together. NaN pixels are left out of their pixel's fit.
+
+    Inputs:
+        :darkfiles: (list of str) paths to the raw dark frames.
+        :inst: (Instrument object) instrument for which data is being reduced.
+
+    Outputs:
+        :bias: (2D array) counts at zero exposure time.
+        :rate: (2D array) dark current, in counts per second.
+        :itimes: (list of float) exposure time of each frame.
+    """
+    sums = None
+    itimes = []
+    for darkfile in tqdm(darkfiles, desc="Fitting dark model", leave=False):
+        frame = u.read_frames([darkfile], inst)[0][0]
+        itime = inst.itime(inst.head(darkfile))
+        itimes.append(itime)
+
+        if sums is None:
+            # n, sum t, sum t^2, sum y and sum t * y for every pixel
+            sums = [np.zeros(frame.shape) for _ in range(5)]
+        good = np.isfinite(frame)
+        frame = np.where(good, frame, 0.0)
+        sums[0] += good
+        sums[1] += good * itime
+        sums[2] += good * itime ** 2
+        sums[3] += frame
+        sums[4] += frame * itime
+
+    n, s_t, s_tt, s_y, s_ty = sums
+    denom = n * s_tt - s_t ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rate = np.where(denom > 0, (n * s_ty - s_t * s_y) / denom, 0.0)
+        bias = (s_y - rate * s_t) / n
+
+    if len(np.unique(itimes)) < 2:
+        logger.warning(
+            "All darks have the same exposure time, so the dark current "
+            "can't be fit; the model is a constant dark."
+        )
+    return bias, rate, itimes
+
+
+def model_driver(raw_dir, reddir, config, inst, force=False, pack=None):
+    """
+    Fits the dark model for a night from all of its darks and writes it to
+    dark_model.fits, as a cube holding the bias and then the rate.
+
+    Inputs:
+        :raw_dir: (string) directory for the raw data
+        :reddir: (string) directory for the reduced data
+        :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :force: (bool) if True, the model is refit even if its manifest shows
+                it is up to date.
+        :pack: (str) directory of a pack of the night's raw frames, made
+                with night_store.pack_night, to read raw frames and headers
+                from rather than their FITS files.
+
+    Outputs:
+        :model_file: (str) path to the dark model.
+    """
+    with ns.using(pack):
+        darklist = []
+        for texp_list in darks.dark_lists(config).values():
+            darklist.extend(texp_list)
+        darkfiles = u.make_filelist(raw_dir, darklist, inst)
+
+        model_file = reddir + model_name
+        if not force and mf.is_current(model_file, darkfiles, inst):
+            return model_file
+
+        bias, rate, itimes = fit_dark_model(darkfiles, inst)
+
+        head = inst.head(darkfiles[0])
+        head.set("DARKMODL", True, "planes are bias and rate (counts/s)")
+        head.set("EXPTIMES", str(sorted(set(itimes))), "dark exposure times")
+        head.set("DATAFILE", str(darklist))  # add all file names
+        model = np.array([bias, rate])
+        #the model's coefficients are kept exactly, whatever the storage policy
+        wr.write_product(model_file, model, head, darkfiles, inst, intermediate=False)
+        wr.flush()
+        return model_file
+
+
+def synthesize_dark(model, itime):
+    """
+    Makes a master dark for an exposure time from a dark model.
+
+    Inputs:
+        :model: (3D array) bias and rate planes, as written by model_driver.
+        :itime: (float) exposure time, in seconds.
+
+    Outputs:
+        :dark: (2D array) dark for that exposure time.
+    """
+    return model[0] + model[1] * itime
@@ -2,14 +2,28 @@
 Functions to work with darks.
 """
 
-import astropy.io.fits as pyfits
 import numpy as np
 from tqdm import tqdm
 
+from . import calib_cache as cc
+from . import combine as comb
+from . import manifest as mf
+from . import night_store as ns
 from . import plotting as pl
 from . import utils as u
-
-def dark_driver(raw_dir, reddir, config, inst, plotting_yml=None):
+from . import writer as wr
+
+def dark_driver(
+    raw_dir,
+    reddir,
+    config,
+    inst,
+    plotting_yml=None,
+    force=False,
+    library=None,
+    night=None,
+    pack=None,
+):
     """Night should be entered in format 'yyyy_mm_dd' as string.
     This will point toward a config file for the night with darks listed.flat
 
@@ -19,28 +33,65 @@ def dark_driver(raw_dir, reddir, config, inst, plotting_yml=None):
         :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
         :inst: (Instrument object) instrument for which data is being reduced.
         :plotting_yml: (string) path to the plotting configuration file.
+        :force: (bool) if True, darks are rebuilt even if their manifests
+                show they are up to date.
+        :library: (CalibrationLibrary) library that darks are published to,
+                and restored from if the library is set to reuse products.
+        :night: (str) night being reduced, as "YYYY-MM-DD".
+        :pack: (str) directory of a pack of the night's raw frames, made
+                with night_store.pack_night, to read raw frames and headers
+                from rather than their FITS files.
 
     """
-    if plotting_yml:
-        pl.initialize_plotting(plotting_yml)
+    with ns.using(pack):
+        if plotting_yml:
+            pl.initialize_plotting(plotting_yml)
+
+        darklists = dark_lists(config)
+
+        for texp in tqdm(darklists, desc="Running darks", position=0, leave=True):
+            product = f"dark_{int(round(texp))}sec"
+            if (
+                library is not None
+                and library.reuse
+                and library.restore(inst, product, reddir, night)
+            ):
+                continue
+            create_darks(
+                raw_dir, reddir, darklists[texp], inst, force=force
+            )  # creates a new dark file
+
+        wr.flush()
+        if library is not None:
+            library.publish_night(reddir, inst, night)
 
+
+def dark_lists(config):
+    """Groups the darks of a night by exposure time, with one master dark
+    to be made for each group.
+
+    Inputs:
+        :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
+
+    Outputs:
+        :darklists: (dict) list of dark file numbers for each exposure time.
+    """
     _darks = config[config.Object == "dark"]
     texps = _darks.ExpTime.unique()
 
-    for texp in tqdm(texps, desc="Running darks", position=0, leave=True):
+    darklists = {}
+    for texp in texps:
         darklist = []
         ww = np.where(_darks.ExpTime == texp)
         allfiles = _darks.iloc[ww].Filenums.values
         for aa in np.arange(len(allfiles)):
             for bb in eval(allfiles[aa]):
                 darklist.append(bb)
+        darklists[texp] = darklist
+    return darklists
 
-        create_darks(
-            raw_dir, reddir, darklist, inst
-        )  # creates a new dark file
 
-
-def create_darks(raw_dir, reddir, darklist, inst):
+def create_darks(raw_dir, reddir, darklist, inst, force=False):
     """creates the actual darks from a list of dark file numbers, taking
     the median and writing to a file. Returns the final dark.
 
@@ -48,20 +99,24 @@ def create_darks(raw_dir, reddir, darklist, inst):
         :reddir: (string) directory for the reduced data
         :darklist: string) list of dark file numbers
         :inst: (Instrument object) instrument for which data is being reduced.
+        :force: (bool) if True, the dark is rebuilt even if its manifest
+                shows it is up to date.
     """
 
-    ndarks = len(darklist)
     darkfiles = u.make_filelist(raw_dir, darklist, inst)
 
-    dark_array = u.read_imcube(darkfiles)
-
-    dark_array = inst.adjust_array(dark_array, ndarks)
     head = inst.head(darkfiles[0])
     itime = inst.itime(head)
+    dark_filename = reddir + "dark_{}sec.fits".format(int(round(itime)))
+    if not force and mf.is_current(dark_filename, darkfiles, inst):
+        return cc.get(dark_filename)
+
+    dark_array, _ = u.read_frames(darkfiles, inst)
 
-    final_dark = np.median(dark_array, axis=0)  # nanmedian?
+    final_dark = comb.median(dark_array)  # nanmedian?
 
-    pl.plot_array(
+    wr.plot(
+        pl.plot_array,
         "intermediate",
         dark_array,
         -1.0,
@@ -72,10 +127,6 @@ def create_darks(raw_dir, reddir, darklist, inst):
 
     head.set("DATAFILE", str(darklist))  # add all file names
 
-    hdu = pyfits.PrimaryHDU(
-        final_dark, header=head
-    )  # can i do this with fits?
-    dark_filename = reddir + "dark_{}sec.fits".format(int(round(itime)))
-    hdu.writeto(dark_filename, overwrite=True, output_verify="ignore")
+    wr.write_product(dark_filename, final_dark, head, darkfiles, inst)
 
     return final_dark
@@ -2,6 +2,7 @@
 Module for driving reduction processes. Contains highest-level API.
 """
 
+from functools import partial
 from glob import glob
 
 import numpy as np
@@ -9,19 +10,42 @@ import pandas as pd
 import os as os
 from tqdm import tqdm
 
+from . import badpix as bp
+from . import dark_model as dm
+from . import night_store as ns
 from . import darks, flats, image
+from . import parallel as par
 from . import plotting as pl
+from . import prefetch as pf
 from . import search_headers as search
 from . import sky
 from . import summarize as summarize
+from . import writer as wr
 
 import logging
 
 logger = logging.getLogger('simmer')
 
+
+def _task(func, *args, storage=None, packs=()):
+    """
+    Runs one calibration task, waiting for its products to be written so
+    that tasks depending on it can read them. Worker processes don't share
+    this process's storage policy or night packs, so they are passed along.
+    """
+    if storage is not None:
+        wr.set_storage(**storage)
+    for pack_dir in packs:
+        if pack_dir not in ns.active():
+            ns.use(pack_dir)
+    result = func(*args)
+    wr.flush()
+    return result
+
+
 def all_driver(
 
-    inst, config_file, raw_dir, reddir, sep_skies = False, plotting_yml=None, searchsize=10, just_images=False, selected_stars=None, verbose=True
+    inst, config_file, raw_dir, reddir, sep_skies = False, plotting_yml=None, searchsize=10, just_images=False, selected_stars=None, verbose=True, quality_limits=None, combine="median", incremental=False, write_cube=False, rebuild_calibrations=False, calib_workers=1, library=None, night=None, dark_model=False, badpix_mask=False, per_frame_sky=False, background_writes=False, storage=None, pack=None, prefetch_bytes=pf.default_max_bytes, roi_margin=None
 
 ):
     """
@@ -36,6 +60,47 @@ def all_driver(
         :sep_skies: (Boolean) if true, skies for observations of star STAR are recorded with Object = "STAR sky". If false, observations were taken using a dither pattern and can be used as the skies.
         :plotting_yml: (string) path to the plotting configuration file.
         :selected_stars: (array of strings; OPTIONAL) list of stars to reduce
+        :quality_limits: (dict; OPTIONAL) per-frame quality thresholds used to
+            reject frames before registration. See quality.default_limits.
+        :combine: (string) how registered frames are combined: "median" or "mean".
+        :incremental: (Boolean) if true, only frames that haven't been registered
+            in a previous run are registered.
+        :write_cube: (Boolean) if true, the shifted frames of each star and
+            filter are written to a single sh_cube.fits instead of sh##.fits files.
+        :rebuild_calibrations: (Boolean) if true, every dark, flat and sky is
+            rebuilt. Otherwise only those whose manifests show that their
+            input files changed since they were made are rebuilt.
+        :calib_workers: (int) number of processes making darks, flats and
+            skies at the same time. None uses every core.
+        :library: (CalibrationLibrary; OPTIONAL) cross-night library that
+            darks and flats are published to and, when missing, taken from.
+        :night: (string) night being reduced, as "YYYY-MM-DD". Needed to
+            publish to the library.
+        :dark_model: (Boolean) if true, a linear dark model is fit to all of
+            the night's darks and flats use darks made from it, instead of
+            one master dark being made for each exposure time.
+        :badpix_mask: (Boolean) if true, a bad pixel mask is found from the
+            night's darks and flats, and science frames are repaired with it
+            instead of the instrument's own bad pixel correction.
+        :per_frame_sky: (Boolean) if true, each dithered frame is sky-subtracted
+            with a sky made from the other frames only, so that the star
+            doesn't contaminate its own sky.
+        :background_writes: (Boolean) if true, FITS products and plots are
+            written in background threads while the reduction goes on.
+            See writer.
+        :storage: (dict; OPTIONAL) how intermediate products are stored, as
+            keyword arguments for writer.set_storage, e.g.
+            {"compression": "GZIP_2", "single": True}. Final images are
+            always stored losslessly.
+        :pack: (string; OPTIONAL) directory of a pack of the night's raw
+            frames, made with night_store.pack_night. Raw frames and their
+            headers are read from it rather than from their FITS files.
+        :prefetch_bytes: (int) memory cap for reading the next star's data
+            while the current one is processed, in the image and
+            registration stages. 0 disables prefetching.
+        :roi_margin: (int; OPTIONAL) if set, used in place of the instrument's
+            roi_margin: frames are cropped to the final image footprint plus
+            this many pixels once coarsely centered. See utils.roi_bounds.
     """
     #check if desired reddir exists and create it if needed
     if os.path.isdir(reddir) == False:
@@ -53,53 +118,106 @@ def all_driver(
     if plotting_yml:
         pl.initialize_plotting(plotting_yml)
 
-    #If this is a re-reduction, it's possible to save time by using existing darks, flats, and skies
-    if just_images == False:
-        darks.dark_driver(raw_dir, reddir, config, inst)
-        flats.flat_driver(raw_dir, reddir, config, inst)
-        sky.sky_driver(raw_dir, reddir, config, inst, sep_skies=sep_skies)
-    methods = image.image_driver(raw_dir, reddir, config, inst, sep_skies=sep_skies, selected_stars = selected_stars, verbose=verbose)
-
-
-    star_dirlist = glob(reddir + "*/")
-
-    # we want to ensure that the code doesn't attempt to reduce folders
-    # that are in the reduced directory but not in the config
-
-    cleaned_star_dirlist = [
-        star_dir
-        for star_dir in star_dirlist
-        for ob in config.Object
-        if ob in star_dir
-    ]
-    miter=0
-    print('methods: ', methods)
-    for i, s_dir in enumerate(
-        tqdm(
-            np.unique(cleaned_star_dirlist),
-            desc="Running registration",
-            position=0,
-            leave=True,
-        )
-    ):
-        logger.info(f"Running registration for {s_dir}")
-        logger.info(f"searchsize: {searchsize}")
-        if selected_stars != None:
-            thisstar = os.path.basename(s_dir[:-1])
-            print('this star: ', thisstar)
-            use_method = 'saturated' #workaround for now; would be better to do something like methods[miter]
-            miter += 1
-            if thisstar not in selected_stars:
-                print('Star ', thisstar, 'not in selected list of stars (', selected_stars, ')')
-                continue
-        else:
-            use_method = methods[i]
-
-        image.create_im(s_dir, searchsize, method=use_method, verbose=verbose)
-
-
-    #make summary plot showing reduced images of all stars observed
-    summarize.image_grid(reddir)
+    failed = True
+    try:
+        if background_writes:
+            wr.start()
+        if storage is not None:
+            wr.set_storage(**storage)
+        if pack is not None:
+            ns.use(pack)
+
+        #If this is a re-reduction, it's possible to save time by using existing darks, flats, and skies
+        if just_images == False and calib_workers == 1:
+            if dark_model:
+                dm.model_driver(raw_dir, reddir, config, inst, force=rebuild_calibrations)
+            else:
+                darks.dark_driver(raw_dir, reddir, config, inst, force=rebuild_calibrations, library=library, night=night)
+            flats.flat_driver(raw_dir, reddir, config, inst, force=rebuild_calibrations, library=library, night=night, dark_model=dark_model)
+            if badpix_mask:
+                bp.mask_driver(raw_dir, reddir, config, inst, force=rebuild_calibrations)
+            sky.sky_driver(raw_dir, reddir, config, inst, sep_skies=sep_skies, force=rebuild_calibrations, per_frame=per_frame_sky)
+        elif just_images == False:
+            calibration_driver(
+                raw_dir,
+                reddir,
+                config,
+                inst,
+                sep_skies=sep_skies,
+                plotting_yml=plotting_yml,
+                force=rebuild_calibrations,
+                max_workers=calib_workers,
+                library=library,
+                night=night,
+                dark_model=dark_model,
+                badpix_mask=badpix_mask,
+                per_frame_sky=per_frame_sky,
+            )
+        methods = image.image_driver(raw_dir, reddir, config, inst, sep_skies=sep_skies, selected_stars = selected_stars, verbose=verbose, quality_limits=quality_limits, write_cube=write_cube, badpix_mask=badpix_mask, prefetch_bytes=prefetch_bytes, roi_margin=roi_margin)
+
+
+        star_dirlist = glob(reddir + "*/")
+
+        # we want to ensure that the code doesn't attempt to reduce folders
+        # that are in the reduced directory but not in the config
+
+        cleaned_star_dirlist = [
+            star_dir
+            for star_dir in star_dirlist
+            for ob in config.Object
+            if ob in star_dir
+        ]
+        miter=0
+        print('methods: ', methods)
+        star_dirs = np.unique(cleaned_star_dirlist)
+        with pf.Prefetcher(prefetch_bytes) as prefetcher:
+            for i, s_dir in enumerate(
+                tqdm(
+                    star_dirs,
+                    desc="Running registration",
+                    position=0,
+                    leave=True,
+                )
+            ):
+                # this star's shifted frames were read while the last one was registered
+                prefetcher.wait()
+                if i + 1 < len(star_dirs):
+                    prefetcher.start(pf.read_files, glob(star_dirs[i + 1] + "*/sh*.fits"))
+                logger.info(f"Running registration for {s_dir}")
+                logger.info(f"searchsize: {searchsize}")
+                if selected_stars != None:
+                    thisstar = os.path.basename(s_dir[:-1])
+                    print('this star: ', thisstar)
+                    use_method = 'saturated' #workaround for now; would be better to do something like methods[miter]
+                    miter += 1
+                    if thisstar not in selected_stars:
+                        print('Star ', thisstar, 'not in selected list of stars (', selected_stars, ')')
+                        continue
+                else:
+                    use_method = methods[i]
+
+                image.create_im(s_dir, searchsize, method=use_method, verbose=verbose, combine=combine, incremental=incremental)
+
+
+        #make summary plot showing reduced images of all stars observed
+        summarize.image_grid(reddir)
+        failed = False
+    finally:
+        # the writer, storage policy and pack are shared, so they are
+        # put back even if the reduction fails. The writer is stopped last,
+        # as it re-raises the errors of background writes, and those are
+        # only logged if the reduction already failed for another reason.
+        if pack is not None:
+            ns.release(pack)
+        if storage is not None:
+            wr.set_storage()
+        if background_writes:
+            try:
+                wr.stop()
+            except Exception:
+                if not failed:
+                    raise
+                logger.exception("Background writes also failed.")
 
     #make summary plot showing contrast curves for all stars observed
     #summarize.nightly_contrast_curve(reddir)
@@ -118,6 +236,145 @@ def all_driver(
     """
 
 
+def calibration_driver(
+    raw_dir,
+    reddir,
+    config,
+    inst,
+    sep_skies=False,
+    plotting_yml=None,
+    force=False,
+    max_workers=None,
+    library=None,
+    night=None,
+    dark_model=False,
+    badpix_mask=False,
+    per_frame_sky=False,
+    pack=None,
+):
+    """
+    Makes every dark, flat and sky of a night, running independent ones at
+    the same time. Each flat only waits for the dark with its exposure time,
+    and each sky only for the flat of its filter, so the stage takes about
+    as long as its slowest dark -> flat -> sky chain.
+
+    Inputs:
+        :raw_dir: (string) directory for the raw data
+        :reddir: (string) directory for the reduced data
+        :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :sep_skies: (Boolean) if true, skies for observations of star STAR are recorded with Object = "STAR sky". If false, observations were taken using a dither pattern and can be used as the skies.
+        :plotting_yml: (string) path to the plotting configuration file.
+        :force: (bool) if True, products are rebuilt even if their manifests
+            show they are up to date.
+        :max_workers: (int) number of worker processes. None uses every core.
+        :library: (CalibrationLibrary) library that darks and flats are
+            published to. Missing darks are taken from it, and darks and flats
+            are restored from it if the library is set to reuse products.
+        :night: (str) night being reduced, as "YYYY-MM-DD".
+        :dark_model: (bool) if True, one dark model is fit for the night in
+            place of the darks, and every flat waits for it.
+        :badpix_mask: (bool) if True, the night's bad pixel mask is also
+            found, once every flat is made. It reads the raw darks itself.
+        :per_frame_sky: (bool) if True, skies also get a leave-one-out sky
+            for each frame. See sky.create_skies.
+        :pack: (str) directory of a pack of the night's raw frames, made
+            with night_store.pack_night. Worker processes read raw frames
+            and headers from it rather than from their FITS files.
+    """
+    with ns.using(pack):
+        tasks = {}
+        reuse = library is not None and library.reuse
+
+        darkfiles = {}
+        if dark_model:
+            darkfiles[reddir + dm.model_name] = "dark model"
+            tasks["dark model"] = (
+                partial(dm.model_driver, force=force),
+                (raw_dir, reddir, config, inst),
+                [],
+            )
+            darklists = {}
+        else:
+            darklists = darks.dark_lists(config)
+        for texp, darklist in darklists.items():
+            product = f"dark_{int(round(texp))}sec"
+            if reuse and library.restore(inst, product, reddir, night):
+                continue
+            name = f"dark {texp}"
+            darkfiles[reddir + product + ".fits"] = name
+            tasks[name] = (
+                partial(darks.create_darks, force=force),
+                (raw_dir, reddir, darklist, inst),
+                [],
+            )
+
+        flatlists = flats.flat_lists(config, reddir, dark_model=dark_model)
+        for filter_name, (flatlist, darkfile) in flatlists.items():
+            if reuse and library.restore(
+                inst,
+                flats.flat_product(raw_dir, flatlist, inst, filter_name),
+                reddir,
+                night,
+            ):
+                continue
+            if darkfile in darkfiles:
+                deps = [darkfiles[darkfile]]
+            else:
+                deps = []
+                if library is not None and not os.path.exists(darkfile):
+                    library.restore(
+                        inst, os.path.basename(darkfile)[:-5], reddir, night
+                    )
+            tasks[f"flat {filter_name}"] = (
+                partial(flats.create_flats, filter_name=filter_name, force=force),
+                (raw_dir, reddir, flatlist, darkfile, inst),
+                deps,
+            )
+
+        all_flats = [name for name in tasks if name.startswith("flat ")]
+        if badpix_mask:
+            tasks["bad pixels"] = (
+                partial(bp.mask_driver, force=force),
+                (raw_dir, reddir, config, inst),
+                all_flats,
+            )
+        for starname, skylists in sky.sky_lists(config, inst, sep_skies).items():
+            s_dir = reddir + starname + "/"
+            os.makedirs(s_dir, exist_ok=True)
+            for filter_name, skylist in skylists.items():
+                # a filter without flats of its own uses another filter's flat
+                # (e.g. Br-gamma on PHARO), so its sky waits for all of them
+                if f"flat {filter_name}" in tasks:
+                    deps = [f"flat {filter_name}"]
+                else:
+                    deps = all_flats
+                tasks[f"sky {starname} {filter_name}"] = (
+                    partial(
+                        sky.create_skies,
+                        filter_name=filter_name,
+                        force=force,
+                        per_frame=per_frame_sky,
+                    ),
+                    (raw_dir, reddir, s_dir, skylist, inst),
+                    deps,
+                )
+
+        tasks = {
+            name: (
+                partial(_task, func, storage=wr.storage(), packs=ns.active()),
+                args,
+                deps,
+            )
+            for name, (func, args, deps) in tasks.items()
+        }
+        logger.info(f"Making {len(tasks)} calibration products.")
+        par.run_graph(tasks, max_workers=max_workers, plotting_yml=plotting_yml)
+
+        if library is not None:
+            library.publish_night(reddir, inst, night)
+
+
 def image_driver(inst, config_file, raw_dir, reddir):
     """
     Runs all_drivers, terminating after running image_drivers.
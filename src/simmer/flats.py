@@ -7,27 +7,37 @@ from glob import glob
 
 from os import path
 
-import astropy.io.fits as pyfits
 import numpy as np
 from tqdm import tqdm
 
+from . import calib_cache as cc
+from . import combine as comb
+from . import dark_model as dm
+from . import manifest as mf
+from . import night_store as ns
 from . import plotting as pl
 from . import utils as u
+from . import writer as wr
 
 class DarkOpeningError(FileNotFoundError):
     pass
 
 
-def open_darks(darkfile):
+def open_darks(darkfile, itime=None):
     """
-    Opens dark files. Essentially a wrapper around pyfits.getdata that
-    also includes a descriptive exception if the file doesn't exist.
+    Opens dark files through the calibration cache, with a descriptive
+    exception if the file doesn't exist. If the file is a dark model, marked
+    by the DARKMODL keyword, the dark for the given exposure time is made
+    from it.
 
     Inputs:
-        :darkfile: (str) path to dark to be opened.
+        :darkfile: (str) path to dark, or dark model, to be opened.
+        :itime: (float) exposure time of the frames to be corrected. Needed
+                for dark models.
 
     Outputs:
-        :dark: (array) data from darks FITS file.
+        :dark: (array) read-only data from darks FITS file, or the dark
+                synthesized from the model.
     """
     if darkfile[-4:] != "fits":
         raise DarkOpeningError(
@@ -39,11 +49,29 @@ def open_darks(darkfile):
             file corresponding to every exposure setting used in your observations and flats."""
         )
     else:
-        dark = pyfits.getdata(darkfile, 0)
+        dark = cc.get(darkfile)
+        # only a 3D file can be a model, so 2D darks skip the header read
+        if dark.ndim == 3 and u.read_header(darkfile).get("DARKMODL", False):
+            if itime is None:
+                raise ValueError(
+                    "An exposure time is needed to make a dark from a model."
+                )
+            return dm.synthesize_dark(dark, itime)
         return dark
 
 
-def flat_driver(raw_dir, reddir, config, inst, plotting_yml=None):
+def flat_driver(
+    raw_dir,
+    reddir,
+    config,
+    inst,
+    plotting_yml=None,
+    force=False,
+    library=None,
+    night=None,
+    dark_model=False,
+    pack=None,
+):
     """Sets up and runs create_flats.
 
     Inputs:
@@ -52,20 +80,80 @@ def flat_driver(raw_dir, reddir, config, inst, plotting_yml=None):
         :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
         :inst: (Instrument object) instrument for which data is being reduced.
         :plotting_yml: (string) path to the plotting configuration file.
+        :force: (bool) if True, flats are rebuilt even if their manifests
+                show they are up to date.
+        :library: (CalibrationLibrary) library that flats are published to.
+                A dark missing from reddir is taken from the nearest night
+                in the library, and flats are restored from it if the
+                library is set to reuse products.
+        :night: (str) night being reduced, as "YYYY-MM-DD".
+        :dark_model: (bool) if True, flats are dark-subtracted with darks made
+                from the night's dark model (see dark_model.model_driver)
+                rather than with the dark of the same exposure time.
+        :pack: (str) directory of a pack of the night's raw frames, made
+                with night_store.pack_night, to read raw frames and headers
+                from rather than their FITS files.
 
     """
-    if plotting_yml:
-        pl.initialize_plotting(plotting_yml)
+    with ns.using(pack):
+        if plotting_yml:
+            pl.initialize_plotting(plotting_yml)
+
+        flatlists = flat_lists(config, reddir, dark_model=dark_model)
+
+        for filter_name in tqdm(
+            flatlists, desc="Running flats", position=0, leave=True
+        ):
+            flatlist, darkfile = flatlists[filter_name]
+            if library is not None:
+                if library.reuse and library.restore(
+                    inst,
+                    flat_product(raw_dir, flatlist, inst, filter_name),
+                    reddir,
+                    night,
+                ):
+                    continue
+                if not path.exists(darkfile):
+                    library.restore(
+                        inst, path.basename(darkfile)[:-5], reddir, night
+                    )
+            create_flats(
+                raw_dir,
+                reddir,
+                flatlist,
+                darkfile,
+                inst,
+                filter_name=filter_name,
+                force=force,
+            )
+
+        wr.flush()
+        if library is not None:
+            library.publish_night(reddir, inst, night)
+
+
+def flat_lists(config, reddir, dark_model=False):
+    """Groups the flats of a night by filter, with one master flat to be made
+    for each group, and finds the dark each group needs.
+
+    Inputs:
+        :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
+        :reddir: (string) directory for the reduced data
+        :dark_model: (bool) if True, every filter uses the night's dark model.
 
+    Outputs:
+        :flatlists: (dict) for each filter, the list of flat file numbers and
+                the path to the dark with the flats' exposure time, or to the
+                dark model.
+    """
     _flats = config[config.Object == "flat"]
     filts = _flats.Filter.tolist()
 
     #Remove duplicates from list of filters
     filts = np.unique(filts)
 
-    for filter_name in tqdm(
-        filts, desc="Running flats", position=0, leave=True
-    ):
+    flatlists = {}
+    for filter_name in filts:
         flatlist = []
         ww = np.where(_flats.Filter == filter_name)
         allfiles = _flats.iloc[ww].Filenums.values
@@ -76,14 +164,42 @@ def flat_driver(raw_dir, reddir, config, inst, plotting_yml=None):
         itime = _flats[_flats.Filter == filter_name].ExpTime.values[0]
 
         # darks are matched with flats by exposure time
-        darkfile = reddir + f"dark_{int(round(itime))}sec.fits"
-        create_flats(
-            raw_dir, reddir, flatlist, darkfile, inst, filter_name=filter_name
-        )
+        if dark_model:
+            darkfile = reddir + dm.model_name
+        else:
+            darkfile = reddir + f"dark_{int(round(itime))}sec.fits"
+        flatlists[filter_name] = (flatlist, darkfile)
+    return flatlists
+
+
+def flat_product(raw_dir, flatlist, inst, filter_name=None):
+    """Finds the name that create_flats gives the master flat of a list of
+    flats, which comes from the filter in the first flat's header rather
+    than from the config (e.g. flat_K_short for PHARO's Ks).
+
+    Inputs:
+        :raw_dir: (str) directory where the raw data is stored.
+        :flatlist: (list) list of integers corresponding to flats.
+        :inst: (inst object) instrument for which data is being reduced.
+        :filter_name: (str) filter name to use if the header's is unknown.
+
+    Outputs:
+        :product: (str) product name, e.g. "flat_K_short".
+    """
+    flatfiles = u.make_filelist(raw_dir, flatlist[:1], inst)
+    head = inst.head(flatfiles[0])
+    return f"flat_{inst.filt(len(flatlist), head, filter_name)}"
 
 
 def create_flats(
-    raw_dir, reddir, flatlist, darkfile, inst, filter_name=None, test=False
+    raw_dir,
+    reddir,
+    flatlist,
+    darkfile,
+    inst,
+    filter_name=None,
+    test=False,
+    force=False,
 ):
     """Create a flat from a single list of flat files.
 
@@ -95,6 +211,8 @@ def create_flats(
         :filter_name: (str) filter name given if head['FILT1NAM'] == 'Unknown'
         :plotting_yml: (string) path to the plotting configuration file.
         :test: (bool) Boolean flag used for testing purposes.
+        :force: (bool) if True, the flat is rebuilt even if its manifest
+                shows it is up to date with its raw frames and dark.
 
     Outputs:
         :final_flat: (array) median-filtered flat.
@@ -106,15 +224,20 @@ def create_flats(
     short_flatfiles = flatfiles.copy()
     for jj in np.arange(len(flatfiles)):
         short_flatfiles[jj] = os.path.basename(flatfiles[jj]).split('.')[0]
-    flat_array = u.read_imcube(flatfiles)
-    flat_array = inst.adjust_array(flat_array, nflats)
     head = inst.head(flatfiles[0])
     filt = inst.filt(nflats, head, filter_name)
 
+    flat_filename = reddir + f"flat_{filt}.fits"
+    inputs = flatfiles if test else flatfiles + [darkfile]
+    if not force and mf.is_current(flat_filename, inputs, inst):
+        return cc.get(flat_filename)
+
+    flat_array, _ = u.read_frames(flatfiles, inst)
+
     if test:
         dark = 0.0
     else:
-        dark = open_darks(darkfile)
+        dark = open_darks(darkfile, inst.itime(head))
 
     for i in range(nflats):
         flat_array[i, :, :] = flat_array[i, :, :] - dark
@@ -122,13 +245,13 @@ def create_flats(
             flat_array[i, :, :]
         )
 
-    final_flat = np.median(flat_array, axis=0)
+    final_flat = comb.median(flat_array)
     final_flat = final_flat / np.median(final_flat)
 
     #CDD change: use a narrow range for flat colorscaling (was -2, 2)
     flat_vmin, flat_vmax = np.percentile(flat_array, [1,99])
-    pl.plot_array(
-        "intermediate", flat_array, flat_vmin, flat_vmax, reddir, f"flat_cube_{filt}.png", snames=short_flatfiles
+    wr.plot(
+        pl.plot_array, "intermediate", flat_array, flat_vmin, flat_vmax, reddir, f"flat_cube_{filt}.png", snames=short_flatfiles
     )
 
     # CDD update
@@ -136,9 +259,6 @@ def create_flats(
     head.set("DATAFILE", str(flatlist))  # add all file names
     # end CDD update
 
-    hdu = pyfits.PrimaryHDU(final_flat, header=head)
-    hdu.writeto(
-        reddir + f"flat_{filt}.fits", overwrite=True, output_verify="ignore"
-    )
+    wr.write_product(flat_filename, final_flat, head, inputs, inst)
 
     return final_flat
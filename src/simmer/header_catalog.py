@@ -0,0 +1,253 @@
+"""
+Module for a catalog of the FITS header keywords of a night's raw frames.
+The catalog is read once, in parallel, and kept next to the data as a CSV
+table with one row per file, so that checking the log sheet, finding dark
+exposure times and searching for bad headers don't reopen every frame.
+Files that are new or have changed since the catalog was written are
+re-read when it is next loaded.
+
+Headers are read with a minimal scanner that only parses the cards it is
+asked for, falling back to astropy for anything it doesn't handle. Raw
+frames may be plain, gzipped (.fits.gz) or tile-compressed (.fits.fz).
+"""
+
+import gzip
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pandas as pd
+
+from . import utils as u
+
+import logging
+logger = logging.getLogger('simmer')
+
+catalog_name = "_header_catalog.csv"
+
+# keywords used anywhere in the reduction to sort or check raw frames
+keywords = [
+    "OBJECT",
+    "ITIME0",
+    "T_INT",
+    "TRUITIME",
+    "FILT1NAM",
+    "FILT2NAM",
+    "FILTER",
+    "RA",
+    "DEC",
+    "DATAFILE",
+    "FRAMENUM",
+]
+string_keywords = [
+    "OBJECT", "FILT1NAM", "FILT2NAM", "FILTER", "RA", "DEC", "DATAFILE"
+]
+
+block_size = 2880
+card_size = 80
+
+_int_value = re.compile(r"[+-]?\d+")
+_float_value = re.compile(r"[+-]?(\d+\.?\d*|\.\d+)([EeDd][+-]?\d+)?")
+
+
+def _parse_value(text):
+    """
+    Parses the value field of a header card (columns 11-80) the way
+    astropy does for strings, logicals, integers and reals. Raises a
+    ValueError for anything else.
+    """
+    text = text.lstrip()
+    if text.startswith("'"):
+        # quotes inside a string are doubled
+        chars = []
+        start = 1
+        while True:
+            end = text.find("'", start)
+            if end < 0:
+                raise ValueError("Unterminated string value.")
+            if text[end + 1 : end + 2] == "'":
+                chars.append(text[start : end + 1])
+                start = end + 2
+                continue
+            chars.append(text[start:end])
+            break
+        value = "".join(chars).rstrip()
+        if value.endswith("&"):
+            raise ValueError("Long string values continue over several cards.")
+        return value
+
+    value = text.split("/", 1)[0].strip()
+    if value == "T":
+        return True
+    if value == "F":
+        return False
+    if _int_value.fullmatch(value):
+        return int(value)
+    if _float_value.fullmatch(value):
+        return float(value.replace("D", "E").replace("d", "e"))
+    raise ValueError(f"Can't parse the header value {value!r}.")
+
+
+def _scan(filename, keys):
+    """
+    Reads header blocks from the start of a file until END, parsing only
+    the cards of the given keywords. Raises a ValueError for anything that
+    isn't a plain primary header with an image, e.g. the empty primary
+    header of a tile-compressed file.
+    """
+    wanted = set(keys) | {"NAXIS"}
+    found = {}
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f:
+        first = True
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                raise ValueError("The header ends before its END card.")
+            text = block.decode("ascii")
+            if first and not text.startswith("SIMPLE  ="):
+                raise ValueError("Not a primary FITS header.")
+            first = False
+            for start in range(0, block_size, card_size):
+                card = text[start : start + card_size]
+                name = card[:8].rstrip()
+                if name == "END":
+                    if not found.get("NAXIS"):
+                        raise ValueError("The primary HDU has no image.")
+                    return {key: found.get(key) for key in keys}
+                if name in wanted and name not in found:
+                    if card[8:10] != "= ":
+                        raise ValueError(f"{name} has no value.")
+                    found[name] = _parse_value(card[10:])
+
+
+def scan_header(filename, keys):
+    """
+    Reads a few keywords from the primary header of a FITS file without
+    building an astropy Header. Gzipped files are scanned as they are
+    decompressed. Files the scanner can't read simply (e.g. tile-compressed
+    files, long strings or complex values) are read with astropy instead, as
+    are files it can't decompress, since astropy finds compression from a
+    file's contents rather than its name.
+
+    Inputs:
+        :filename: (string) path to a FITS file.
+        :keys: (list of str) upper case keywords to read.
+
+    Outputs:
+        :values: (dict) value of each keyword, or None if it's missing.
+    """
+    try:
+        return _scan(filename, keys)
+    except (ValueError, UnicodeDecodeError, OSError, EOFError):
+        # e.g. a truncated .gz file, or an uncompressed one named .gz
+        head = u.read_header(filename)
+        return {key: head.get(key) for key in keys}
+
+
+def _read_row(filename):
+    """
+    Reads the catalog keywords of one file, with None for missing ones.
+    """
+    stat = os.stat(filename)
+    head = scan_header(filename, keywords)
+    row = {
+        "file": os.path.basename(filename),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    for key in keywords:
+        value = head.get(key)
+        if key in string_keywords and value is not None:
+            value = str(value)
+        row[key] = value
+    return row
+
+
+def load_catalog(raw_dir, max_workers=None):
+    """
+    Returns the header catalog of a raw directory, reading the headers of
+    files that aren't in the saved catalog or have changed since, and
+    saving the updated catalog.
+
+    Inputs:
+        :raw_dir: (string) path of the directory containing the raw data.
+        :max_workers: (int) number of reading threads. None uses the default
+                of concurrent.futures.ThreadPoolExecutor.
+
+    Outputs:
+        :catalog: (pandas DataFrame) keywords of each FITS file, indexed by
+                file name. Missing keywords are NaN.
+    """
+    catalog_file = raw_dir + catalog_name
+    files = sorted(u.find_fits(raw_dir + "*"))
+    stats = {}
+    for filename in files:
+        stat = os.stat(filename)
+        stats[os.path.basename(filename)] = (stat.st_size, stat.st_mtime_ns)
+
+    if os.path.exists(catalog_file):
+        saved = pd.read_csv(
+            catalog_file, dtype={key: str for key in string_keywords}
+        ).set_index("file", drop=False)
+        unchanged = [
+            name
+            for name in saved.index
+            if stats.get(name)
+            == (saved.at[name, "size"], saved.at[name, "mtime_ns"])
+        ]
+        removed = len(unchanged) != len(saved)
+        saved = saved.loc[unchanged]
+    else:
+        saved = None
+        unchanged = []
+        removed = False
+
+    stale = [f for f in files if os.path.basename(f) not in set(unchanged)]
+    if saved is not None and not stale and not removed:
+        return saved
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rows = list(pool.map(_read_row, stale))
+    logger.debug(f"Read the headers of {len(rows)} files into the catalog.")
+
+    catalog = pd.DataFrame(
+        rows, columns=["file", "size", "mtime_ns"] + keywords
+    ).set_index("file", drop=False)
+    if saved is not None and len(saved):
+        catalog = pd.concat([saved, catalog])
+    catalog = catalog.sort_index()
+    try:
+        catalog.to_csv(catalog_file, index=False)
+    except OSError:
+        logger.warning(
+            f"Can't write the header catalog to {raw_dir}; it will be "
+            "rebuilt next time."
+        )
+    return catalog
+
+
+def header(catalog, filename):
+    """
+    Builds a FITS header holding the catalog keywords of a file, for
+    functions such as inst.itime and inst.filt that take a header.
+
+    Inputs:
+        :catalog: (pandas DataFrame) catalog from load_catalog.
+        :filename: (string) path or name of the file.
+
+    Outputs:
+        :head: (astropy.io.fits Header) the file's catalog keywords. Keywords
+                that the file doesn't have are left out.
+    """
+    row = catalog.loc[os.path.basename(filename)]
+    head = pyfits.Header()
+    for key in keywords:
+        value = row[key]
+        if isinstance(value, str) or not pd.isna(value):
+            if isinstance(value, (np.integer, np.floating)):
+                value = value.item()
+            head[key] = value
+    return head
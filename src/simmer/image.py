@@ -10,11 +10,22 @@ import astropy.io.fits as pyfits
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from astropy.convolution import Gaussian2DKernel, interpolate_replace_nans
 
+from . import badpix as bp
+from . import calib_cache as cc
+from . import combine as comb
+from . import drizzle as dz
+from . import manifest as mf
+from . import nan_interp as ni
+from . import night_store as ns
 from . import plotting as pl
+from . import prefetch as pf
+from . import quality as qual
+from . import raw_cache as rc
 from . import registration as reg
+from . import stack_store as ss
 from . import utils as u
+from . import writer as wr
 from . import contrast as contrast
 
 import logging
@@ -27,14 +38,14 @@ class FlatOpeningError(ValueError):
 
 def open_flats(flatfile):
     """
-    Opens flats files. Essentially a wrapper around pyfits.getdata that
-    also includes a descriptive exception if the file doesn't exist.
+    Opens flats files through the calibration cache, with a descriptive
+    exception if the file doesn't exist.
 
     Inputs:
         :flatfile: (str) path to dark to be opened.
 
     Outputs:
-        :dark: (array) data from darks FITS file.
+        :flat: (array) read-only data from flats FITS file.
     """
     if flatfile[-4:] != "fits":
         raise FlatOpeningError(
@@ -46,11 +57,11 @@ def open_flats(flatfile):
             file corresponding to every filter used in your observations."""
         )
     else:
-        flat = pyfits.getdata(flatfile, 0)
+        flat = cc.get(flatfile)
         return flat
 
 
-def image_driver(raw_dir, reddir, config, inst, sep_skies=False, plotting_yml=None, selected_stars = None, verbose=False):
+def image_driver(raw_dir, reddir, config, inst, sep_skies=False, plotting_yml=None, selected_stars = None, verbose=False, quality_limits=None, write_cube=False, badpix_mask=False, prefetch_bytes=pf.default_max_bytes, roi_margin=None, pack=None):
     """Do flat division, sky subtraction, and initial alignment via coords in header.
     Returns Python list of each registration method used per star.
 
@@ -61,93 +72,156 @@ def image_driver(raw_dir, reddir, config, inst, sep_skies=False, plotting_yml=No
         :inst: (Instrument object) instrument for which data is being reduced.
         :plotting_yml: (string) path to the plotting configuration file.
         :selected_stars: (array of strings; OPTIONAL) list of stars to reduce
+        :quality_limits: (dict; OPTIONAL) per-frame quality thresholds used to
+                reject frames before registration. See quality.default_limits.
+        :write_cube: (bool) if True, the shifted frames of each star and filter
+                are written as a single sh_cube.fits instead of sh##.fits files.
+        :badpix_mask: (bool) if True, bad pixels are repaired using the night's
+                mask from badpix.mask_driver, when there is one.
+        :prefetch_bytes: (int) memory cap for reading the next star and
+                filter's frames and calibrations while the current one is
+                processed. 0 disables prefetching.
+        :roi_margin: (int) if set, used in place of inst.roi_margin. See
+                create_imstack.
+        :pack: (str) directory of a pack of the night's raw frames, made
+                with night_store.pack_night, to read raw frames and headers
+                from rather than their FITS files.
     """
-    # Save these images to the appropriate folder.
+    with ns.using(pack):
+        # Save these images to the appropriate folder.
 
-    if plotting_yml:
-        pl.initialize_plotting(plotting_yml)
+        if plotting_yml:
+            pl.initialize_plotting(plotting_yml)
 
-    if inst.take_skies:
-        skies = config[config.Comments == "sky"]
-    else:
-        skies = config[
-            (config.Object != "flat")
-            & (config.Object != "dark")
-            & (config.Object != "setup")
-        ]
-    stars = skies.Object.unique()
-    sdirs = glob(reddir + "*/")
-
-    #Make sure list of stars doesn't include sky frames taken by nodding
-    if sep_skies == True:
-        keep = np.zeros(len(stars)) + 1
-        for kk in np.arange(len(keep)):
-            if("sky" in stars[kk]):
-                keep[kk] = 0
-        wstar = np.where(keep == 1)
-        stars = stars[wstar]
+        if inst.take_skies:
+            skies = config[config.Comments == "sky"]
+        else:
+            skies = config[
+                (config.Object != "flat")
+                & (config.Object != "dark")
+                & (config.Object != "setup")
+            ]
+        stars = skies.Object.unique()
+        sdirs = glob(reddir + "*/")
+
+        #Make sure list of stars doesn't include sky frames taken by nodding
+        if sep_skies == True:
+            keep = np.zeros(len(stars)) + 1
+            for kk in np.arange(len(keep)):
+                if("sky" in stars[kk]):
+                    keep[kk] = 0
+            wstar = np.where(keep == 1)
+            stars = stars[wstar]
 
-    else:
-        stars = stars
-
-    methods = []
-
-    for star in tqdm(
-        np.unique(stars), desc="Running image driver", position=0, leave=True
-    ):
-        #Check if we want to run this star
-        if selected_stars != None:
-            if star not in selected_stars:
-                print('Star ', star, 'not in selected list of stars (', selected_stars, ')')
-                continue
-        s_dir = reddir + star + "/"
-        if (
-            s_dir not in sdirs
-        ):  # make sure there's a subdirectory for each star
-            os.mkdir(s_dir)
-
-        filts = skies[
-            skies.Object == star
-        ].Filter.values  # array of filters as strings
-
-        #Remove duplicates from list of filters
-        filts = np.unique(filts)
-
-        for n, filter_name in enumerate(filts):
-            obj = config[config.Object == star]
-
-            #Trying workaround
-            ww = np.where(np.logical_and(obj.Filter.values == filter_name,
-                obj.Comments != 'sky'))
-            allfiles = obj.iloc[ww].Filenums.values
-            imlist = []
-            for aa in np.arange(len(allfiles)):
-                for bb in eval(allfiles[aa]):
-                    imlist.append(bb)
-
-            # cast obj_methods as list so that elementwise comparison isn't performed
-            obj_methods = config[config.Object == star].Method.values
-
-            # use pd.isnull because it can check against strings
-            if np.all(pd.isnull(obj_methods)):
-                methods.append("quick_look")
-            else:
-                obj_method = obj_methods[~pd.isnull(obj_methods)][0].lower()
-                if "saturated" and "separated" in obj_method:
-                    methods.append("saturated separated")
-                elif "saturated" in obj_method and "separated" not in obj_method:
-                    methods.append("saturated")
-
-                elif "saturated" not in obj_method and "separated" in obj_method:
-                    methods.append("separated")
-            create_imstack(
-                raw_dir, reddir, s_dir, imlist, inst, filter_name=filter_name
-            )
-    return methods
+        else:
+            stars = stars
+
+        methods = []
+        units = []
+
+        for star in np.unique(stars):
+            #Check if we want to run this star
+            if selected_stars != None:
+                if star not in selected_stars:
+                    print('Star ', star, 'not in selected list of stars (', selected_stars, ')')
+                    continue
+            s_dir = reddir + star + "/"
+            if (
+                s_dir not in sdirs
+            ):  # make sure there's a subdirectory for each star
+                os.mkdir(s_dir)
+
+            filts = skies[
+                skies.Object == star
+            ].Filter.values  # array of filters as strings
+
+            #Remove duplicates from list of filters
+            filts = np.unique(filts)
+
+            for n, filter_name in enumerate(filts):
+                obj = config[config.Object == star]
+
+                #Trying workaround
+                ww = np.where(np.logical_and(obj.Filter.values == filter_name,
+                    obj.Comments != 'sky'))
+                allfiles = obj.iloc[ww].Filenums.values
+                imlist = []
+                for aa in np.arange(len(allfiles)):
+                    for bb in eval(allfiles[aa]):
+                        imlist.append(bb)
+
+                # cast obj_methods as list so that elementwise comparison isn't performed
+                obj_methods = config[config.Object == star].Method.values
+
+                # use pd.isnull because it can check against strings
+                if np.all(pd.isnull(obj_methods)):
+                    methods.append("quick_look")
+                else:
+                    obj_method = obj_methods[~pd.isnull(obj_methods)][0].lower()
+                    if "saturated" and "separated" in obj_method:
+                        methods.append("saturated separated")
+                    elif "saturated" in obj_method and "separated" not in obj_method:
+                        methods.append("saturated")
+
+                    elif "saturated" not in obj_method and "separated" in obj_method:
+                        methods.append("separated")
+                units.append((s_dir, imlist, filter_name))
+
+        with pf.Prefetcher(prefetch_bytes) as prefetcher:
+            for k, (s_dir, imlist, filter_name) in enumerate(
+                tqdm(units, desc="Running image driver", position=0, leave=True)
+            ):
+                # this unit was read while the last one was processed
+                prefetcher.wait()
+                if k + 1 < len(units):
+                    prefetcher.start(
+                        prefetch_imstack, raw_dir, reddir, *units[k + 1], inst
+                    )
+                create_imstack(
+                    raw_dir, reddir, s_dir, imlist, inst, filter_name=filter_name,
+                    quality_limits=quality_limits, write_cube=write_cube,
+                    badpix_mask=badpix_mask, roi_margin=roi_margin,
+                )
+        wr.flush()
+        return methods
+
+
+def prefetch_imstack(raw_dir, reddir, s_dir, imlist, filter_name, inst, max_bytes):
+    """Reads the raw frames, headers, flat and sky that create_imstack will
+    need into the raw frame and calibration caches, unless the frames take
+    more than max_bytes (or more than the raw frame cache holds).
+
+    Inputs:
+        :raw_dir: (string) path to directory containing raw data
+        :reddir: (string) path to directory containing reduced data
+        :s_dir: (string) path to directory corresponding to a specific star.
+        :imlist: (list) file numbers of the images.
+        :filter_name: (string) name of the filter used for the images in question.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :max_bytes: (int) memory cap for the frames.
+    """
+    imfiles = u.make_filelist(raw_dir, imlist, inst)
+    first, _ = rc.read_frames(imfiles[:1], inst)
+    nbytes = first.nbytes * len(imfiles)
+    if nbytes > min(max_bytes, rc.max_bytes):
+        logger.debug(
+            f"Not prefetching {s_dir} ({filter_name}): its frames take "
+            f"{nbytes} bytes."
+        )
+        return
+    rc.read_frames(imfiles, inst)
+
+    filt = inst.filt(len(imlist), inst.head(imfiles[0]), filter_name)
+    flatfile = cc.flat_file(reddir, filt, inst)
+    skyfile = s_dir + filt + "/sky.fits"
+    for calfile in [flatfile, skyfile]:
+        if os.path.exists(calfile):
+            cc.get(calfile)
 
 
 def create_imstack(
-    raw_dir, reddir, s_dir, imlist, inst, plotting_yml=None, filter_name=None
+    raw_dir, reddir, s_dir, imlist, inst, plotting_yml=None, filter_name=None,
+    quality_limits=None, write_cube=False, badpix_mask=False, roi_margin=None,
 ):
     """Create the stack of images by performing flat division, sky subtraction.
 
@@ -159,6 +233,19 @@ def create_imstack(
         :inst: (Instrument object) instrument for which data is being reduced.
         :plot: (bool) determines whether or not intermediate plots should be produced.
         :filter_name: (string) name of the filter used for the images in question.
+        :quality_limits: (dict) per-frame quality thresholds. Rejected frames
+                are still written, but flagged in quality.csv so that
+                create_im skips them.
+        :write_cube: (bool) if True, all shifted frames are written to a single
+                sh_cube.fits, with each frame's header in its HEADERS table
+                extension, rather than to one sh##.fits file per frame.
+        :badpix_mask: (bool) if True, bad pixels are repaired using the night's
+                mask from badpix.mask_driver, when there is one, instead of
+                the instrument's own correction.
+        :roi_margin: (int) if set, used in place of inst.roi_margin: frames
+                are cropped to the final image footprint plus this margin
+                once coarsely centered. See utils.roi_bounds for how much
+                that saves.
 
     Outputs:
         :im_array: (3d array) array of 2d images.
@@ -176,9 +263,8 @@ def create_imstack(
     for jj in np.arange(len(imfiles)):
         original_fnames[jj] = os.path.basename(imfiles[jj]).split('.')[0]
 
-    im_array = u.read_imcube(imfiles)
-
-    im_array = inst.adjust_array(im_array, nims)
+    #Frames already read for the sky come from the cache
+    im_array, raw_heads = rc.read_frames(imfiles, inst)
 
     head = inst.head(imfiles[0])
     filt = inst.filt(nims, head, filter_name)
@@ -190,48 +276,71 @@ def create_imstack(
     if sf_dir not in fdirs:  # make a directory for each filt
         os.mkdir(sf_dir)
 
-    flatfile = reddir + f"flat_{filt}.fits"
-    if (
-        inst.name == "PHARO" and filt == "Br-gamma"
-    ):  # not sure whether this is generalizable
-        flatfile = reddir + "flat_K_short.fits"
-
-    #For ShARCS, use Ks flat instead of BrG-2.16 if necessary
-    if (inst.name == "ShARCS" and filt == "BrG-2.16"):
-        if os.path.exists(flatfile) == False:
-            flatfile = reddir + 'flat_Ks.fits'
-
-    #For ShARCS, use J flat instead of J+Ch4-1.2 if necessary
-    if (inst.name == "ShARCS" and filt == "J+Ch4-1.2"):
-        if os.path.exists(flatfile) == False:
-            flatfile = reddir + 'flat_J.fits'
-
+    flatfile = cc.flat_file(reddir, filt, inst)
     flat = open_flats(flatfile)
 
     skyfile = sf_dir + "sky.fits"
-    sky = pyfits.getdata(skyfile, 0)
-
-    #Use a 2D Gaussian Kernel to interpolate over NaNs in the sky file
-    # Generate Gaussian kernel with x_stddev=1 (and y_stddev=1)
-    # It is a 9x9 array
-    kernel = Gaussian2DKernel(x_stddev=1)
-    # Replace NaNs with interpolated values
-    sky = interpolate_replace_nans(sky, kernel)
+    sky = cc.get(skyfile)
+
+    #Use a 2D Gaussian Kernel (x_stddev=1, y_stddev=1) to interpolate
+    #over NaNs in the sky file
+    sky = ni.interpolate_nans(sky, stddev=1)
+
+    #Calibrate in the instrument's precision rather than upcasting each frame
+    flat = np.where(flat == 0, np.nan, flat).astype(im_array.dtype)
+    sky = sky.astype(im_array.dtype)
+
+    #Frames that have a sky made without them (sky.create_skies with
+    #per_frame=True) use it in place of the shared sky
+    frame_skies = [sky] * nims
+    skycube_file = sf_dir + "sky_cube.fits"
+    if os.path.exists(skycube_file):
+        with pyfits.open(skycube_file) as hdul:
+            sky_frames = list(hdul["FRAMES"].data)
+            sky_cube = ni.interpolate_nans(u.image_hdu(hdul).data, stddev=1)
+        sky_cube = sky_cube.astype(im_array.dtype)
+        for i, filenum in enumerate(imlist):
+            if filenum in sky_frames:
+                frame_skies[i] = sky_cube[sky_frames.index(filenum)]
 
     #sky[np.isnan(sky)] = 0.0  # set nans from flat=0 pixels to 0 in sky
 
+    #Once frames are coarsely centered, only the final image footprint (plus
+    #a margin for registration) needs to be kept.
+    frame_shape = im_array.shape[1:]
+    mask = bp.load_mask(reddir, frame_shape) if badpix_mask else None
+    corner = u.final_corner(frame_shape, inst.final_size, inst.final_corner)
+    if roi_margin is None:
+        roi_margin = inst.roi_margin
+    if roi_margin is None:
+        roi = (0, frame_shape[0], 0, frame_shape[1])
+    else:
+        roi = u.roi_bounds(
+            frame_shape, inst.final_size, inst.final_corner, roi_margin
+        )
+    if roi_margin is None and not write_cube:
+        shifted_array = im_array
+    else:
+        shifted_array = np.empty(
+            (nims, roi[1] - roi[0], roi[3] - roi[2]), dtype=im_array.dtype
+        )
+
     shifts_all = []
+    metrics = []
+    shifted_heads = []
     for i in range(nims):
         # flat division and sky subtraction
         current_im = im_array[i, :, :]
-        flat[flat == 0] = np.nan
         current_im = (
             current_im / flat
-        ) - sky  # where flat = 0, this will be nan
-        current_head = pyfits.getheader(imfiles[i])
+        ) - frame_skies[i]  # where flat = 0, this will be nan
+        current_head = raw_heads[i]
 
         # bad pixel correction
-        current_im = inst.bad_pix(current_im)
+        if mask is not None:
+            current_im = bp.repair(current_im, mask)
+        else:
+            current_im = inst.bad_pix(current_im)
 
         # now deal with headers and shifts
         shifted_im, shifts = reg.shift_bruteforce(
@@ -240,16 +349,46 @@ def create_imstack(
 
         shifts_all.append(shifts)
 
-        im_array[i, :, :] = shifted_im
-        hdu = pyfits.PrimaryHDU(shifted_im, header=current_head)
-        hdu.writeto(
-            sf_dir + "sh{:02d}.fits".format(i),
-            overwrite=True,
-            output_verify="ignore",
+        shifted_im = shifted_im[roi[0] : roi[1], roi[2] : roi[3]]
+        shifted_array[i, :, :] = shifted_im
+        metrics.append(qual.frame_metrics(shifted_im))
+
+        current_head.set("RAWFILE", original_fnames[i], "raw frame")
+        #record where the final image footprint sits in the saved frame
+        current_head.set("ROIROW0", roi[0], "row of saved frame in full frame")
+        current_head.set("ROICOL0", roi[2], "col of saved frame in full frame")
+        current_head.set("FINSIZE", inst.final_size, "final image size")
+        current_head.set("FINROW0", corner[0] - roi[0], "final image row")
+        current_head.set("FINCOL0", corner[1] - roi[2], "final image col")
+
+        if write_cube:
+            shifted_heads.append(current_head)
+            continue
+        wr.write_fits(
+            sf_dir + "sh{:02d}.fits".format(i), shifted_im, current_head,
+            intermediate=True,
         )
 
-    pl.plot_array(
-        "intermediate", im_array, -10.0, 10000.0, sf_dir, "shift1_cube.png",snames=original_fnames
+    #Only one layout may be present, so that create_im reads the right frames
+    if write_cube:
+        for shfile in glob(sf_dir + "sh[0-9]*.fits"):
+            os.remove(shfile)
+        wr.write_cube(sf_dir + "sh_cube.fits", shifted_array, shifted_heads)
+    elif os.path.exists(sf_dir + "sh_cube.fits"):
+        os.remove(sf_dir + "sh_cube.fits")
+
+    im_array = shifted_array
+
+    #Record the quality of each frame and whether it will be registered
+    frame_quality = qual.assess_frames(metrics, shifts_all, quality_limits)
+    frame_quality.insert(0, "im", np.arange(nims))
+    frame_quality.insert(1, "file", original_fnames)
+    frame_quality.to_csv(sf_dir + "quality.csv", index=False)
+    for jj in np.where(~frame_quality.accepted.values)[0]:
+        original_fnames[jj] = original_fnames[jj] + " (rejected)"
+
+    wr.plot(
+        pl.plot_array, "intermediate", im_array, -10.0, 10000.0, sf_dir, "shift1_cube.png",snames=original_fnames
     )
 
     # write shifts to file
@@ -261,7 +400,160 @@ def create_imstack(
     return im_array, shifts_all
 
 
-def create_im(s_dir, ssize1, plotting_yml=None, fdirs=None, method="quick_look", verbose=False):
+def register_frame(image, method, ssize1, newshifts1):
+    """Registers a single frame with the requested method.
+
+    Inputs:
+        :image: (2D array) coarsely centered frame, free of NaNs.
+        :method: (str) image registration method.
+        :ssize1: (int) initial pixel search size of box.
+        :newshifts1: (list) keeps track of sub-pixel x-y shifts.
+
+    Outputs:
+        :image_centered: (2D array) registered frame.
+        :rot: (2D array) normalized rotation residuals, or None if the method
+                doesn't compute them.
+        :newshifts1: (list) keeps track of sub-pixel x-y shifts.
+    """
+    rot = None
+    if method == "saturated":
+        image_centered, rot, newshifts1 = reg.register_saturated(
+            image, ssize1, newshifts1
+        )
+    elif method == "quick_look":
+        image[image < 0.0] = 0.0
+        image_centered = reg.register_bruteforce(image)
+        if len(image_centered) == 0:
+            logger.info("Resorting to saturated mode.")
+            image_centered, rot, newshifts1 = reg.register_saturated(
+                image, ssize1, newshifts1
+            )
+    elif method == "saturated separated":
+        rough_center = reg.find_wide_binary(image)
+        image_centered, rot, newshifts1 = reg.register_saturated(
+            image, ssize1, newshifts1, rough_center=rough_center
+        )
+    elif method == "separated":
+        rough_center = reg.find_wide_binary(image)
+        image_centered = reg.register_bruteforce(
+            image, rough_center=rough_center
+        )
+    else:  # e.g. psf, where all frames were registered beforehand
+        image_centered = image
+    return image_centered, rot, newshifts1
+
+
+def measure_shift(image, method, ssize1):
+    """Finds the registration shift of a frame without resampling it.
+
+    Inputs:
+        :image: (2D array) coarsely centered frame, free of NaNs. It may be
+                modified in place.
+        :method: (str) image registration method.
+        :ssize1: (int) initial pixel search size of box.
+
+    Outputs:
+        :shift: (tuple) (d_row, d_col) shift that registers the frame.
+        :rot: (2D array) normalized rotation residuals, or None if the method
+                doesn't compute them.
+    """
+    rot = None
+    shift = []
+    rough_center = None
+    if "separated" in method:
+        rough_center = reg.find_wide_binary(image)
+
+    if method in ["quick_look", "separated"]:
+        if method == "quick_look":
+            image[image < 0.0] = 0.0
+        shift = reg.register_bruteforce(
+            image, rough_center=rough_center, apply_shift=False
+        )
+        if len(shift) == 0 and method == "quick_look":
+            logger.info("Resorting to saturated mode.")
+
+    if method in ["saturated", "saturated separated"] or len(shift) == 0:
+        _, rot, newshifts1 = reg.register_saturated(
+            image, ssize1, [], rough_center=rough_center, apply_shift=False
+        )
+        shift = newshifts1[0]
+    return shift, rot
+
+
+def calibration_key(sf_dir):
+    """Identifies the calibrations that a star and filter's frames were
+    reduced with, by the manifest digests of its skies and of the
+    calibration products (the flat) that the sky was made from.
+
+    Inputs:
+        :sf_dir: (str) directory for the star and filter.
+
+    Outputs:
+        :key: (str) the digests, with "None" for products without one.
+    """
+    skyfile = sf_dir + "sky.fits"
+    products = [skyfile, sf_dir + "sky_cube.fits"]
+    sky_manifest = mf.load(skyfile)
+    if sky_manifest is not None:
+        products += [
+            entry["file"]
+            for entry in sky_manifest["inputs"]
+            if os.path.exists(mf.manifest_file(entry["file"]))
+        ]
+    digests = []
+    for product in products:
+        manifest = mf.load(product)
+        digests.append(str(manifest and manifest.get("digest")))
+    return ", ".join(digests)
+
+
+def register_incremental(sf_dir, indices, headers, ssize1, method):
+    """Registers only the frames that aren't already in the star and filter's
+    stack store, and drops stored frames that are no longer in the stack.
+    Previously registered frames are kept as long as the registration
+    settings and the star and filter's sky and flat (see calibration_key)
+    are unchanged.
+
+    Inputs:
+        :sf_dir: (str) directory for the star and filter.
+        :indices: (list of int) indices of the shifted frames to be combined.
+        :headers: (dict) headers of the shifted frames, keyed by index.
+        :ssize1: (int) initial pixel search size of box.
+        :method: (str) image registration method.
+
+    Outputs:
+        :store: (StackStore) store holding exactly the requested frames.
+        :keys: (list of str) identifiers of the frames, in the order of indices.
+    """
+    store = ss.StackStore(
+        sf_dir + "stack_store/", method, ssize1, calibration_key(sf_dir)
+    )
+    keys = [
+        ss.frame_key(headers[i], "sh{:02d}".format(i)) for i in indices
+    ]
+    for key in store.keys():
+        if key not in keys:
+            store.remove(key)
+
+    new = [(i, key) for i, key in zip(indices, keys) if key not in store]
+    logger.info(f"Registering {len(new)} new of {len(indices)} frames.")
+    if new:
+        new_frames = u.as_float(u.read_shifted(sf_dir, [i for i, _ in new]))
+        new_frames = ni.interpolate_nans(new_frames, stddev=1)
+        for (i, key), image in zip(new, new_frames):
+            shifts = []
+            image_centered, rot, shifts = register_frame(
+                image, method, ssize1, shifts
+            )
+            if rot is None:
+                rot = np.zeros((ssize1 * 2 + 1, ssize1 * 2 + 1))
+            shift = shifts[0] if shifts else (np.nan, np.nan)
+            store.add(key, image_centered, rot, shift)
+    store.save()
+    return store, keys
+
+
+def create_im(s_dir, ssize1, plotting_yml=None, fdirs=None, method="quick_look", verbose=False, combine="median", incremental=False, oversample=2):
     """Take the shifted, cut down images from before, then perform registration
     and combine. Tests should happen before this, as this is a per-star basis.
 
@@ -271,7 +563,24 @@ def create_im(s_dir, ssize1, plotting_yml=None, fdirs=None, method="quick_look",
         :plotting_yml: (str) path to the plotting configuration file.
         :fdirs: (list of str) file directories.
         :method: (str) image registration method.
+        :combine: (str) how registered frames are combined: "median" or "mean",
+                both of which ignore NaNs, or "drizzle". With "drizzle", frames
+                aren't resampled; each frame's pixels are added at their
+                sub-pixel offsets onto a grid oversampled by oversample.
+        :incremental: (bool) if True, registered frames are kept in a stack
+                store for each star and filter, and only frames that aren't
+                in it yet are registered. With combine="mean", the update
+                only touches the new frames.
+        :oversample: (int) output pixels per input pixel, per axis, for
+                combine="drizzle".
     """
+    if combine not in ["median", "mean", "drizzle"]:
+        raise ValueError("combine must be 'median', 'mean' or 'drizzle'.")
+    if combine == "drizzle" and (incremental or method == "psf"):
+        raise ValueError(
+            "The drizzle combine can't be used incrementally or with psf."
+        )
+
     if plotting_yml:
         pl.initialize_plotting(plotting_yml)
 
@@ -287,93 +596,111 @@ def create_im(s_dir, ssize1, plotting_yml=None, fdirs=None, method="quick_look",
 
         logger.debug('working on sf_dir ', sf_dir)
 
-        files = glob(
-            sf_dir + f"sh*.fits"
-        )  # might need to change to file_prefix
-        nims = len(files)
-
-        frames = u.read_imcube(files)
-        frames = frames.astype(float)
-
-        arrsize1 = ssize1 * 2 + 1
-        rots = np.zeros((nims, arrsize1, arrsize1))
-        newshifts1 = []
+        #shifted frames are either sh##.fits files or a single sh_cube.fits
+        headers = u.read_shifted_headers(sf_dir)
+        indices = sorted(headers)
+
+        #Skip frames rejected by the quality checks in create_imstack
+        quality_file = sf_dir + "quality.csv"
+        if os.path.exists(quality_file):
+            accepted = qual.accepted_frames(quality_file)
+            indices = [i for i in indices if i in accepted]
+        if len(indices) == 0:
+            logger.error(f"No frames left to combine in {sf_dir}; skipping.")
+            continue
+        nims = len(indices)
 
-        # if we're doing PSF-fitting, we do it across all the images at once
-        if method == 'psf':
-            frames = reg.register_psf_fit(frames)
+        if combine == "drizzle":
+            frames = u.as_float(u.read_shifted(sf_dir, indices))
 
-        for i in range(nims):  # each image
-            image = frames[i, :, :]
+            arrsize1 = ssize1 * 2 + 1
+            rots = np.zeros((nims, arrsize1, arrsize1))
+            newshifts1 = []
 
-            #Interpolate over NaNs so that scipy can shift images
-            #without producing arrays that are completely NaN
-            #Following this tutorial: https://docs.astropy.org/en/stable/convolution/index.html
+            #Shifts are measured on NaN-filled copies; the frames themselves
+            #are added as they are, with NaN pixels left out.
+            filled = ni.interpolate_nans(frames, stddev=1)
+            for i in range(nims):
+                shift, rot = measure_shift(filled[i, :, :], method, ssize1)
+                if rot is not None:
+                    rots[i, :, :] = rot
+                newshifts1.append(shift)
+            del filled
+        elif incremental and method != "psf":
+            store, keys = register_incremental(
+                sf_dir, indices, headers, ssize1, method
+            )
+            frames, rots = store.frames(keys)
+            newshifts1 = store.shifts(keys)
+        else:
+            #frames are kept in the precision create_imstack wrote them in
+            frames = u.as_float(u.read_shifted(sf_dir, indices))
 
-            # Generate Gaussian kernel with x_stddev=1 (and y_stddev=1)
-            # It is a 9x9 array
-            kernel = Gaussian2DKernel(x_stddev=1)
+            arrsize1 = ssize1 * 2 + 1
+            rots = np.zeros((nims, arrsize1, arrsize1))
+            newshifts1 = []
 
-            # Replace NaNs with interpolated values
-            image = interpolate_replace_nans(image, kernel)
+            # if we're doing PSF-fitting, we do it across all the images at once
+            if method == 'psf':
+                frames = reg.register_psf_fit(frames)
 
-            if method == "saturated":
-                image_centered, rot, newshifts1 = reg.register_saturated(
-                    image, ssize1, newshifts1
+            #Interpolate over NaNs so that scipy can shift images
+            #without producing arrays that are completely NaN.
+            #All frames are filled at once with a 2D Gaussian kernel
+            #(x_stddev=1, y_stddev=1), as in astropy's interpolate_replace_nans.
+            frames = ni.interpolate_nans(frames, stddev=1)
+
+            for i in range(nims):  # each image
+                image_centered, rot, newshifts1 = register_frame(
+                    frames[i, :, :], method, ssize1, newshifts1
                 )
-                rots[i, :, :] = rot
-            elif method == "quick_look":
-                image[image < 0.0] = 0.0
-                image_centered = reg.register_bruteforce(image)
-                if len(image_centered) == 0:
-                    logger.info("Resorting to saturated mode.")
-                    image_centered, rot, newshifts1 = reg.register_saturated(
-                        image, ssize1, newshifts1
-                    )
+                if rot is not None:
                     rots[i, :, :] = rot
-            elif method == "saturated separated":
-                rough_center = reg.find_wide_binary(image)
-                image_centered, rot, newshifts1 = reg.register_saturated(
-                    image, ssize1, newshifts1, rough_center=rough_center
-                )
-                rots[i, :, :] = rot
-            elif method == "separated":
-                rough_center = reg.find_wide_binary(image)
-                image_centered = reg.register_bruteforce(
-                    image, rough_center=rough_center
-                )
-            frames[i, :, :] = image_centered  # newimage
-
-        final_im = np.nanmedian(frames, axis=0)
-        #Trim down to smaller final size
-        final_im = final_im[100:700,100:700] #extract central 600x600 pixel region
+                frames[i, :, :] = image_centered  # newimage
 
-        #Trim down to smaller final size
-        cutsize = 600 #desired axis length of final cutout image
-        astart = int(round((final_im.shape[0]-cutsize)/2.))
-        bstart = int(round((final_im.shape[1]-cutsize)/2.))
+        if combine == "drizzle":
+            final_im, _ = dz.shift_and_add(
+                frames, newshifts1, oversample=oversample
+            )
+        elif combine == "mean" and incremental and method != "psf":
+            final_im = store.mean()
+        elif combine == "mean":
+            final_im = np.nanmean(frames, axis=0, dtype=np.float64)
+        else:
+            final_im = comb.nanmedian(frames)
+
+        #Trim down to the final image footprint recorded by create_imstack.
+        #Older stacks have no record; they used rows/cols 100:700.
+        head = headers[indices[0]]
+        scale = oversample if combine == "drizzle" else 1
+        cutsize = head.get("FINSIZE", 600) * scale #desired axis length of final cutout image
+        astart = head.get("FINROW0", 100) * scale
+        bstart = head.get("FINCOL0", 100) * scale
         aend = astart+cutsize
         bend = bstart+cutsize
-        if np.logical_or(aend > final_im.shape[0],bend > final_im.shape[1]):
+        if (
+            min(astart, bstart) < 0
+            or aend > final_im.shape[0]
+            or bend > final_im.shape[1]
+        ):
 
             logger.error('ERROR: Requested cutout is too large. Using full image instead.')
-            logger.info('Current image dimensions: ', final_im.shape)
-            logger.info('Desired cuts: ', astart, aend, bstart, bend)
+            logger.info('Current image dimensions: %s', final_im.shape)
+            logger.info('Desired cuts: %s %s %s %s', astart, aend, bstart, bend)
         else:
-            final_im = final_im[astart:astart+cutsize,bstart:bstart+cutsize] #extract central cutsize x cutsize pixel region from larger image
+            final_im = final_im[astart:aend,bstart:bend] #extract cutsize x cutsize pixel region from larger image
 
-        head = pyfits.getheader(files[0])
-        hdu = pyfits.PrimaryHDU(final_im, header=head)
-        hdu.writeto(
-            sf_dir + "final_im.fits", overwrite=True, output_verify="ignore"
-        )
+        if combine == "drizzle":
+            head.set("OVERSAMP", oversample, "output pixels per input pixel")
+        wr.write_fits(sf_dir + "final_im.fits", final_im, head)
 
         textfile1 = open(sf_dir + "shifts2.txt", "w")
         textfile1.write("im, d_row, d_col\n")
         for i, item in enumerate(newshifts1):
             textfile1.write("{},{},{}\n".format(i, *item))
         textfile1.close()
-        pl.plot_array(
+        wr.plot(
+            pl.plot_array,
             "rots",
             rots,
             0.0,
@@ -383,11 +710,14 @@ def create_im(s_dir, ssize1, plotting_yml=None, fdirs=None, method="quick_look",
             extent=[-ssize1, ssize1, -ssize1, ssize1],
         )
 
-        final_vmin, final_vmax = np.percentile(final_im, [1,99])
-        pl.plot_array(
-            "final_im", final_im, final_vmin, final_vmax, sf_dir, "final_image.png"
+        final_vmin, final_vmax = np.nanpercentile(final_im, [1,99])
+        wr.plot(
+            pl.plot_array, "final_im", final_im, final_vmin, final_vmax, sf_dir, "final_image.png"
         )
+        if combine == "drizzle":
+            continue  # frames were never shifted, so there are no centers to show
         frames_vmin, frames_vmax = np.percentile(frames, [1,99])
-        pl.plot_array(
-            "intermediate", frames, frames_vmin, frames_vmax, sf_dir, "centers.png"
+        wr.plot(
+            pl.plot_array, "intermediate", frames, frames_vmin, frames_vmax, sf_dir, "centers.png"
         )
+    wr.flush()
@@ -2,15 +2,19 @@
 Module for instrument class and subclasses.
 """
 
-import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import astropy.io.fits as pyfits
 import numpy as np
 from scipy.ndimage.filters import median_filter
 
+from . import calib_cache as cc
 from . import utils as u
 
+# floating point types that frames can be reduced in
+precisions = {"double": np.float64, "single": np.float32}
+
 
 class Instrument:
     """
@@ -23,8 +27,67 @@ class Instrument:
         10  # Size of rot search; needs to be bigger if initial shifts are off.
     )
 
-    def __init__(self, take_skies=False):
+    final_size = 600  # side length of the final image, in pixels
+    # row, col of the final image's corner in a coarsely centered frame.
+    # None centers the final image on the star.
+    final_corner = (100, 100)
+
+    def __init__(self, take_skies=False, roi_margin=None, precision="double"):
+        """
+        Inputs:
+            :take_skies: (bool) whether separate sky frames were taken.
+            :roi_margin: (int) if set, frames are cropped to the final image
+                    footprint plus this many pixels on every side as soon as
+                    they are coarsely centered. If None, frames are
+                    registered at full size. It can also be set for a
+                    single reduction with all_driver or image_driver.
+                    With the default off-center final_corner the crop
+                    saves little; see utils.roi_bounds.
+            :precision: (str) "double" or "single". Frame cubes and the
+                    products written from them are kept in this precision;
+                    sums and means are still accumulated in double precision.
+                    "single" halves the memory used by each cube.
+        """
+        if precision not in precisions:
+            raise ValueError(
+                f"precision must be one of {list(precisions)}."
+            )
         self.take_skies = take_skies
+        self.roi_margin = roi_margin
+        self.precision = precision
+        self.dtype = precisions[precision]
+
+    def raw_section(self):
+        """Part of each raw frame that adjust_array keeps, so that readers
+        can skip the rest.
+
+        Outputs:
+            :section: (tuple) row and column slices of the raw frame.
+        """
+        return (slice(None), slice(None))
+
+    def raw_frame(self, hdu, section):
+        """Reads part of the frame in a raw FITS file.
+
+        Inputs:
+            :hdu: (astropy.io.fits HDU) HDU holding the image of an open raw
+                    file (see utils.image_hdu).
+            :section: (tuple) row and column slices to read, from raw_section.
+
+        Outputs:
+            :frame: (2D array) that part of the frame, reading no more of
+                    the file than it needs.
+        """
+        return hdu.section[section]
+
+    def static_bad_pixels(self):
+        """Known bad pixels of the detector, independent of the night.
+
+        Outputs:
+            :mask: (2D boolean array) True for bad pixels, or None if the
+                    instrument has no list of them.
+        """
+        return None
 
     def bad_pix(self, image):
         """Read in bad pixel file, cut down to size, and replace NaN
@@ -83,12 +146,16 @@ class ShARCS(Instrument):
             [
                 u.image_subsection(array[dd, :, :], self.npix, self.center)
                 for dd in range(nims)
-            ]
+            ],
+            dtype=self.dtype,
         )
 
     def adjust_im(self, image):
         return np.fliplr(image)
 
+    def raw_section(self):
+        return u.subsection_slices(self.npix, self.center)
+
     def head(self, file):
         """
         Given a FITS file, returns its head.
@@ -139,6 +206,21 @@ class ShARCS(Instrument):
         itime_val = head["ITIME0"] * 1e-6
         return itime_val
 
+    def static_bad_pixels(self):
+        """Read in bad pixel file and cut it down to size.
+
+        Outputs:
+            :mask: (2D boolean array) True for bad pixels.
+        """
+        script_dir = os.path.dirname(
+            __file__
+        )  # <-- absolute dir the script is in
+        rel_path = "badpix.fits"
+        bpfile_name = os.path.join(script_dir, rel_path)
+        bpfile = cc.get(bpfile_name)
+        bpfile = u.image_subsection(bpfile, self.npix, self.center)
+        return bpfile == 1
+
     def bad_pix(self, image):
         """Read in bad pixel file, cut down to size, replace bad
         pixels with median of surrounding pixels.
@@ -150,16 +232,8 @@ class ShARCS(Instrument):
             :iamge: (2D numpy array) image, now filtered for bad pixels.
                     Same dimensions as input image.
         """
-        script_dir = os.path.dirname(
-            __file__
-        )  # <-- absolute dir the script is in
-        rel_path = "badpix.fits"
-        bpfile_name = os.path.join(script_dir, rel_path)
-        bpfile = pyfits.getdata(bpfile_name, 0)
-        bpfile = u.image_subsection(bpfile, self.npix, self.center)
-
         bad = np.where(np.logical_or(
-            bpfile == 1, # locations of bad pixels
+            self.static_bad_pixels(), # locations of bad pixels
             np.isnan(image)==1) # where pixels are NaN
         )
 
@@ -210,12 +284,67 @@ class PHARO(Instrument):
     file_prefix = "sph"
     plim = (462, 562)
     off = (-462, -462)
+    # where each plane of a raw 4-quadrant cube goes in the full frame
+    quadrants = [
+        (slice(0, 512), slice(512, 1024)),  # Lower right
+        (slice(0, 512), slice(0, 512)),  # Lower left
+        (slice(512, 1024), slice(0, 512)),  # Upper left
+        (slice(512, 1024), slice(512, 1024)),  # Upper right
+    ]
+
+    def __init__(
+        self,
+        take_skies=False,
+        roi_margin=None,
+        precision="double",
+        raw_quadrants=False,
+    ):
+        """
+        Inputs:
+            :take_skies: (bool) whether separate sky frames were taken.
+            :roi_margin: (int) see Instrument.
+            :precision: (str) "double" or "single". See Instrument.
+            :raw_quadrants: (bool) if True, frames are read straight from the
+                    raw 4-quadrant cubes (ph####.fits), and assembled as they
+                    are read, so read_data doesn't need to be run first.
+        """
+        super().__init__(
+            take_skies=take_skies, roi_margin=roi_margin, precision=precision
+        )
+        self.raw_quadrants = raw_quadrants
+        if raw_quadrants:
+            self.file_prefix = "ph"
+
+    def assemble(self, quadrant):
+        """
+        Assembles a full frame from the four quadrants of a raw cube.
+
+        Inputs:
+            :quadrant: (function) returns plane q of the raw cube; e.g. a
+                    cube's __getitem__, or an HDU section's, which reads only
+                    that plane from disk.
+
+        Outputs:
+            :frame: (2D array) the 1024 x 1024 frame.
+        """
+        frame = np.zeros((1024, 1024), dtype=self.dtype)
+        for q, (rows, cols) in enumerate(self.quadrants):
+            frame[rows, cols] = quadrant(q)
+        return frame
+
+    def raw_frame(self, hdu, section):
+        """Reads part of the frame in a PHARO file, assembling it from its
+        quadrants if the file is a raw 4-quadrant cube.
+        """
+        if hdu.shape == (4, 512, 512):
+            return self.assemble(hdu.section.__getitem__)[section]
+        return hdu.section[section]
 
     def adjust_im(self, image):
         return image
 
     def adjust_array(self, array, nims):
-        return array.astype(float)
+        return array.astype(self.dtype)
 
     def filt(self, nims, head, filter_name):
         """
@@ -243,7 +372,7 @@ class PHARO(Instrument):
             :file: (str) path to FITS file of interest.
 
         """
-        return pyfits.getheader(file)
+        return u.read_header(file)
 
     def itime(self, head):
         """
@@ -262,18 +391,21 @@ class PHARO(Instrument):
         return itime_val
 
     def adjust_thisimage(self, thisimage):
-        thisimage = thisimage.astype(float)
+        thisimage = thisimage.astype(self.dtype)
         return thisimage
 
-    def read_data(self, raw_dir, new_dir):
+    def read_data(self, raw_dir, new_dir, max_workers=None):
         """
-        Reads data.
+        Reads data. Not needed if the instrument is made with
+        raw_quadrants=True, which assembles frames as they are read.
 
         Inputs:
             :rawdir: (string) absolute path to directory containing raw data.
                         File path should end with '/'.
             :newdir: (string) absolute path to directory that will contain
                         4-quadrant data. File path should end with '/'.
+            :max_workers: (int) number of files converted at the same time.
+                        None uses the default of ThreadPoolExecutor.
 
         Outputs:
             None
@@ -288,13 +420,11 @@ class PHARO(Instrument):
                 :new_file_name: (string) name of flattened 4-quadrant data.
             """
             im_cube = pyfits.getdata(raw_file_name)
-            header = pyfits.getheader(raw_file_name)
+            header = u.read_header(raw_file_name)
 
             newfile = np.zeros((1024, 1024))
-            newfile[0:512, 512:1024] = im_cube[0, :, :]  # Lower right
-            newfile[0:512, 0:512] = im_cube[1, :, :]  # Lower left
-            newfile[512:1024, 0:512] = im_cube[2, :, :]  # Upper left
-            newfile[512:1024, 512:1024] = im_cube[3, :, :]  # Upper right
+            for q, (rows, cols) in enumerate(self.quadrants):
+                newfile[rows, cols] = im_cube[q, :, :]
 
             hdu = pyfits.PrimaryHDU(newfile, header=header)
             hdu.writeto(new_file_name, overwrite=True, output_verify="ignore")
@@ -305,15 +435,18 @@ class PHARO(Instrument):
             """
             Convert the cubes to flat files for a whole night.
             """
-            flist = glob.glob(raw_dir + "*.fits")
+            flist = u.find_fits(raw_dir + "*")
 
             if not os.path.isdir(new_dir):
                 os.mkdir(new_dir)
 
-            for fpath in flist:
-                fname = fpath.split("/")[-1]
-                newfname = new_dir + "s" + fname
-
-                read_pharo(fpath, newfname)
+            #converted files are written uncompressed
+            newflist = [
+                new_dir + "s" + fpath.split("/")[-1].split(".fits")[0] + ".fits"
+                for fpath in flist
+            ]
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                # list() re-raises any conversion error here
+                list(pool.map(read_pharo, flist, newflist))
 
         convert_night()
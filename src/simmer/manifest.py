@@ -0,0 +1,148 @@
+"""
+Module for recording what each calibration product (master dark, flat or
+sky) was built from. Each product gets a JSON manifest next to it listing
+its input files with their sizes and modification times, the instrument
+settings and the SImMER version, along with a digest of all of these. A
+product whose manifest still matches its inputs doesn't need rebuilding.
+"""
+
+import hashlib
+import json
+import os
+from importlib.metadata import PackageNotFoundError, version
+
+import logging
+logger = logging.getLogger('simmer')
+
+
+def code_version():
+    """
+    Returns the installed SImMER version, or "unknown" when running from a
+    source tree that isn't installed.
+    """
+    try:
+        return version("simmer")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def manifest_file(product):
+    """
+    Returns the path of the manifest for a product file.
+
+    Inputs:
+        :product: (str) path to a calibration product, e.g. dark_10sec.fits.
+    """
+    return product + ".manifest.json"
+
+
+def file_state(files):
+    """
+    Describes input files by size and modification time. Files that don't
+    exist are recorded with a size and mtime of None, so that they make any
+    product depending on them stale once they appear.
+
+    Inputs:
+        :files: (list of str) paths to input files, including upstream
+                calibration products.
+
+    Outputs:
+        :state: (list of dicts) file, size and mtime_ns of each file.
+    """
+    state = []
+    for file in files:
+        try:
+            stat = os.stat(file)
+            size, mtime = stat.st_size, stat.st_mtime_ns
+        except FileNotFoundError:
+            size, mtime = None, None
+        state.append(
+            {"file": os.path.abspath(file), "size": size, "mtime_ns": mtime}
+        )
+    return state
+
+
+def build_manifest(product, inputs, inst):
+    """
+    Describes everything a calibration product depends on.
+
+    Inputs:
+        :product: (str) path to the calibration product.
+        :inputs: (list of str) paths to every file the product is made from.
+        :inst: (Instrument object) instrument for which data is being reduced.
+
+    Outputs:
+        :manifest: (dict) the product's dependencies and their digest.
+    """
+    manifest = {
+        "product": os.path.abspath(product),
+        "inputs": file_state(inputs),
+        "instrument": inst.name,
+        "precision": getattr(inst, "precision", "double"),
+        "version": code_version(),
+    }
+    manifest["digest"] = hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode()
+    ).hexdigest()
+    return manifest
+
+
+def is_current(product, inputs, inst):
+    """
+    Checks whether a calibration product can be reused as it is.
+
+    Inputs:
+        :product: (str) path to the calibration product.
+        :inputs: (list of str) paths to every file the product is made from.
+        :inst: (Instrument object) instrument for which data is being reduced.
+
+    Outputs:
+        :current: (bool) True if the product exists and its manifest matches
+                the current state of its inputs.
+    """
+    if not os.path.exists(product) or not os.path.exists(
+        manifest_file(product)
+    ):
+        return False
+    try:
+        with open(manifest_file(product)) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        return False
+    current = build_manifest(product, inputs, inst)
+    if recorded.get("digest") != current["digest"]:
+        logger.debug(f"{product} is out of date with its inputs.")
+        return False
+    return True
+
+
+def load(product):
+    """
+    Reads the manifest of a product.
+
+    Inputs:
+        :product: (str) path to the calibration product.
+
+    Outputs:
+        :manifest: (dict) the recorded manifest, or None if there is none or
+                it can't be read.
+    """
+    try:
+        with open(manifest_file(product)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def record(product, inputs, inst):
+    """
+    Writes the manifest of a freshly built calibration product.
+
+    Inputs:
+        :product: (str) path to the calibration product.
+        :inputs: (list of str) paths to every file the product is made from.
+        :inst: (Instrument object) instrument for which data is being reduced.
+    """
+    manifest = build_manifest(product, inputs, inst)
+    with open(manifest_file(product), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
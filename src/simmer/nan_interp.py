@@ -0,0 +1,79 @@
+"""
+Module for replacing NaN pixels with a Gaussian-weighted average of their
+neighbors. This reproduces astropy's ``interpolate_replace_nans`` with a
+``Gaussian2DKernel``, but works on whole image cubes at once and uses the
+separability of the Gaussian to keep the convolution cheap.
+"""
+
+import numpy as np
+from astropy.convolution import Gaussian1DKernel
+from scipy.ndimage import correlate1d
+
+from . import utils as u
+
+
+def gaussian_kernel_1d(stddev=1):
+    """
+    Returns the normalized 1D Gaussian kernel whose outer product with itself
+    is astropy's ``Gaussian2DKernel(x_stddev=stddev)``.
+
+    Inputs:
+        :stddev: (float) standard deviation of the Gaussian, in pixels.
+
+    Outputs:
+        :kernel: (1D array) normalized kernel weights.
+    """
+    kernel = Gaussian1DKernel(stddev).array
+    return kernel / np.sum(kernel)
+
+
+def interpolate_nans(im_array, stddev=1):
+    """
+    Replaces NaN pixels in an image or a cube of images by normalized
+    convolution with a Gaussian kernel. Finite pixels are left untouched,
+    and NaNs with no finite neighbors within the kernel stay NaN, as in
+    astropy's ``interpolate_replace_nans``.
+
+    Inputs:
+        :im_array: (2D or 3D array) image, or cube of images with shape
+                    (nims, xpix, ypix).
+        :stddev: (float) standard deviation of the Gaussian kernel, in pixels.
+
+    Outputs:
+        :filled: (2D or 3D array) copy of im_array with NaNs interpolated over,
+                    in single precision if im_array is, else double.
+    """
+    filled = u.as_float(im_array)
+    nan_mask = np.isnan(filled)
+    if not np.any(nan_mask):
+        return filled
+
+    if filled.ndim == 3:
+        # only convolve the frames that actually contain NaNs
+        to_fill = np.where(np.any(nan_mask, axis=(1, 2)))[0]
+        filled[to_fill] = _fill_frames(
+            filled[to_fill], nan_mask[to_fill], stddev
+        )
+    else:
+        filled = _fill_frames(filled[None], nan_mask[None], stddev)[0]
+    return filled
+
+
+def _fill_frames(frames, nan_mask, stddev):
+    """
+    Fills the NaN pixels of a 3D cube, convolving along the two image axes.
+    Pixels beyond the frame edge count as zero-valued data, matching
+    astropy's default ``boundary='fill'`` behavior.
+    """
+    kernel = gaussian_kernel_1d(stddev)
+    data = np.where(nan_mask, 0.0, frames)
+    weights = (~nan_mask).astype(frames.dtype)
+    for axis in (1, 2):
+        data = correlate1d(data, kernel, axis=axis, mode="constant", cval=0.0)
+        weights = correlate1d(
+            weights, kernel, axis=axis, mode="constant", cval=1.0
+        )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frames[nan_mask] = data[nan_mask] / weights[nan_mask]
+    return frames
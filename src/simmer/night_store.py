@@ -0,0 +1,313 @@
+"""
+Module for packing a night's raw frames into a single binary store, for
+nights that are reduced many times over. pack_night reads every raw frame
+once, cut down by the instrument as utils.read_frames would return it, into
+one memory-mapped array, with the frames' headers and the size and
+modification time of their files alongside. Once a pack is in use, every
+read of raw frames through utils.read_frames, and of their headers through
+utils.read_header (and so inst.head), is served from it, without opening
+any FITS file, as long as the files haven't changed since they were packed
+and, for frames, the instrument settings match. A pack is put in use for a
+whole session with use, or for one driver with its pack argument.
+"""
+
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import astropy.io.fits as pyfits
+
+import logging
+logger = logging.getLogger('simmer')
+
+chunk_size = 32
+
+_packs = {}
+
+
+def _settings(inst):
+    """
+    Describes the instrument settings that the packed frames depend on.
+    """
+    return ", ".join(
+        [
+            inst.name,
+            inst.file_prefix,
+            str(getattr(inst, "npix", None)),
+            str(getattr(inst, "center", None)),
+            np.dtype(inst.dtype).str,
+        ]
+    )
+
+
+class NightPack:
+    """
+    Raw frames of a night, as cut down by an instrument, stored in one
+    array file that is memory-mapped when the pack is opened.
+
+    A pack directory holds frames.npy, with one plane per raw file,
+    index.csv, with the name, size and modification time of each file, and
+    headers.npz, with each file's header as text and the settings the
+    frames were packed with.
+    """
+
+    def __init__(self, pack_dir):
+        """
+        Inputs:
+            :pack_dir: (str) directory written by pack_night.
+        """
+        self.pack_dir = pack_dir
+        self.index = pd.read_csv(pack_dir + "index.csv", dtype={"file": str})
+        meta = np.load(pack_dir + "headers.npz")
+        self.raw_dir = str(meta["raw_dir"])
+        self.settings = str(meta["settings"])
+        self.headers = meta["headers"]
+        self.frames = np.load(pack_dir + "frames.npy", mmap_mode="r")
+        self.planes = {file: k for k, file in enumerate(self.index.file)}
+        self.states = list(zip(self.index["size"], self.index["mtime_ns"]))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _plane(self, filename):
+        """
+        Returns the plane of a raw file, or None if it isn't packed or has
+        changed since it was packed.
+        """
+        if os.path.dirname(os.path.abspath(filename)) != self.raw_dir:
+            return None
+        plane = self.planes.get(os.path.basename(filename))
+        if plane is None:
+            return None
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != self.states[plane]:
+            return None
+        return plane
+
+    def frame(self, filename):
+        """
+        Returns one packed frame without copying it.
+
+        Inputs:
+            :filename: (str) path to the raw file.
+
+        Outputs:
+            :frame: (2D array) read-only view of the frame in the pack.
+        """
+        plane = self._plane(filename)
+        if plane is None:
+            raise KeyError(f"{filename} isn't in the pack, or has changed.")
+        return self.frames[plane]
+
+    def header(self, filename):
+        """
+        Returns the packed header of a raw file.
+
+        Inputs:
+            :filename: (str) path to the raw file.
+
+        Outputs:
+            :head: (astropy.io.fits Header) its header.
+        """
+        plane = self._plane(filename)
+        if plane is None:
+            raise KeyError(f"{filename} isn't in the pack, or has changed.")
+        return pyfits.Header.fromstring(str(self.headers[plane]))
+
+    def read_frames(self, filelist, inst):
+        """
+        Reads raw frames from the pack, as utils.read_frames would read them
+        from their files.
+
+        Inputs:
+            :filelist: (list) paths to raw FITS frames.
+            :inst: (Instrument object) instrument for which data is being
+                    reduced.
+
+        Outputs:
+            :im_array: (3D array) copy of the frames, or None if the
+                    instrument settings differ or any file isn't packed or
+                    has changed.
+            :headers: (list) header of each frame.
+        """
+        if _settings(inst) != self.settings:
+            return None
+        planes = [self._plane(filename) for filename in filelist]
+        if any(plane is None for plane in planes):
+            return None
+        headers = [
+            pyfits.Header.fromstring(str(self.headers[plane]))
+            for plane in planes
+        ]
+        return np.array(self.frames[planes]), headers
+
+
+def pack_night(raw_dir, pack_dir, inst, max_workers=None):
+    """
+    Packs every raw frame of a night into a NightPack. Frames whose cut
+    down shape differs from the first frame's are left out, and are read
+    from their files as usual.
+
+    Inputs:
+        :raw_dir: (str) path of the directory containing the raw data.
+        :pack_dir: (str) directory to write the pack to; created if needed.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :max_workers: (int) number of reading threads. None uses the default
+                of concurrent.futures.ThreadPoolExecutor.
+
+    Outputs:
+        :pack: (NightPack) the new pack.
+    """
+    # utils reads frames through this module, so it is imported here
+    from . import utils as u
+
+    files = sorted(u.find_fits(raw_dir + inst.file_prefix + "*"))
+    if len(files) == 0:
+        raise ValueError(f"No raw frames to pack in {raw_dir}.")
+    os.makedirs(pack_dir, exist_ok=True)
+
+    # frames aren't read from a pack that is being rewritten
+    release(pack_dir)
+    frames = None
+    packed, headers = [], []
+    for start in range(0, len(files), chunk_size):
+        chunk = files[start : start + chunk_size]
+        try:
+            cubes = [u.read_frames(chunk, inst, max_workers=max_workers)]
+            names = [chunk]
+        except ValueError:
+            cubes, names = [], []
+            for filename in chunk:
+                cubes.append(u.read_frames([filename], inst))
+                names.append([filename])
+        for (cube, heads), chunk_files in zip(cubes, names):
+            if frames is None:
+                frames = np.lib.format.open_memmap(
+                    pack_dir + "frames.npy",
+                    mode="w+",
+                    dtype=cube.dtype,
+                    shape=(len(files),) + cube.shape[1:],
+                )
+            if cube.shape[1:] != frames.shape[1:]:
+                logger.warning(
+                    f"Not packing {chunk_files}: their frames are "
+                    f"{cube.shape[1:]} rather than {frames.shape[1:]}."
+                )
+                continue
+            frames[len(packed) : len(packed) + len(cube)] = cube
+            packed += chunk_files
+            headers += [head.tostring() for head in heads]
+    frames.flush()
+    del frames
+    if len(packed) < len(files):
+        # drop the planes left unused at the end
+        trimmed = np.load(pack_dir + "frames.npy", mmap_mode="r")[: len(packed)]
+        np.save(pack_dir + "frames.tmp.npy", trimmed)
+        del trimmed
+        os.replace(pack_dir + "frames.tmp.npy", pack_dir + "frames.npy")
+
+    rows = []
+    for filename in packed:
+        stat = os.stat(filename)
+        rows.append([os.path.basename(filename), stat.st_size, stat.st_mtime_ns])
+    pd.DataFrame(rows, columns=["file", "size", "mtime_ns"]).to_csv(
+        pack_dir + "index.csv", index=False
+    )
+    np.savez(
+        pack_dir + "headers.npz",
+        headers=np.array(headers),
+        raw_dir=os.path.abspath(raw_dir),
+        settings=_settings(inst),
+    )
+    logger.info(f"Packed {len(packed)} frames from {raw_dir} into {pack_dir}.")
+    return NightPack(pack_dir)
+
+
+def use(pack_dir):
+    """
+    Serves raw frames from a pack until it is released.
+
+    Inputs:
+        :pack_dir: (str) directory written by pack_night.
+    """
+    _packs[pack_dir] = NightPack(pack_dir)
+
+
+def release(pack_dir=None):
+    """
+    Stops serving raw frames from a pack.
+
+    Inputs:
+        :pack_dir: (str) pack to release. None releases every pack.
+    """
+    if pack_dir is None:
+        _packs.clear()
+    else:
+        _packs.pop(pack_dir, None)
+
+
+@contextmanager
+def using(pack_dir):
+    """
+    Serves raw frames from a pack within a with block, as the drivers do
+    with their pack argument. A pack that was already in use stays in use.
+
+    Inputs:
+        :pack_dir: (str) directory written by pack_night. None does nothing.
+    """
+    if pack_dir is None or pack_dir in _packs:
+        yield
+        return
+    use(pack_dir)
+    try:
+        yield
+    finally:
+        release(pack_dir)
+
+
+def active():
+    """
+    Returns the directories of the packs in use.
+    """
+    return list(_packs)
+
+
+def read_frames(filelist, inst):
+    """
+    Reads raw frames from the first pack in use that holds all of them.
+
+    Inputs:
+        :filelist: (list) paths to raw FITS frames.
+        :inst: (Instrument object) instrument for which data is being reduced.
+
+    Outputs:
+        :frames: (tuple) the cube and headers, as from utils.read_frames, or
+                None if no pack holds all of the frames.
+    """
+    for pack in list(_packs.values()):
+        frames = pack.read_frames(filelist, inst)
+        if frames is not None:
+            return frames
+    return None
+
+
+def header(filename):
+    """
+    Reads the header of a raw file from the first pack in use that holds it.
+
+    Inputs:
+        :filename: (str) path to the raw file.
+
+    Outputs:
+        :head: (astropy.io.fits Header) its header, or None if no pack holds
+                the file unchanged.
+    """
+    for pack in list(_packs.values()):
+        plane = pack._plane(filename)
+        if plane is not None:
+            return pyfits.Header.fromstring(str(pack.headers[plane]))
+    return None
@@ -0,0 +1,109 @@
+"""
+Module for running independent pieces of a reduction at the same time.
+Tasks are run in worker processes, each started fresh ("spawn"), so that
+matplotlib and numba's thread pools are never shared across a fork.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import logging
+logger = logging.getLogger('simmer')
+
+
+def _init_worker(plotting_yml, numba_threads):
+    """
+    Sets up a worker process: plotting configuration, and a cap on numba's
+    threads so that the workers don't oversubscribe the cores between them.
+    """
+    import numba
+
+    from . import plotting as pl
+
+    numba.set_num_threads(min(numba_threads, numba.config.NUMBA_NUM_THREADS))
+    if plotting_yml:
+        pl.initialize_plotting(plotting_yml)
+
+
+def _check_graph(tasks):
+    """
+    Returns the task names in an order that puts every task after its
+    dependencies, keeping the given order otherwise. Raises a ValueError on
+    unknown dependencies or cycles.
+    """
+    for name, (_, _, deps) in tasks.items():
+        unknown = set(deps) - set(tasks)
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks {unknown}.")
+
+    order = []
+    done = set()
+    remaining = list(tasks)
+    while remaining:
+        ready = [n for n in remaining if set(tasks[n][2]) <= done]
+        if not ready:
+            raise ValueError(f"Tasks {remaining} have circular dependencies.")
+        order.extend(ready)
+        done.update(ready)
+        remaining = [n for n in remaining if n not in done]
+    return order
+
+
+def run_graph(tasks, max_workers=None, plotting_yml=None):
+    """
+    Runs tasks that depend on one another, starting each one as soon as all
+    of its dependencies have finished.
+
+    Inputs:
+        :tasks: (dict) maps each task's name to a tuple of (function, args,
+                dependencies), where args is a tuple and dependencies a list
+                of task names. Functions and arguments must be picklable.
+        :max_workers: (int) number of worker processes. Defaults to the
+                number of cores; 1 runs every task in this process, in
+                dependency order.
+        :plotting_yml: (string) path to the plotting configuration file.
+
+    Outputs:
+        :results: (dict) return value of each task, by name.
+    """
+    order = _check_graph(tasks)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    results = {}
+    if max_workers == 1 or len(tasks) <= 1:
+        for name in order:
+            func, args, _ = tasks[name]
+            results[name] = func(*args)
+        return results
+
+    numba_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(plotting_yml, numba_threads),
+    )
+    running = {}
+    pending = list(order)
+    try:
+        while pending or running:
+            for name in list(pending):
+                func, args, deps = tasks[name]
+                if all(dep in results for dep in deps):
+                    running[executor.submit(func, *args)] = name
+                    pending.remove(name)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                # re-raises the task's exception, after which nothing new
+                # is started
+                results[name] = future.result()
+                logger.debug(f"Finished {name}.")
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True)
+    return results
@@ -0,0 +1,116 @@
+"""
+Module for loading the next unit of a reduction, such as the next star and
+filter, on a background thread while the current one is processed, so that
+reading and computing overlap. A Prefetcher runs one loading job at a time;
+loading functions put what they read where the stage will look for it (the
+raw frame and calibration caches, or the operating system's file cache),
+and are given a memory cap they must keep to. A failed prefetch is only
+logged: the stage then reads its data as usual, and reports the error
+itself.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger('simmer')
+
+default_max_bytes = 512 * 1024 ** 2
+
+read_size = 1024 ** 2
+
+
+class Prefetcher:
+    """
+    Runs loading jobs, one at a time, on a background thread. Used as
+
+        with Prefetcher(max_bytes) as prefetcher:
+            for k, unit in enumerate(units):
+                prefetcher.wait()  # unit was loaded during the last one
+                if k + 1 < len(units):
+                    prefetcher.start(load, units[k + 1])
+                process(unit)
+    """
+
+    def __init__(self, max_bytes=default_max_bytes):
+        """
+        Inputs:
+            :max_bytes: (int) memory that a loading job may use. 0 disables
+                    prefetching.
+        """
+        if max_bytes < 0:
+            raise ValueError("The prefetching memory cap can't be negative.")
+        self.max_bytes = int(max_bytes)
+        self._pool = None
+        if self.max_bytes > 0:
+            self._pool = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="simmer-prefetch"
+            )
+        self._future = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self, func, *args):
+        """
+        Starts loading with func(*args, max_bytes), after any job that is
+        still running.
+
+        Inputs:
+            :func: (function) loading function. Its last argument is the
+                    memory cap.
+            :args: its other arguments.
+        """
+        if self._pool is None:
+            return
+        self.wait()
+        self._future = self._pool.submit(func, *args, self.max_bytes)
+
+    def wait(self):
+        """
+        Waits for the running job, if any, to finish.
+        """
+        if self._future is None:
+            return
+        future, self._future = self._future, None
+        exc = future.exception()
+        if exc is not None:
+            logger.debug(f"Prefetching failed, so it'll be read as usual: {exc!r}")
+
+    def close(self):
+        """
+        Waits for the running job, then stops the thread.
+        """
+        self.wait()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+def read_files(files, max_bytes):
+    """
+    Reads files into the operating system's file cache, without keeping
+    them in memory, so that reading them again doesn't wait on the disk.
+    Stops once max_bytes have been read.
+
+    Inputs:
+        :files: (list of str) paths to the files.
+        :max_bytes: (int) most bytes to read.
+
+    Outputs:
+        :nbytes: (int) number of bytes read.
+    """
+    remaining = max_bytes
+    for filename in files:
+        with open(filename, "rb") as f:
+            while remaining > 0:
+                chunk = f.read(min(read_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+        if remaining <= 0:
+            logger.debug("Stopped prefetching files at the memory cap.")
+            break
+    return max_bytes - remaining
@@ -0,0 +1,146 @@
+"""
+Module for cheap per-frame quality checks, used to drop bad AO frames
+(open loop, clouds, star off the chip) before they are registered.
+"""
+
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger('simmer')
+
+# Every limit defaults to None, i.e. that metric is recorded but never
+# used to reject a frame.
+default_limits = {
+    "min_peak": None,  # minimum background-subtracted peak, in counts
+    "max_background": None,  # maximum background level, in counts
+    "max_fwhm": None,  # maximum core FWHM proxy, in pixels
+    "max_centroid_offset": None,  # max centroid-to-peak distance, in pixels
+    "max_shift_offset": None,  # max distance from the stack's median position
+}
+
+
+def frame_metrics(image, stamp_size=32):
+    """
+    Measures a coarsely centered frame: the star is expected at the center
+    of the array, as left by registration.shift_bruteforce.
+
+    Inputs:
+        :image: (2D array) calibrated, coarsely centered frame.
+        :stamp_size: (int) side of the box around the center used for the
+                star's peak, FWHM and centroid, in pixels.
+
+    Outputs:
+        :metrics: (dict) peak, background, fwhm and centroid_offset.
+    """
+    background = float(np.nanmedian(image))
+
+    cent = (int(image.shape[0] / 2), int(image.shape[1] / 2))
+    half = int(stamp_size / 2)
+    stamp = (
+        image[
+            cent[0] - half : cent[0] + half, cent[1] - half : cent[1] + half
+        ]
+        - background
+    )
+    stamp = np.where(np.isfinite(stamp), stamp, 0.0)
+    peak = float(np.max(stamp))
+
+    if peak <= 0:
+        return {
+            "peak": peak,
+            "background": background,
+            "fwhm": np.nan,
+            "centroid_offset": np.nan,
+        }
+
+    # FWHM proxy: diameter of a disk with as many pixels as are above half max
+    n_core = np.count_nonzero(stamp > peak / 2.0)
+    fwhm = 2.0 * np.sqrt(n_core / np.pi)
+
+    # a real star's light is centered on its peak; a hot pixel or a smeared,
+    # open-loop PSF pulls the flux-weighted centroid away from it
+    weights = np.clip(stamp, 0, None)
+    rows, cols = np.indices(stamp.shape)
+    centroid = (
+        np.sum(rows * weights) / np.sum(weights),
+        np.sum(cols * weights) / np.sum(weights),
+    )
+    maxpix = np.unravel_index(np.argmax(stamp), stamp.shape)
+    centroid_offset = np.hypot(
+        centroid[0] - maxpix[0], centroid[1] - maxpix[1]
+    )
+
+    return {
+        "peak": peak,
+        "background": background,
+        "fwhm": float(fwhm),
+        "centroid_offset": float(centroid_offset),
+    }
+
+
+def assess_frames(metrics, shifts, limits=None):
+    """
+    Decides which frames of a stack to keep.
+
+    Inputs:
+        :metrics: (list of dicts) output of frame_metrics for each frame.
+        :shifts: (list of tuples) coarse (drow, dcol) shift of each frame.
+        :limits: (dict) thresholds, with the keys of default_limits. Missing
+                keys or None values aren't applied.
+
+    Outputs:
+        :quality: (pandas DataFrame) one row per frame with every metric,
+                whether the frame was accepted and, if not, why.
+    """
+    checks = dict(default_limits)
+    if limits:
+        unknown = set(limits) - set(default_limits)
+        if unknown:
+            raise ValueError(f"Unknown frame quality limits: {unknown}.")
+        checks.update(limits)
+
+    quality = pd.DataFrame(metrics)
+    shifts = np.array(shifts, dtype=float).reshape(len(quality), 2)
+    median_shift = np.median(shifts, axis=0)
+    quality["shift_offset"] = np.hypot(*(shifts - median_shift).T)
+
+    comparisons = {
+        "min_peak": ("peak", np.less),
+        "max_background": ("background", np.greater),
+        "max_fwhm": ("fwhm", np.greater),
+        "max_centroid_offset": ("centroid_offset", np.greater),
+        "max_shift_offset": ("shift_offset", np.greater),
+    }
+    reasons = [[] for _ in range(len(quality))]
+    for key, (column, fails) in comparisons.items():
+        limit = checks[key]
+        if limit is None:
+            continue
+        # an unmeasurable metric (NaN) fails any limit placed on it
+        values = quality[column].values
+        failed = fails(values, limit) | np.isnan(values)
+        for i in np.where(failed)[0]:
+            reasons[i].append(key)
+
+    quality["accepted"] = [len(r) == 0 for r in reasons]
+    quality["reason"] = [";".join(r) for r in reasons]
+
+    n_rejected = np.count_nonzero(~quality.accepted.values)
+    if n_rejected:
+        logger.info(f"Rejected {n_rejected} of {len(quality)} frames.")
+    return quality
+
+
+def accepted_frames(quality_file):
+    """
+    Reads the per-frame decisions written by image.create_imstack.
+
+    Inputs:
+        :quality_file: (str) path to a quality.csv file.
+
+    Outputs:
+        :accepted: (set) indices of the frames that were kept.
+    """
+    quality = pd.read_csv(quality_file)
+    return set(quality.im[quality.accepted.astype(bool)].values)
@@ -0,0 +1,121 @@
+"""
+Module for a process-wide, in-memory cache of raw frames. When stars are
+dithered, sky.create_skies and image.create_imstack read the same raw
+files; the cache keeps each frame, already cut down by the instrument's
+adjust_array, together with its header, so that each file is decoded once
+per reduction. The least recently used frames are evicted once their total
+size exceeds a limit.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import utils as u
+
+import logging
+logger = logging.getLogger('simmer')
+
+max_bytes = 1024 ** 3
+
+_cache = OrderedDict()
+_nbytes = 0
+_lock = threading.Lock()
+
+
+def set_max_bytes(nbytes):
+    """
+    Sets the memory limit of the cache, evicting frames if needed.
+
+    Inputs:
+        :nbytes: (int) total size of cached frames, in bytes. 0 disables
+                caching.
+    """
+    global max_bytes
+    if nbytes < 0:
+        raise ValueError("The cache size can't be negative.")
+    with _lock:
+        max_bytes = int(nbytes)
+        _evict()
+
+
+def clear():
+    """
+    Empties the cache.
+    """
+    global _nbytes
+    with _lock:
+        _cache.clear()
+        _nbytes = 0
+
+
+def _key(filename, inst):
+    """
+    Identifies a frame by path, modification time and size, and by the
+    instrument settings that adjust_array depends on, so that a file
+    rewritten on disk or cut down differently is never served from a stale
+    entry.
+    """
+    stat = os.stat(filename)
+    return (
+        os.path.abspath(filename),
+        stat.st_mtime_ns,
+        stat.st_size,
+        inst.name,
+        str(getattr(inst, "npix", None)),
+        str(getattr(inst, "center", None)),
+        np.dtype(inst.dtype).str,
+    )
+
+
+def _evict():
+    """
+    Drops least recently used frames until the cache fits its limit.
+    Must be called with the lock held.
+    """
+    global _nbytes
+    while _cache and _nbytes > max_bytes:
+        key, (frame, _) = _cache.popitem(last=False)
+        _nbytes -= frame.nbytes
+        logger.debug(f"Evicted {key[0]} from the raw frame cache.")
+
+
+def read_frames(filelist, inst):
+    """
+    Reads a list of raw frames into an adjusted image cube, reading from
+    disk, with utils.read_frames, only the frames that aren't cached.
+
+    Inputs:
+        :filelist: (list) paths to raw FITS frames.
+        :inst: (Instrument object) instrument for which data is being reduced.
+
+    Outputs:
+        :im_array: (3D array) the frames, as inst.adjust_array would return
+                    them. A new array, so it can be modified.
+        :headers: (list) copy of the primary header of each frame.
+    """
+    global _nbytes
+    keys = [_key(filename, inst) for filename in filelist]
+    entries = [None] * len(filelist)
+    with _lock:
+        for k, key in enumerate(keys):
+            if key in _cache:
+                _cache.move_to_end(key)
+                entries[k] = _cache[key]
+
+    missing = [k for k, entry in enumerate(entries) if entry is None]
+    if missing:
+        frames, headers = u.read_frames([filelist[k] for k in missing], inst)
+        with _lock:
+            for k, frame, head in zip(missing, frames, headers):
+                frame.setflags(write=False)
+                entries[k] = (frame, head)
+                if keys[k] not in _cache:
+                    _cache[keys[k]] = entries[k]
+                    _nbytes += frame.nbytes
+            _evict()
+
+    im_array = np.array([frame for frame, _ in entries])
+    return im_array, [head.copy() for _, head in entries]
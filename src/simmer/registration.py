@@ -64,7 +64,7 @@ def zoom_image(image, rough_center):
     return zoomed_image
 
 
-def register_bruteforce(image, rough_center=None):
+def register_bruteforce(image, rough_center=None, apply_shift=True):
     """
     Performs the default image registration scheme. Shifts the center of the
     image to the peak.
@@ -73,6 +73,9 @@ def register_bruteforce(image, rough_center=None):
         :image: (2-d array) photon counts at each pixel of each science image.
         :rough_center: (2-d array, default None) location of primary star. This
                     argument is only passed in the wide binary case.
+        :apply_shift: (bool, default True) if False, the image isn't shifted and
+                    the (yshift, xshift) that would have been applied is
+                    returned instead.
 
     outputs:
         image_centered : (2-d array) image cenered by the rotations method.
@@ -134,6 +137,8 @@ def register_bruteforce(image, rough_center=None):
     yshift = base_position[0] - coordinates[0][0]
     xshift = base_position[1] - coordinates[0][1]
 
+    if not apply_shift:
+        return (yshift, xshift)
     image_centered = roll_shift(image, (yshift, xshift))
     return image_centered
 
@@ -181,7 +186,9 @@ def find_wide_binary(image):
     return np.round(rough_center[0]).astype(int)
 
 
-def register_saturated(image, searchsize1, newshifts1, rough_center=None):
+def register_saturated(
+    image, searchsize1, newshifts1, rough_center=None, apply_shift=True
+):
 
     """
     Performs image registration when a saturated star is present in
@@ -193,6 +200,8 @@ def register_saturated(image, searchsize1, newshifts1, rough_center=None):
         :newshifts1: (list) keeps tracks of x-y shifts.
         :rough_center: (2-d array, default None) location of primary star. This
                     argument is only passed in the wide binary case.
+        :apply_shift: (bool, default True) if False, the shift is only recorded
+                    in newshifts1 and the image is returned unshifted.
 
     outputs:
         :image_centered: (2-d array) image centered by the rotations method.
@@ -216,6 +225,8 @@ def register_saturated(image, searchsize1, newshifts1, rough_center=None):
     else:
         rot = res1 / np.max(res1)
     newshifts1.append((yshift1, xshift1))
+    if not apply_shift:
+        return image, rot, newshifts1
     image_centered = subpix_shift(image, (yshift1, xshift1))
     return image_centered, rot, newshifts1
 
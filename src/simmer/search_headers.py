@@ -4,9 +4,9 @@
     the header. These issues are only known to occur
     with ShARCS data."""
 
-from glob import glob
+from . import header_catalog as hc
+from . import utils as u
 
-import astropy.io.fits as pyfits
 import logging
 logger = logging.getLogger('simmer')
 
@@ -27,7 +27,7 @@ def search_headers(raw_dir, write_dir=None):
     file = write_dir + "headers_wrong.txt"
     textfile = open(file, "w")
 
-    files = glob(raw_dir + "*.fits")
+    files = u.find_fits(raw_dir + "*")
     files = [
         f
         for f in files
@@ -36,9 +36,10 @@ def search_headers(raw_dir, write_dir=None):
         and "dark" not in f.split("/")[-1]
     ]
 
+    catalog = hc.load_catalog(raw_dir)
     for file in files:
-        # load in header
-        head = pyfits.getheader(file)
+        # catalog keywords of the header
+        head = hc.header(catalog, file)
         keys = head.keys()
 
         # check keywords
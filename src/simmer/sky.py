@@ -10,10 +10,16 @@ import numpy as np
 from tqdm import tqdm
 import re as re
 
+from . import calib_cache as cc
+from . import combine as comb
+from . import manifest as mf
+from . import night_store as ns
 from . import plotting as pl
+from . import raw_cache as rc
 from . import utils as u
+from . import writer as wr
 
-def sky_driver(raw_dir, reddir, config, inst, sep_skies = False, plotting_yml=None):
+def sky_driver(raw_dir, reddir, config, inst, sep_skies = False, plotting_yml=None, force=False, per_frame=False, pack=None):
     """Night should be entered in format 'yyyy_mm_dd' as string.
     This will point toward a config file for the night with flats listed.
 
@@ -24,8 +30,56 @@ def sky_driver(raw_dir, reddir, config, inst, sep_skies = False, plotting_yml=No
         :inst: (Instrument object) instrument for which data is being reduced.
         :sep_skies: (Boolean) if true, skies for observations of star STAR are recorded with Object = "STAR sky". If false, observations were taken using a dither pattern and can be used as the skies.
         :plotting_yml: (string) path to the plotting configuration file.
+        :force: (bool) if True, skies are rebuilt even if their manifests
+                show they are up to date.
+        :per_frame: (bool) if True, each frame also gets a sky made without
+                it, written to sky_cube.fits. Only useful for dithered stars,
+                whose sky frames are the science frames.
+        :pack: (str) directory of a pack of the night's raw frames, made
+                with night_store.pack_night, to read raw frames and headers
+                from rather than their FITS files.
     """
+    with ns.using(pack):
+        if plotting_yml:
+            pl.initialize_plotting(plotting_yml)
+
+        skylists = sky_lists(config, inst, sep_skies=sep_skies)
+        sdirs = glob(reddir + "*/")
+
+        for starname in tqdm(skylists, desc="Running skies", position=0, leave=True):
+            s_dir = reddir + starname + "/"
+            if (
+                s_dir not in sdirs
+            ):  # make sure there's a subdirectory for each star
+                os.mkdir(s_dir)
+
+            for filter_name, skylist in skylists[starname].items():
+                create_skies(
+                    raw_dir,
+                    reddir,
+                    s_dir,
+                    skylist,
+                    inst,
+                    filter_name=filter_name,
+                    force=force,
+                    per_frame=per_frame,
+                )
+        wr.flush()
+
+
+def sky_lists(config, inst, sep_skies=False):
+    """Groups the sky frames of a night by star and filter, with one sky to
+    be made for each group.
 
+    Inputs:
+        :config: (pandas DataFrame) dataframe corresponding to config sheet for data.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :sep_skies: (Boolean) if true, skies for observations of star STAR are recorded with Object = "STAR sky". If false, observations were taken using a dither pattern and can be used as the skies.
+
+    Outputs:
+        :skylists: (dict) for each star, a dict of the sky file numbers for
+                each filter.
+    """
     if inst.take_skies:
         skies = config[config.Comments == "sky"]
     else:
@@ -36,7 +90,6 @@ def sky_driver(raw_dir, reddir, config, inst, sep_skies = False, plotting_yml=No
         ]
 
     stars = skies.Object.unique()
-    sdirs = glob(reddir + "*/")
 
     #Split into sky frames and star frames for observations taken by nodding
     if sep_skies == True:
@@ -54,16 +107,8 @@ def sky_driver(raw_dir, reddir, config, inst, sep_skies = False, plotting_yml=No
         starnames = stars
         skynames = stars
 
-    if plotting_yml:
-        pl.initialize_plotting(plotting_yml)
-
-    for starname in tqdm(starnames, desc="Running skies", position=0, leave=True):
-        s_dir = reddir + starname + "/"
-        if (
-            s_dir not in sdirs
-        ):  # make sure there's a subdirectory for each star
-            os.mkdir(s_dir)
-
+    skylists = {}
+    for starname in starnames:
         #determine object name for skies
         if sep_skies == True:
             skyname = starname+' sky'
@@ -77,21 +122,28 @@ def sky_driver(raw_dir, reddir, config, inst, sep_skies = False, plotting_yml=No
         #Remove duplicates from list of filters
         filts = np.unique(filts)
 
-        for n, filter_name in enumerate(filts):
+        skylists[starname] = {}
+        for filter_name in filts:
             skylist = []
             ww = np.where(np.logical_and(skies.Object == skyname, skies.Filter == filter_name))
             allfiles = skies.iloc[ww].Filenums.values
             for aa in np.arange(len(allfiles)):
                 for bb in eval(allfiles[aa]):
                     skylist.append(bb)
-
-            create_skies(
-                raw_dir, reddir, s_dir, skylist, inst, filter_name=filter_name
-            )
+            skylists[starname][filter_name] = skylist
+    return skylists
 
 
 def create_skies(
-    raw_dir, reddir, s_dir, skylist, inst, plotting_yml=None, filter_name=None
+    raw_dir,
+    reddir,
+    s_dir,
+    skylist,
+    inst,
+    plotting_yml=None,
+    filter_name=None,
+    force=False,
+    per_frame=False,
 ):
     """Create a sky from a single list of skies.
     sf_dir is the reduced directory for the specific star and filter.
@@ -103,6 +155,19 @@ def create_skies(
         :skylist: (list) list of strings of paths pointing to sky files.
         :inst: (Instrument object) instrument for which data is being reduced.
         :plotting_yml: (string) path to the plotting configuration file.
+        :filter_name: (string) filter to use if it's unknown in the header.
+        :force: (bool) if True, the sky is rebuilt even if its manifest
+                shows it is up to date with its raw frames and flat.
+        :per_frame: (bool) if True, a sky for each frame is also made from
+                all of the other frames (a leave-one-out median), so that a
+                dithered star doesn't contaminate its own sky. They are
+                written to sky_cube.fits, with the frame numbers in its
+                FRAMES extension, for image.create_imstack to use.
+
+    The two skies treat NaNs differently: sky.fits is a plain median, so a
+    pixel that is NaN in any sky frame is NaN in it, while each frame's sky
+    in sky_cube.fits ignores NaNs in the other frames, and is NaN only
+    where none of them has a finite value.
 
     Outputs:
         :final_sky: (2D array) medianed sky image.
@@ -114,10 +179,6 @@ def create_skies(
 
     skyfiles = u.make_filelist(raw_dir, skylist, inst)
 
-    sky_array = u.read_imcube(skyfiles)
-
-    sky_array = inst.adjust_array(sky_array, nskies)
-
     head = inst.head(skyfiles[0])
     filt = inst.filt(nskies, head, filter_name)
 
@@ -127,38 +188,78 @@ def create_skies(
     sf_dir = s_dir + filt + "/"
     if sf_dir not in fdirs:  # make a dir for each filt
         os.mkdir(sf_dir)
-    flatfile = reddir + f"flat_{filt}.fits"
-    if inst.name == "PHARO" and filt == "Br-gamma":
-        flatfile = reddir + "flat_K_short.fits"  # no BrG flats in Palomar data
-
-    #For ShARCS, use Ks flat instead of BrG-2.16 if necessary
-    if (inst.name == "ShARCS" and filt == "BrG-2.16"):
-        if os.path.exists(flatfile) == False:
-            flatfile = reddir + 'flat_Ks.fits'
-
-    #For ShARCS, use J flat instead of J+Ch4-1.2 if necessary
-    if (inst.name == "ShARCS" and filt == "J+Ch4-1.2"):
-        if os.path.exists(flatfile) == False:
-            flatfile = reddir + 'flat_J.fits'
-
-    flat = pyfits.getdata(flatfile, 0)
+    flatfile = cc.flat_file(reddir, filt, inst)
+
+    sky_filename = sf_dir + "sky.fits"
+    cube_filename = sf_dir + "sky_cube.fits"
+    inputs = skyfiles + [flatfile]
+    #Only skies asked for in this run may be present, so that create_imstack
+    #subtracts the right ones
+    if not per_frame and os.path.exists(cube_filename):
+        os.remove(cube_filename)
+        if os.path.exists(mf.manifest_file(cube_filename)):
+            os.remove(mf.manifest_file(cube_filename))
+    if (
+        not force
+        and mf.is_current(sky_filename, inputs, inst)
+        and (not per_frame or mf.is_current(cube_filename, inputs, inst))
+    ):
+        return cc.get(sky_filename)
+
+    #The frames stay cached for create_imstack when they are also the
+    #science frames
+    sky_array, _ = rc.read_frames(skyfiles, inst)
+
+    flat = cc.get(flatfile)
+    flat = np.where(flat == 0, np.nan, flat)
 
     for i in range(nskies):
-        flat[flat == 0] = np.nan
         sky_array[i, :, :] = sky_array[i, :, :] / flat
 
     # final_sky = u.median_outlier_reject(sky_array, 2.0) #2sigma outlier rejection?
-    final_sky = np.median(sky_array, axis=0)
+    final_sky = comb.median(sky_array)
 
     #CDD change: use adaptive range for sky colorscaling (was -10,100)
     sky_vmin, sky_vmax = np.percentile(sky_array, [1,99])
-    pl.plot_array(
-        "intermediate", sky_array, sky_vmin, sky_vmax, sf_dir, "sky_cube.png"
+    wr.plot(
+        pl.plot_array,
+        "intermediate",
+        sky_array,
+        sky_vmin,
+        sky_vmax,
+        sf_dir,
+        "sky_cube.png",
     )
 
     head.set("DATAFILE", str(skylist))  # add all file names
 
-    hdu = pyfits.PrimaryHDU(final_sky, header=head)
-    hdu.writeto(sf_dir + "sky.fits", overwrite=True, output_verify="ignore")
+    wr.write_product(sky_filename, final_sky, head, inputs, inst)
+
+    if per_frame:
+        # unlike final_sky, NaNs in the other frames are ignored
+        sky_cube = comb.leave_one_out_median(sky_array)
+        wr.submit(
+            write_sky_cube, cube_filename, sky_cube, head, skylist, inputs, inst
+        )
 
     return final_sky
+
+
+def write_sky_cube(cube_filename, sky_cube, head, skylist, inputs, inst):
+    """Writes the per-frame skies made by create_skies and records their
+    manifest.
+
+    Inputs:
+        :cube_filename: (string) path to write to.
+        :sky_cube: (3D array) sky for each frame.
+        :head: (astropy.io.fits header object) header of the cube.
+        :skylist: (list) file number of each frame.
+        :inputs: (list of str) paths to every file the skies are made from.
+        :inst: (Instrument object) instrument for which data is being reduced.
+    """
+    hdul = pyfits.HDUList(
+        wr.image_hdus(sky_cube, head)
+        + [pyfits.ImageHDU(np.array(skylist), name="FRAMES")]
+    )
+    hdul.writeto(cube_filename, overwrite=True, output_verify="ignore")
+    mf.record(cube_filename, inputs, inst)
@@ -0,0 +1,174 @@
+"""
+Module for keeping the registered frames of a star and filter on disk, so
+that adding exposures to a target only requires registering the new frames.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger('simmer')
+
+
+def frame_key(head, default):
+    """
+    Identifies the raw exposure behind a shifted frame.
+
+    Inputs:
+        :head: (FITS header) header of a frame written by create_imstack.
+        :default: (str) key to use for stacks written before raw file names
+                were recorded, e.g. the name of the shifted frame.
+
+    Outputs:
+        :key: (str) name of the raw file.
+    """
+    return str(head.get("RAWFILE", default))
+
+
+class StackStore:
+    """
+    Registered frames of one star and filter, with their registration shifts
+    and a running sum for mean combines. Frames are stored one per file as
+    float32, so adding or dropping a frame never rewrites the others.
+
+    The store is tied to the registration settings and to the calibrations
+    the frames were reduced with: opening it with a different method, search
+    size or calibration key discards the frames registered before.
+    """
+
+    def __init__(self, store_dir, method, searchsize, calibration=""):
+        """
+        Inputs:
+            :store_dir: (str) directory holding the store; created if needed.
+            :method: (str) image registration method.
+            :searchsize: (int) initial pixel search size of box.
+            :calibration: (str) identifies the sky and flat the frames were
+                    reduced with, e.g. from image.calibration_key.
+        """
+        self.store_dir = store_dir
+        self.settings = f"{method}, {searchsize}, {calibration}"
+        self.index_file = store_dir + "index.csv"
+        self.sum_file = store_dir + "sum.npz"
+
+        self.index = pd.DataFrame(columns=["key", "d_row", "d_col"])
+        self.sum = None
+        self.count = None
+
+        if os.path.exists(self.index_file) and os.path.exists(self.sum_file):
+            sums = np.load(self.sum_file)
+            if str(sums["settings"]) == self.settings:
+                self.index = pd.read_csv(self.index_file, dtype={"key": str})
+                self.sum = sums["sum"]
+                self.count = sums["count"]
+            else:
+                logger.info(
+                    f"Registration settings changed; clearing {store_dir}."
+                )
+                shutil.rmtree(store_dir)
+        os.makedirs(store_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        return key in self.index.key.values
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.key.values)
+
+    def _frame_file(self, key):
+        return self.store_dir + f"{key}.npz"
+
+    def add(self, key, frame, rot, shift):
+        """
+        Adds a registered frame. O(1) in the number of stored frames.
+
+        Inputs:
+            :key: (str) identifier of the raw exposure.
+            :frame: (2D array) registered frame.
+            :rot: (2D array) normalized rotation residuals of the frame.
+            :shift: (tuple) sub-pixel (d_row, d_col) registration shift, or
+                    NaNs if the method doesn't record one.
+        """
+        if key in self:
+            self.remove(key)
+        # the sums hold exactly what is saved, so that remove undoes add
+        frame = frame.astype(np.float32)
+        if self.sum is not None and self.sum.shape != frame.shape:
+            raise ValueError(
+                "Frame shape doesn't match the frames already in the store."
+            )
+        np.savez(self._frame_file(key), frame=frame, rot=rot)
+
+        finite = np.isfinite(frame)
+        if self.sum is None:
+            self.sum = np.zeros(frame.shape)
+            self.count = np.zeros(frame.shape, dtype=np.int32)
+        self.sum += np.where(finite, frame, 0.0)
+        self.count += finite
+
+        self.index.loc[len(self.index)] = [key, shift[0], shift[1]]
+
+    def remove(self, key):
+        """
+        Drops a frame from the store, e.g. when it was rejected by the
+        quality checks after being registered.
+
+        Inputs:
+            :key: (str) identifier of the raw exposure.
+        """
+        frame = np.load(self._frame_file(key))["frame"].astype(float)
+        finite = np.isfinite(frame)
+        self.sum -= np.where(finite, frame, 0.0)
+        self.count -= finite
+        os.remove(self._frame_file(key))
+        self.index = self.index[self.index.key != key].reset_index(drop=True)
+
+    def save(self):
+        """
+        Writes the index and running sums to disk.
+        """
+        self.index.to_csv(self.index_file, index=False)
+        if self.sum is not None:
+            np.savez(
+                self.sum_file,
+                sum=self.sum,
+                count=self.count,
+                settings=self.settings,
+            )
+
+    def frames(self, keys):
+        """
+        Loads registered frames and their rotation residuals.
+
+        Inputs:
+            :keys: (list of str) identifiers of the frames, in order.
+
+        Outputs:
+            :frames: (3D array) registered frames.
+            :rots: (3D array) rotation residuals.
+        """
+        loaded = [np.load(self._frame_file(key)) for key in keys]
+        frames = np.array([entry["frame"] for entry in loaded])
+        rots = np.array([entry["rot"] for entry in loaded])
+        return frames, rots
+
+    def shifts(self, keys):
+        """
+        Returns the recorded sub-pixel shifts of the given frames, skipping
+        frames whose registration method doesn't record one.
+        """
+        index = self.index.set_index("key").loc[keys]
+        index = index.dropna()
+        return list(zip(index.d_row.values, index.d_col.values))
+
+    def mean(self):
+        """
+        Returns the NaN-ignoring mean of every stored frame, from the
+        running sums.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum / self.count
@@ -44,8 +44,9 @@ def image_grid(reddir):
     im_array = u.read_imcube(flist)
 
     npix=50 # number of pixels to show
-    lo=int((600-npix)/2.)
-    hi = int((600+npix)/2.)
+    final_size = im_array.shape[1] # 600 unless configured otherwise
+    lo=int((final_size-npix)/2.)
+    hi = int((final_size+npix)/2.)
     pl.plot_array(
             "intermediate", im_array[:,lo:hi, lo:hi], -10.0, 10000.0, reddir, "all_stars.png",snames=snames,filts=filts)
 
@@ -6,6 +6,7 @@ import yaml
 import unittest
 from shutil import copyfile
 import os
+import tempfile
 
 import pandas as pd
 import numpy as np
@@ -15,6 +16,7 @@ import simmer.schemas.custom_validator as validator
 import simmer.schemas.read_yml as read
 import simmer.insts as i
 import simmer.create_config as c
+import simmer.header_catalog as hc
 import simmer.check_logsheet as check
 import simmer.search_headers as search
 from simmer.tests.tests_reduction import (
@@ -333,3 +335,137 @@ class TestShARCSSpecific(unittest.TestCase):
                 val = False
         f.close()
         self.assertTrue(val)
+
+
+class TestHeaderCatalog(unittest.TestCase):
+    """
+    The header catalog should hold the keywords of every raw frame, and be
+    updated only for files that are new or changed.
+    """
+
+    def write_frame(self, raw_dir, num, obj, itime, framenum=True):
+        head = pyfits.Header()
+        head["OBJECT"] = obj
+        head["ITIME0"] = itime * 1e6
+        head["TRUITIME"] = itime
+        head["FILT1NAM"] = "Ks"
+        head["DATAFILE"] = f"s{num:04d}"
+        if framenum:
+            head["FRAMENUM"] = num
+        pyfits.writeto(
+            raw_dir + f"s{num:04d}.fits", np.zeros((4, 4)), head, overwrite=True
+        )
+
+    def test_catalog(self):
+        inst = i.ShARCS()
+        with tempfile.TemporaryDirectory() as raw_dir:
+            raw_dir += "/"
+            self.write_frame(raw_dir, 1, "dark", 10.0)
+            self.write_frame(raw_dir, 2, "dark", 30.0)
+            self.write_frame(raw_dir, 3, "HIP 1", 1.5, framenum=False)
+
+            catalog = hc.load_catalog(raw_dir)
+            self.assertEqual(
+                list(catalog.index), ["s0001.fits", "s0002.fits", "s0003.fits"]
+            )
+            head = hc.header(catalog, raw_dir + "s0003.fits")
+            self.assertEqual(head["OBJECT"], "HIP 1")
+            self.assertEqual(inst.itime(head), 1.5)
+            self.assertNotIn("FRAMENUM", head)
+
+            # a saved catalog gives the same headers
+            saved = hc.load_catalog(raw_dir)
+            self.assertEqual(
+                hc.header(saved, "s0001.fits"), hc.header(catalog, "s0001.fits")
+            )
+
+            # new and rewritten files are picked up
+            self.write_frame(raw_dir, 4, "dark", 10.0)
+            os.remove(raw_dir + "s0002.fits")
+            self.write_frame(raw_dir, 2, "flat", 30.0)
+            catalog = hc.load_catalog(raw_dir)
+            self.assertEqual(len(catalog), 4)
+            self.assertEqual(hc.header(catalog, "s0002.fits")["OBJECT"], "flat")
+
+            ad.find_itimes(inst, raw_dir)
+            with open(raw_dir + "_dark_itimes.txt") as f:
+                lines = sorted(f.read().split("\n")[:-1])
+            self.assertEqual(lines, ["s0001.fits 10.0", "s0004.fits 10.0"])
+
+            with self.assertLogs('simmer', level='INFO') as cm:
+                search.search_headers(raw_dir)
+            self.assertEqual(
+                cm.output,
+                [f"ERROR:simmer:Header Incomplete in {raw_dir}s0003.fits!!!"],
+            )
+
+    def test_scan_header(self):
+        head = pyfits.Header()
+        head["OBJECT"] = "HIP 1's  "
+        head["RA"] = "12:00:00.0"
+        head["EMPTY"] = ""
+        head["TRUITIME"] = 1.5e-3
+        head["ITIME0"] = -12
+        head["DONE"] = True
+        head["TEMP"] = (77.25, "a comment / with a slash")
+        keys = ["OBJECT", "RA", "EMPTY", "TRUITIME", "ITIME0", "DONE", "TEMP"]
+        with tempfile.TemporaryDirectory() as raw_dir:
+            file = raw_dir + "/s0001.fits"
+            pyfits.writeto(file, np.zeros((4, 4)), head)
+            read = pyfits.getheader(file)
+            expected = {key: read[key] for key in keys}
+            expected["MISSING"] = None
+            self.assertEqual(hc.scan_header(file, keys + ["MISSING"]), expected)
+            self.assertEqual(hc._scan(file, keys + ["MISSING"]), expected)
+
+            # values the scanner doesn't parse are read with astropy
+            head["OBJECT"] = "a long object name " * 5
+            pyfits.writeto(file, np.zeros((4, 4)), head, overwrite=True)
+            with self.assertRaises(ValueError):
+                hc._scan(file, ["OBJECT"])
+            self.assertEqual(
+                hc.scan_header(file, ["OBJECT"]), {"OBJECT": head["OBJECT"]}
+            )
+
+    def test_compressed(self):
+        head = pyfits.Header()
+        head["OBJECT"] = "HIP 1"
+        head["TRUITIME"] = 1.5
+        keys = ["OBJECT", "TRUITIME"]
+        expected = {"OBJECT": "HIP 1", "TRUITIME": 1.5}
+        with tempfile.TemporaryDirectory() as raw_dir:
+            raw_dir += "/"
+            pyfits.writeto(raw_dir + "s0001.fits.gz", np.zeros((4, 4)), head)
+            pyfits.HDUList(
+                [pyfits.PrimaryHDU(), pyfits.CompImageHDU(np.zeros((4, 4)), head)]
+            ).writeto(raw_dir + "s0002.fits.fz")
+            # gzipped headers are scanned; fpacked ones are read by astropy
+            self.assertEqual(hc._scan(raw_dir + "s0001.fits.gz", keys), expected)
+            with self.assertRaises(ValueError):
+                hc._scan(raw_dir + "s0002.fits.fz", keys)
+            self.assertEqual(hc.scan_header(raw_dir + "s0002.fits.fz", keys), expected)
+
+            catalog = hc.load_catalog(raw_dir)
+            self.assertEqual(list(catalog.index), ["s0001.fits.gz", "s0002.fits.fz"])
+            self.assertEqual(
+                hc.header(catalog, raw_dir + "s0002.fits.fz")["OBJECT"], "HIP 1"
+            )
+
+    def test_mislabelled_gzip(self):
+        head = pyfits.Header()
+        head["OBJECT"] = "HIP 1"
+        with tempfile.TemporaryDirectory() as raw_dir:
+            raw_dir += "/"
+            # an uncompressed file with a gzip name is read by astropy
+            pyfits.writeto(raw_dir + "s0001.fits", np.zeros((4, 4)), head)
+            os.rename(raw_dir + "s0001.fits", raw_dir + "s0001.fits.gz")
+            with self.assertRaises(OSError):
+                hc._scan(raw_dir + "s0001.fits.gz", ["OBJECT"])
+            self.assertEqual(
+                hc.scan_header(raw_dir + "s0001.fits.gz", ["OBJECT"]),
+                {"OBJECT": "HIP 1"},
+            )
+            catalog = hc.load_catalog(raw_dir)
+            self.assertEqual(
+                hc.header(catalog, raw_dir + "s0001.fits.gz")["OBJECT"], "HIP 1"
+            )
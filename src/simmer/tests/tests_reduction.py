@@ -2,23 +2,42 @@
     isort:skip_file
 """
 
+import operator
 import os
 import sys
 import unittest
+from unittest import mock
 import urllib.request
 import zipfile
 import pickle
+import tempfile
 
 
 import astropy.io.fits as pyfits
+import simmer.badpix as bp
+import simmer.dark_model as dm
 import simmer.darks as darks
 import simmer.drivers as drivers
+import simmer.drizzle as dz
 import simmer.flats as flats
 import simmer.image as image
+import simmer.calib_cache as cc
+import simmer.calib_library as cl
+import simmer.combine as comb
 import simmer.insts as i
+import simmer.manifest as mf
+import simmer.nan_interp as ni
+import simmer.night_store as ns
+import simmer.parallel as par
+import simmer.prefetch as pf
 import numpy as np
 import pandas as pd
 import simmer.sky as sky
+import simmer.stack_store as ss
+import simmer.quality as qual
+import simmer.raw_cache as rc
+import simmer.utils as u
+import simmer.writer as wr
 
 
 # Before we get into testing, there are a few utility functions
@@ -140,6 +159,1031 @@ class TestExceptions(unittest.TestCase):
             flats.open_darks(non_existent_flat)
 
 
+class TestNanInterpolation(unittest.TestCase):
+    """
+    The batched NaN filling should agree with astropy's
+    interpolate_replace_nans, which it replaces.
+    """
+
+    def test_matches_astropy(self):
+        from astropy.convolution import (
+            Gaussian2DKernel,
+            interpolate_replace_nans,
+        )
+
+        rng = np.random.default_rng(42)
+        cube = rng.normal(100.0, 10.0, (3, 64, 64))
+        cube[rng.random(cube.shape) < 0.05] = np.nan
+        cube[1, :3, :3] = np.nan  # at the frame edge
+        cube[2] = rng.normal(100.0, 10.0, (64, 64))  # a frame without NaNs
+
+        kernel = Gaussian2DKernel(x_stddev=1)
+        expected = np.array(
+            [interpolate_replace_nans(frame, kernel) for frame in cube]
+        )
+        result = ni.interpolate_nans(cube, stddev=1)
+        self.assertTrue(np.allclose(result, expected, equal_nan=True))
+        self.assertTrue(np.array_equal(result[2], cube[2]))
+
+    def test_finite_pixels_untouched(self):
+        image = np.arange(100.0).reshape(10, 10)
+        image[5, 5] = np.nan
+        result = ni.interpolate_nans(image)
+        finite = np.isfinite(image)
+        self.assertTrue(np.array_equal(result[finite], image[finite]))
+        self.assertTrue(np.isfinite(result[5, 5]))
+
+
+class TestCombine(unittest.TestCase):
+    """
+    The compiled stack reductions should reproduce NumPy's.
+    """
+
+    rng = np.random.default_rng(7)
+    cube = rng.normal(size=(6, 20, 30))
+    cube[rng.random(cube.shape) < 0.2] = np.nan
+    cube[:, 0, 0] = np.nan  # NaN in every frame
+
+    def test_nanmedian(self):
+        expected = np.nanmedian(self.cube, axis=0)
+        result = comb.nanmedian(self.cube)
+        self.assertTrue(np.allclose(result, expected, equal_nan=True))
+
+    def test_median_propagates_nan(self):
+        expected = np.median(self.cube, axis=0)
+        result = comb.median(self.cube)
+        self.assertTrue(np.allclose(result, expected, equal_nan=True))
+
+    def test_nanpercentile(self):
+        for q in [0, 1, 50, 99, 100]:
+            expected = np.nanpercentile(self.cube, q, axis=0)
+            result = comb.nanpercentile(self.cube, q)
+            self.assertTrue(np.allclose(result, expected, equal_nan=True))
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            comb.set_backend("cuda")
+
+    def test_single_precision(self):
+        cube = self.cube.astype(np.float32)
+        result = comb.nanmedian(cube)
+        self.assertEqual(result.dtype, np.float32)
+        expected = np.nanmedian(cube, axis=0)
+        self.assertTrue(np.allclose(result, expected, equal_nan=True))
+
+    def test_leave_one_out_median(self):
+        result = comb.leave_one_out_median(self.cube)
+        for k in range(len(self.cube)):
+            others = np.delete(self.cube, k, axis=0)
+            with np.errstate(all="ignore"):
+                expected = np.nanmedian(others, axis=0)
+            self.assertTrue(
+                np.allclose(result[k], expected, equal_nan=True)
+            )
+
+
+class TestPrecision(unittest.TestCase):
+    """
+    Single precision reductions should keep frame cubes in float32.
+    """
+
+    def test_adjust_array(self):
+        raw = np.ones((2, 8, 8), dtype=np.int16)
+        self.assertEqual(i.PHARO().adjust_array(raw, 2).dtype, np.float64)
+        single = i.PHARO(precision="single")
+        self.assertEqual(single.adjust_array(raw, 2).dtype, np.float32)
+
+    def test_nan_interpolation_keeps_precision(self):
+        image = np.ones((10, 10), dtype=np.float32)
+        image[5, 5] = np.nan
+        result = ni.interpolate_nans(image)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertAlmostEqual(float(result[5, 5]), 1.0, places=5)
+
+    def test_invalid_precision(self):
+        with self.assertRaises(ValueError):
+            i.PHARO(precision="half")
+
+
+class TestGeometry(unittest.TestCase):
+    """
+    Early cropping must keep the star centered and the final footprint
+    inside the cropped frame.
+    """
+
+    def test_roi_legacy_footprint(self):
+        shape = (1000, 1000)
+        bounds = u.roi_bounds(shape, 600, corner=(100, 100), margin=20)
+        self.assertEqual(bounds, (80, 920, 80, 920))
+
+    def test_roi_centered_footprint(self):
+        shape = (1000, 1000)
+        r0, r1, c0, c1 = u.roi_bounds(shape, 600, corner=None, margin=20)
+        self.assertEqual((r0, r1, c0, c1), (180, 820, 180, 820))
+        # star stays at the center of the cropped frame
+        self.assertEqual(500 - r0, int((r1 - r0) / 2))
+
+    def test_roi_clipped_to_frame(self):
+        bounds = u.roi_bounds((1024, 1024), 600, corner=(100, 100), margin=200)
+        self.assertEqual(bounds, (0, 1024, 0, 1024))
+
+
+class TestQuality(unittest.TestCase):
+    """
+    Frames that fail the quality limits should be rejected, and the
+    reason recorded.
+    """
+
+    def make_frame(self, amplitude, sigma, offset=(0, 0)):
+        rows, cols = np.indices((101, 101))
+        return amplitude * np.exp(
+            -((rows - 50 - offset[0]) ** 2 + (cols - 50 - offset[1]) ** 2)
+            / (2 * sigma ** 2)
+        )
+
+    def test_metrics(self):
+        metrics = qual.frame_metrics(self.make_frame(1000.0, 2.0))
+        self.assertAlmostEqual(metrics["peak"], 1000.0)
+        # FWHM of a Gaussian is 2.355 sigma
+        self.assertTrue(abs(metrics["fwhm"] - 2.355 * 2.0) < 1.0)
+        self.assertTrue(metrics["centroid_offset"] < 0.5)
+
+    def test_rejection(self):
+        metrics = [
+            qual.frame_metrics(self.make_frame(1000.0, 2.0)),
+            qual.frame_metrics(self.make_frame(1000.0, 8.0)),  # open loop
+            qual.frame_metrics(self.make_frame(5.0, 2.0)),  # clouds
+            qual.frame_metrics(self.make_frame(1000.0, 2.0)),
+        ]
+        shifts = [(0, 0), (1, 0), (0, 1), (80, 80)]  # last one jumped
+        limits = {"min_peak": 100, "max_fwhm": 10, "max_shift_offset": 20}
+        quality = qual.assess_frames(metrics, shifts, limits)
+        self.assertEqual(
+            list(quality.accepted), [True, False, False, False]
+        )
+        self.assertEqual(
+            list(quality.reason),
+            ["", "max_fwhm", "min_peak", "max_shift_offset"],
+        )
+
+    def test_unknown_limit(self):
+        metrics = [qual.frame_metrics(self.make_frame(1000.0, 2.0))]
+        with self.assertRaises(ValueError):
+            qual.assess_frames(metrics, [(0, 0)], {"max_airmass": 2})
+
+
+class TestStackStore(unittest.TestCase):
+    """
+    The stack store should keep running sums that match a full recombine.
+    """
+
+    rng = np.random.default_rng(3)
+    frames = rng.normal(size=(4, 16, 16))
+    frames[0, 2, 2] = np.nan
+    rot = np.zeros((21, 21))
+
+    def test_running_mean(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store_dir = tmp + "/store/"
+            store = ss.StackStore(store_dir, "saturated", 10)
+            for k in range(3):
+                store.add(f"s{k:04d}", self.frames[k], self.rot, (0.5, k))
+            store.save()
+
+            # reopening picks up the frames; add one, drop another
+            store = ss.StackStore(store_dir, "saturated", 10)
+            self.assertEqual(len(store), 3)
+            store.add("s0003", self.frames[3], self.rot, (0.5, 3))
+            store.remove("s0001")
+
+            expected = np.nanmean(self.frames[[0, 2, 3]], axis=0)
+            self.assertTrue(np.allclose(store.mean(), expected))
+            stored, _ = store.frames(["s0000", "s0002", "s0003"])
+            self.assertTrue(
+                np.allclose(stored, self.frames[[0, 2, 3]], equal_nan=True)
+            )
+            self.assertEqual(
+                store.shifts(["s0003", "s0000"]), [(0.5, 3.0), (0.5, 0.0)]
+            )
+
+    def test_settings_change_clears(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store_dir = tmp + "/store/"
+            store = ss.StackStore(store_dir, "saturated", 10)
+            store.add("s0000", self.frames[0], self.rot, (0, 0))
+            store.save()
+            store = ss.StackStore(store_dir, "quick_look", 10)
+            self.assertEqual(len(store), 0)
+            store.add("s0000", self.frames[0], self.rot, (0, 0))
+            store.save()
+            store = ss.StackStore(store_dir, "quick_look", 10, "new flat")
+            self.assertEqual(len(store), 0)
+
+    def test_remove_is_exact(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = ss.StackStore(tmp + "/store/", "saturated", 10)
+            store.add("s0000", self.frames[1], self.rot, (0, 0))
+            store.add("s0001", self.frames[2], self.rot, (0, 0))
+            store.remove("s0000")
+            np.testing.assert_array_equal(
+                store.mean(), self.frames[2].astype(np.float32)
+            )
+
+    def test_calibration_key(self):
+        inst = i.PHARO()
+        with tempfile.TemporaryDirectory() as tmp:
+            reddir = tmp + "/"
+            sf_dir = reddir + "HIP1/K_short/"
+            os.makedirs(sf_dir)
+            flatfile, skyfile = reddir + "flat_K_short.fits", sf_dir + "sky.fits"
+            pyfits.writeto(flatfile, np.ones((4, 4)))
+            mf.record(flatfile, [], inst)
+            pyfits.writeto(skyfile, np.zeros((4, 4)))
+            mf.record(skyfile, [flatfile], inst)
+            key = image.calibration_key(sf_dir)
+            self.assertEqual(image.calibration_key(sf_dir), key)
+
+            # a rebuilt flat changes the key even if the sky wasn't remade
+            mf.record(flatfile, [skyfile], inst)
+            self.assertNotEqual(image.calibration_key(sf_dir), key)
+
+
+class TestFrameCube(unittest.TestCase):
+    """
+    Shifted frames written as a single cube should read back like the
+    individual sh##.fits files.
+    """
+
+    frames = np.arange(3 * 8 * 8, dtype=float).reshape(3, 8, 8)
+
+    def make_headers(self):
+        headers = []
+        for k in range(3):
+            head = pyfits.Header()
+            head["RAWFILE"] = f"s{k:04d}.fits"
+            headers.append(head)
+        return headers
+
+    def test_cube_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sf_dir = tmp + "/"
+            u.write_frame_cube(
+                sf_dir + "sh_cube.fits", self.frames, self.make_headers()
+            )
+            headers = u.read_shifted_headers(sf_dir)
+            self.assertEqual(sorted(headers), [0, 1, 2])
+            self.assertEqual(headers[2]["RAWFILE"], "s0002.fits")
+            frames = u.read_shifted(sf_dir, [2, 0])
+            self.assertTrue(np.array_equal(frames, self.frames[[2, 0]]))
+
+    def test_individual_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sf_dir = tmp + "/"
+            for k, head in enumerate(self.make_headers()):
+                pyfits.writeto(
+                    sf_dir + "sh{:02d}.fits".format(k), self.frames[k], head
+                )
+            headers = u.read_shifted_headers(sf_dir)
+            self.assertEqual(headers[1]["RAWFILE"], "s0001.fits")
+            frames = u.read_shifted(sf_dir, [1, 2])
+            self.assertTrue(np.array_equal(frames, self.frames[[1, 2]]))
+
+
+class TestManifest(unittest.TestCase):
+    """
+    A calibration product should only be reused while its inputs are
+    unchanged.
+    """
+
+    def test_staleness(self):
+        inst = i.PHARO()
+        with tempfile.TemporaryDirectory() as tmp:
+            inputs = [tmp + f"/raw{k}.fits" for k in range(2)]
+            for file in inputs:
+                with open(file, "w") as f:
+                    f.write("raw")
+            product = tmp + "/dark_10sec.fits"
+            self.assertFalse(mf.is_current(product, inputs, inst))
+
+            with open(product, "w") as f:
+                f.write("dark")
+            mf.record(product, inputs, inst)
+            self.assertTrue(mf.is_current(product, inputs, inst))
+
+            # a different instrument setup or input list is a different product
+            self.assertFalse(
+                mf.is_current(product, inputs, i.PHARO(precision="single"))
+            )
+            self.assertFalse(mf.is_current(product, inputs[:1], inst))
+
+            with open(inputs[1], "w") as f:
+                f.write("new raw frame")
+            self.assertFalse(mf.is_current(product, inputs, inst))
+
+
+class TestCalibCache(unittest.TestCase):
+    """
+    Cached calibration products should be read-only, shared, and never
+    outlive a rewrite of their file.
+    """
+
+    def tearDown(self):
+        cc.set_max_bytes(512 * 1024 ** 2)
+        cc.clear()
+
+    def test_cache_hits_and_rewrites(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            flatfile = tmp + "/flat_K_short.fits"
+            pyfits.writeto(flatfile, np.ones((8, 8)))
+            flat = cc.get(flatfile)
+            self.assertIs(cc.get(flatfile), flat)
+            with self.assertRaises(ValueError):
+                flat[0, 0] = 2.0
+
+            # rewriting the product replaces the cached copy
+            os.remove(flatfile)
+            pyfits.writeto(flatfile, np.zeros((40, 40)))
+            self.assertEqual(cc.get(flatfile).shape, (40, 40))
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [tmp + f"/sky{k}.fits" for k in range(3)]
+            for file in files:
+                pyfits.writeto(file, np.ones((8, 8)))
+            cc.set_max_bytes(2 * 8 * 8 * 8)
+            first = cc.get(files[0])
+            for file in files[1:]:
+                cc.get(file)
+            self.assertIsNot(cc.get(files[0]), first)
+
+    def test_flat_fallback(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            reddir = tmp + "/"
+            pyfits.writeto(reddir + "flat_K_short.fits", np.ones((4, 4)))
+            self.assertEqual(
+                cc.flat_file(reddir, "Br-gamma", i.PHARO()),
+                reddir + "flat_K_short.fits",
+            )
+
+            # ShARCS falls back to the Ks flat until a BrG-2.16 flat is made
+            pyfits.writeto(reddir + "flat_Ks.fits", np.ones((4, 4)))
+            self.assertEqual(
+                cc.flat_file(reddir, "BrG-2.16", i.ShARCS()),
+                reddir + "flat_Ks.fits",
+            )
+            pyfits.writeto(reddir + "flat_BrG-2.16.fits", np.ones((4, 4)))
+            self.assertEqual(
+                cc.flat_file(reddir, "BrG-2.16", i.ShARCS()),
+                reddir + "flat_BrG-2.16.fits",
+            )
+
+
+class TestReadFrames(unittest.TestCase):
+    """
+    The bulk reader should match reading whole frames and adjusting them.
+    """
+
+    def test_subsection(self):
+        inst = i.ShARCS()
+        inst.npix, inst.center = 6, (5, 8)
+        rng = np.random.default_rng(4)
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [tmp + f"/s{k:04d}.fits" for k in range(4)]
+            for k, file in enumerate(files):
+                hdu = pyfits.PrimaryHDU(rng.normal(1000.0, 50.0, (16, 20)))
+                hdu.header["FRAME"] = k
+                hdu.scale("int16", bzero=32768)
+                hdu.writeto(file)
+
+            cube, headers = u.read_frames(files, inst, max_workers=2)
+            expected = inst.adjust_array(u.read_imcube(files), 4)
+            self.assertEqual(cube.dtype, expected.dtype)
+            self.assertTrue(np.array_equal(cube, expected))
+            self.assertEqual([h["FRAME"] for h in headers], [0, 1, 2, 3])
+
+        with self.assertRaises(ValueError):
+            u.read_frames([], inst)
+
+    def test_pharo_quadrants(self):
+        rng = np.random.default_rng(6)
+        with tempfile.TemporaryDirectory() as tmp:
+            raw_dir, new_dir = tmp + "/raw/", tmp + "/new/"
+            os.mkdir(raw_dir)
+            for k in range(3):
+                cube = rng.integers(0, 5000, (4, 512, 512)).astype(np.int16)
+                head = pyfits.Header()
+                head["T_INT"] = 1000.0
+                pyfits.writeto(raw_dir + f"ph{k:04d}.fits", cube, head)
+
+            i.PHARO().read_data(raw_dir, new_dir, max_workers=2)
+            converted, _ = u.read_frames(
+                u.make_filelist(new_dir, range(3), i.PHARO()), i.PHARO()
+            )
+            inst = i.PHARO(raw_quadrants=True)
+            assembled, headers = u.read_frames(
+                u.make_filelist(raw_dir, range(3), inst), inst
+            )
+            self.assertTrue(np.array_equal(assembled, converted))
+            self.assertEqual(headers[0]["T_INT"], 1000.0)
+
+    def test_compressed(self):
+        inst = i.PHARO()
+        rng = np.random.default_rng(8)
+        with tempfile.TemporaryDirectory() as tmp:
+            raw_dir = tmp + "/"
+            frames = rng.integers(0, 5000, (3, 32, 32)).astype(np.int16)
+            for k, frame in enumerate(frames):
+                head = pyfits.Header()
+                head["FRAME"] = k
+                pyfits.writeto(raw_dir + f"sph{k:04d}.fits", frame, head)
+            os.rename(raw_dir + "sph0001.fits", raw_dir + "sph0001.fits.gz")
+            hdu = pyfits.CompImageHDU(frames[2], head, compression_type="RICE_1")
+            pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(
+                raw_dir + "sph0002.fits.fz"
+            )
+            os.remove(raw_dir + "sph0002.fits")
+
+            files = u.make_filelist(raw_dir, [0, 1, 2, 3], inst)
+            self.assertEqual(
+                [os.path.basename(f) for f in files],
+                ["sph0000.fits", "sph0001.fits.gz", "sph0002.fits.fz", "sph0003.fits"],
+            )
+            cube, headers = u.read_frames(files[:3], inst, max_workers=3)
+            self.assertTrue(np.array_equal(cube, frames.astype(inst.dtype)))
+            self.assertEqual([h["FRAME"] for h in headers], [0, 1, 2])
+            self.assertEqual(len(u.find_fits(raw_dir + "sph*")), 3)
+
+
+class TestRawCache(unittest.TestCase):
+    """
+    Raw frames should be decoded once, returned as adjusted, writable cubes,
+    and never served after their file changes.
+    """
+
+    def tearDown(self):
+        rc.set_max_bytes(1024 ** 3)
+        rc.clear()
+
+    def test_read_frames(self):
+        inst = i.PHARO(precision="single")
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [tmp + f"/sph{k:04d}.fits" for k in range(3)]
+            for k, file in enumerate(files):
+                head = pyfits.Header()
+                head["FRAME"] = k
+                pyfits.writeto(file, np.full((8, 8), k, dtype=np.int16), head)
+
+            cube, headers = rc.read_frames(files, inst)
+            expected = inst.adjust_array(u.read_imcube(files), 3)
+            self.assertEqual(cube.dtype, np.float32)
+            self.assertTrue(np.array_equal(cube, expected))
+            self.assertEqual([h["FRAME"] for h in headers], [0, 1, 2])
+
+            # callers may modify what they get without touching the cache
+            cube[:] = -1.0
+            headers[0]["FRAME"] = 5
+            cached, headers = rc.read_frames(files, inst)
+            self.assertTrue(np.array_equal(cached, expected))
+            self.assertEqual(headers[0]["FRAME"], 0)
+
+            os.remove(files[1])
+            pyfits.writeto(files[1], np.full((10, 10), 7, dtype=np.int16))
+            self.assertEqual(rc.read_frames(files[1:2], inst)[0].shape, (1, 10, 10))
+
+    def test_eviction(self):
+        inst = i.PHARO()
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [tmp + f"/sph{k:04d}.fits" for k in range(3)]
+            for file in files:
+                pyfits.writeto(file, np.ones((8, 8)))
+            rc.set_max_bytes(2 * 8 * 8 * 8)
+            rc.read_frames(files, inst)
+            self.assertEqual(len(rc._cache), 2)
+            rc.set_max_bytes(0)
+            self.assertEqual(len(rc._cache), 0)
+
+
+class TestWriter(unittest.TestCase):
+    """
+    Background writes should be complete after a flush, pass on the errors
+    they hit, and happen right away when the writer isn't running.
+    """
+
+    inst = i.PHARO()
+
+    def tearDown(self):
+        wr.stop()
+        wr.set_storage()
+
+    def test_synchronous(self):
+        self.assertFalse(wr.running())
+        with tempfile.TemporaryDirectory() as tmp:
+            wr.write_fits(tmp + "/a.fits", np.ones((4, 4)))
+            self.assertTrue(os.path.exists(tmp + "/a.fits"))
+
+    def test_background(self):
+        wr.start(workers=2, max_pending=2)
+        self.assertTrue(wr.running())
+        with tempfile.TemporaryDirectory() as tmp:
+            for k in range(6):
+                wr.write_fits(tmp + f"/{k}.fits", np.full((4, 4), k))
+            wr.flush()
+            for k in range(6):
+                self.assertEqual(pyfits.getdata(tmp + f"/{k}.fits")[0, 0], k)
+
+            raw = tmp + "/raw.fits"
+            pyfits.writeto(raw, np.zeros((4, 4)))
+            product = tmp + "/dark.fits"
+            wr.write_product(product, np.ones((4, 4)), None, [raw], self.inst)
+            wr.flush()
+            self.assertTrue(mf.is_current(product, [raw], self.inst))
+            self.assertTrue(np.array_equal(cc.get(product), np.ones((4, 4))))
+
+    def test_errors(self):
+        wr.start()
+        with self.assertLogs("simmer", level="ERROR"):
+            wr.write_fits("/no/such/directory/a.fits", np.ones((4, 4)))
+            with self.assertRaises(OSError):
+                wr.flush()
+        # errors are only raised once
+        wr.flush()
+        with self.assertLogs("simmer", level="ERROR"):
+            wr.plot(operator.truediv, 1, 0)
+            with self.assertRaises(ZeroDivisionError):
+                wr.stop()
+        self.assertFalse(wr.running())
+
+    def test_storage(self):
+        rng = np.random.default_rng(0)
+        frames = rng.normal(100.0, 5.0, (3, 16, 16))
+        frames[0, 0, 0] = np.nan
+        head = pyfits.Header()
+        head["FINSIZE"] = 8
+        with tempfile.TemporaryDirectory() as tmp:
+            sf_dir = tmp + "/"
+            wr.set_storage(compression="GZIP_2", single=True)
+            for k in range(3):
+                wr.write_fits(
+                    sf_dir + f"sh{k:02d}.fits", frames[k], head, intermediate=True
+                )
+            wr.write_fits(sf_dir + "final_im.fits", frames[0], head)
+
+            with pyfits.open(sf_dir + "sh00.fits") as hdul:
+                self.assertEqual(len(hdul), 2)
+            with pyfits.open(sf_dir + "final_im.fits") as hdul:
+                self.assertEqual(len(hdul), 1)
+            self.assertEqual(u.read_shifted_headers(sf_dir)[1]["FINSIZE"], 8)
+            stored = u.read_shifted(sf_dir, [0, 1, 2])
+            self.assertEqual(stored.dtype, np.float32)
+            np.testing.assert_array_equal(stored, frames.astype(np.float32))
+            np.testing.assert_array_equal(
+                u.read_imcube([sf_dir + "final_im.fits"])[0], frames[0]
+            )
+
+            wr.set_storage(compression="RICE_1", quantize_level=16.0)
+            for k in range(3):
+                os.remove(sf_dir + f"sh{k:02d}.fits")
+            wr.write_cube(sf_dir + "sh_cube.fits", frames, [head] * 3)
+            stored = u.read_shifted(sf_dir, [2, 0])
+            self.assertTrue(np.isnan(stored[1, 0, 0]))
+            np.testing.assert_allclose(stored, frames[[2, 0]], atol=1.0)
+            self.assertEqual(u.read_shifted_headers(sf_dir)[2]["FINSIZE"], 8)
+
+        with self.assertRaises(ValueError):
+            wr.set_storage(compression="RICE_1")
+        with self.assertRaises(ValueError):
+            wr.set_storage(compression="ZIP")
+
+
+class TestNightStore(unittest.TestCase):
+    """
+    Packed frames should be read exactly as from their files, and only
+    while the files and instrument settings are unchanged.
+    """
+
+    def tearDown(self):
+        ns.release()
+
+    def test_pack(self):
+        inst = i.PHARO()
+        rng = np.random.default_rng(12)
+        with tempfile.TemporaryDirectory() as tmp:
+            raw_dir, pack_dir = tmp + "/raw/", tmp + "/pack/"
+            os.mkdir(raw_dir)
+            files = [raw_dir + f"sph{k:04d}.fits" for k in range(5)]
+            for k, file in enumerate(files):
+                head = pyfits.Header()
+                head["FRAME"] = k
+                shape = (8, 8) if k != 3 else (6, 6)
+                pyfits.writeto(file, rng.normal(0.0, 1.0, shape), head)
+            del files[3]
+
+            expected, _ = u.read_frames(files, inst)
+            with self.assertLogs("simmer", level="WARNING"):
+                pack = ns.pack_night(raw_dir, pack_dir, inst)
+            self.assertEqual(len(pack), 4)
+            self.assertEqual(pack.header(files[2])["FRAME"], 2)
+            self.assertFalse(pack.frame(files[1]).flags.writeable)
+
+            ns.use(pack_dir)
+            self.assertEqual(ns.active(), [pack_dir])
+            cube, headers = ns.read_frames(files[::-1], inst)
+            self.assertTrue(np.array_equal(cube, expected[::-1]))
+            self.assertEqual([h["FRAME"] for h in headers], [4, 2, 1, 0])
+            self.assertIsNone(ns.read_frames(files, i.PHARO(precision="single")))
+            self.assertIsNone(ns.read_frames([raw_dir + "sph0003.fits"], inst))
+
+            # a rewritten file is read from disk again
+            os.remove(files[0])
+            pyfits.writeto(files[0], np.ones((8, 8)))
+            self.assertIsNone(ns.read_frames(files, inst))
+            self.assertTrue(np.all(u.read_frames(files, inst)[0][0] == 1.0))
+
+            ns.release(pack_dir)
+            self.assertEqual(ns.active(), [])
+
+    def test_headers(self):
+        inst = i.PHARO()
+        with tempfile.TemporaryDirectory() as tmp:
+            raw_dir, pack_dir = tmp + "/raw/", tmp + "/pack/"
+            os.mkdir(raw_dir)
+            head = pyfits.Header()
+            head["FILTER"] = "K_short"
+            pyfits.writeto(raw_dir + "sph0001.fits", np.zeros((8, 8)), head)
+            ns.pack_night(raw_dir, pack_dir, inst)
+            self.assertIsNone(ns.header(raw_dir + "sph0001.fits"))
+
+            # a driver's pack is only in use while the driver runs
+            with ns.using(pack_dir):
+                self.assertEqual(ns.active(), [pack_dir])
+                with mock.patch.object(pyfits, "open", side_effect=AssertionError):
+                    head = inst.head(raw_dir + "sph0001.fits")
+                self.assertEqual(head["FILTER"], "K_short")
+                with ns.using(pack_dir):
+                    pass
+                self.assertEqual(ns.active(), [pack_dir])
+            self.assertEqual(ns.active(), [])
+
+    def test_driver_releases_pack(self):
+        inst = i.PHARO()
+        default_storage = wr.storage()
+        with tempfile.TemporaryDirectory() as tmp:
+            raw_dir, pack_dir = tmp + "/raw/", tmp + "/pack/"
+            reddir = tmp + "/red/"
+            os.mkdir(raw_dir)
+            pyfits.writeto(raw_dir + "sph0001.fits", np.zeros((8, 8)))
+            ns.pack_night(raw_dir, pack_dir, inst)
+            config_file = tmp + "/config.csv"
+            pd.DataFrame(
+                [["HD 1", 10.0, "Ks", "", "range(2, 4)", "quick_look"]],
+                columns=[
+                    "Object", "ExpTime", "Filter", "Comments", "Filenums", "Method"
+                ],
+            ).to_csv(config_file, index=False)
+
+            kwargs = dict(
+                just_images=True,
+                verbose=False,
+                background_writes=True,
+                storage={"single": True},
+                pack=pack_dir,
+                prefetch_bytes=0,
+            )
+
+            # the star's frames don't exist, so the reduction fails
+            with self.assertRaises(Exception):
+                drivers.all_driver(inst, config_file, raw_dir, reddir, **kwargs)
+            self.assertFalse(wr.running())
+            self.assertEqual(wr.storage(), default_storage)
+            self.assertEqual(ns.active(), [])
+
+            # a background write fails as well, after the reduction did
+            def failing_image_driver(*args, **kw):
+                wr.submit(operator.truediv, 1, 0)
+                raise RuntimeError("reduction failed")
+
+            with mock.patch.object(image, "image_driver", failing_image_driver):
+                with self.assertLogs("simmer", level="ERROR"):
+                    with self.assertRaisesRegex(RuntimeError, "reduction failed"):
+                        drivers.all_driver(
+                            inst, config_file, raw_dir, reddir, **kwargs
+                        )
+            self.assertFalse(wr.running())
+            self.assertEqual(wr.storage(), default_storage)
+            self.assertEqual(ns.active(), [])
+
+
+class TestPrefetch(unittest.TestCase):
+    """
+    Prefetching should run one job at a time in the background, keep to its
+    memory cap, and never raise the errors of a failed job.
+    """
+
+    def setUp(self):
+        rc.clear()
+        cc.clear()
+
+    tearDown = setUp
+
+    def test_prefetcher(self):
+        loaded = []
+        with pf.Prefetcher(max_bytes=10) as prefetcher:
+            prefetcher.start(lambda unit, cap: loaded.append((unit, cap)), 1)
+            prefetcher.start(lambda unit, cap: loaded.append((unit, cap)), 2)
+            prefetcher.wait()
+            self.assertEqual(loaded, [(1, 10), (2, 10)])
+            prefetcher.start(operator.truediv, 1)
+            prefetcher.wait()
+
+        with pf.Prefetcher(max_bytes=0) as prefetcher:
+            prefetcher.start(loaded.append)
+        self.assertEqual(len(loaded), 2)
+        with self.assertRaises(ValueError):
+            pf.Prefetcher(max_bytes=-1)
+
+    def test_prefetch_imstack(self):
+        inst = i.PHARO()
+        with tempfile.TemporaryDirectory() as tmp:
+            raw_dir, reddir = tmp + "/raw/", tmp + "/red/"
+            s_dir = reddir + "HIP1/"
+            os.makedirs(raw_dir)
+            os.makedirs(s_dir + "K_short/")
+            head = pyfits.Header()
+            head["FILTER"] = "K_short"
+            for k in range(3):
+                pyfits.writeto(raw_dir + f"sph{k:04d}.fits", np.ones((8, 8)), head)
+            pyfits.writeto(reddir + "flat_K_short.fits", np.ones((8, 8)))
+            pyfits.writeto(s_dir + "K_short/sky.fits", np.zeros((8, 8)))
+
+            # frames over the cap are left to be read as usual
+            image.prefetch_imstack(
+                raw_dir, reddir, s_dir, [0, 1, 2], "K_short", inst, 8 * 8 * 8 * 2
+            )
+            self.assertEqual(len(rc._cache), 1)
+            self.assertEqual(len(cc._cache), 0)
+
+            image.prefetch_imstack(
+                raw_dir, reddir, s_dir, [0, 1, 2], "K_short", inst, 8 * 8 * 8 * 3
+            )
+            self.assertEqual(len(rc._cache), 3)
+            self.assertEqual(len(cc._cache), 2)
+
+    def test_read_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [tmp + f"/sh{k:02d}.fits" for k in range(3)]
+            for file in files:
+                with open(file, "wb") as f:
+                    f.write(b"0" * 100)
+            self.assertEqual(pf.read_files(files, 150), 150)
+            self.assertEqual(pf.read_files(files, 1000), 300)
+            self.assertEqual(pf.read_files(files, 0), 0)
+
+
+class TestCalibLibrary(unittest.TestCase):
+    """
+    The calibration library should hand out the product from the nearest
+    night, and never take back products it handed out.
+    """
+
+    inst = i.PHARO()
+
+    def publish_dark(self, library, reddir, night, value):
+        darkfile = reddir + "dark_10sec.fits"
+        pyfits.writeto(darkfile, np.full((4, 4), value), overwrite=True)
+        mf.record(darkfile, [], self.inst)
+        library.publish_night(reddir, self.inst, night)
+
+    def test_nearest_night(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            library = cl.CalibrationLibrary(tmp + "/library", max_days=30)
+            reddir = tmp + "/"
+            self.publish_dark(library, reddir, "2019-09-01", 1.0)
+            self.publish_dark(library, reddir, "2019_10_01", 2.0)
+            self.assertEqual(
+                library.nights(self.inst, "dark_10sec"),
+                ["2019-09-01", "2019-10-01"],
+            )
+
+            newdir = tmp + "/new/"
+            os.makedirs(newdir)
+            self.assertTrue(
+                library.restore(self.inst, "dark_10sec", newdir, "2019-09-20")
+            )
+            self.assertEqual(pyfits.getdata(newdir + "dark_10sec.fits")[0, 0], 2.0)
+            # the copy keeps the library's mtime, and isn't rewritten later,
+            # so products made from it stay current
+            source = library.find(self.inst, "dark_10sec", "2019-09-20")
+            restored = os.stat(newdir + "dark_10sec.fits")
+            self.assertEqual(restored.st_mtime_ns, os.stat(source).st_mtime_ns)
+            self.assertTrue(
+                library.restore(self.inst, "dark_10sec", newdir, "2019-09-20")
+            )
+            self.assertEqual(
+                os.stat(newdir + "dark_10sec.fits").st_ctime_ns, restored.st_ctime_ns
+            )
+            self.assertIsNone(library.find(self.inst, "dark_10sec", "2020-01-01"))
+            self.assertIsNone(library.find(self.inst, "dark_30sec", "2019-10-01"))
+
+            # restored products aren't published as the new night's own
+            library.publish_night(newdir, self.inst, "2019-09-20")
+            self.assertEqual(len(library.nights(self.inst, "dark_10sec")), 2)
+
+    def test_restore_flat(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            library = cl.CalibrationLibrary(tmp + "/library", reuse=True)
+            raw_dir, reddir = tmp + "/raw/", tmp + "/red/"
+            os.makedirs(raw_dir)
+            os.makedirs(reddir)
+            flatfile = tmp + "/flat_K_short.fits"
+            pyfits.writeto(flatfile, np.full((4, 4), 3.0))
+            library.publish(flatfile, self.inst, "2019-09-01")
+
+            # the config's filter isn't the one the flat is named after
+            head = pyfits.Header()
+            head["FILTER"] = "K_short"
+            for k in range(2):
+                pyfits.writeto(raw_dir + f"sph{k:04d}.fits", np.ones((4, 4)), head)
+            config = pd.DataFrame(
+                [["flat", 10.0, "Ks", "flat", "range(0, 2)", ""]],
+                columns=[
+                    "Object", "ExpTime", "Filter", "Comments", "Filenums", "Method"
+                ],
+            )
+            self.assertEqual(
+                flats.flat_product(raw_dir, [0, 1], self.inst, "Ks"), "flat_K_short"
+            )
+            flats.flat_driver(
+                raw_dir, reddir, config, self.inst, library=library, night="2019-09-02"
+            )
+            self.assertEqual(pyfits.getdata(reddir + "flat_K_short.fits")[0, 0], 3.0)
+
+
+class TestDarkModel(unittest.TestCase):
+    """
+    The linear dark model should recover bias and dark current, and give
+    darks for exposure times that weren't taken.
+    """
+
+    def test_fit_and_synthesize(self):
+        inst = i.PHARO()
+        rng = np.random.default_rng(5)
+        bias = rng.normal(100.0, 5.0, (16, 16))
+        rate = rng.uniform(0.1, 1.0, (16, 16))
+        with tempfile.TemporaryDirectory() as tmp:
+            darkfiles = []
+            for k, itime in enumerate([10.0, 10.0, 30.0, 60.0]):
+                darkfile = tmp + f"/dark{k}.fits"
+                head = pyfits.Header()
+                head["T_INT"] = itime * 1000.0
+                pyfits.writeto(darkfile, bias + rate * itime, head)
+                darkfiles.append(darkfile)
+
+            fit_bias, fit_rate, itimes = dm.fit_dark_model(darkfiles, inst)
+            self.assertTrue(np.allclose(fit_bias, bias))
+            self.assertTrue(np.allclose(fit_rate, rate))
+            self.assertEqual(itimes, [10.0, 10.0, 30.0, 60.0])
+
+            model_file = tmp + "/" + dm.model_name
+            model_head = pyfits.Header()
+            model_head["DARKMODL"] = True
+            pyfits.writeto(
+                model_file, np.array([fit_bias, fit_rate]), model_head
+            )
+            dark = flats.open_darks(model_file, 20.0)
+            self.assertTrue(np.allclose(dark, bias + rate * 20.0))
+            with self.assertRaises(ValueError):
+                flats.open_darks(model_file)
+
+            # a cube without the keyword isn't taken for a model
+            cube_file = tmp + "/dark_cube.fits"
+            pyfits.writeto(cube_file, np.array([fit_bias, fit_rate]))
+            self.assertEqual(flats.open_darks(cube_file, 20.0).shape, (2, 16, 16))
+
+
+class TestBadPix(unittest.TestCase):
+    """
+    Hot, unstable and dead pixels should be found from darks and flats, and
+    repaired from their neighbors.
+    """
+
+    def test_repair(self):
+        rng = np.random.default_rng(2)
+        image = rng.normal(10.0, 0.1, (12, 12))
+        mask = np.zeros(image.shape, dtype=bool)
+        mask[5, 5] = True
+        image[5, 5] = 1e4
+        image[0, 3] = np.nan
+        repaired = bp.repair(image, mask, radius=1)
+        box = np.delete(image[4:7, 4:7].ravel(), 4)
+        self.assertEqual(repaired[5, 5], np.median(box))
+        self.assertTrue(np.isfinite(repaired[0, 3]))
+        good = ~mask & np.isfinite(image)
+        self.assertTrue(np.array_equal(repaired[good], image[good]))
+
+    def test_mask_driver(self):
+        inst = i.PHARO()
+        rng = np.random.default_rng(3)
+        config = pd.DataFrame(
+            {"Object": ["dark"], "ExpTime": [10.0], "Filenums": ["[1, 2, 3, 4]"]}
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp += "/"
+            for k in range(1, 5):
+                dark = rng.normal(100.0, 1.0, (16, 16))
+                dark[2, 3] = 1000.0  # hot
+                dark[7, 7] = 100.0 + 500.0 * (-1) ** k  # unstable
+                pyfits.writeto(tmp + f"sph{k:04d}.fits", dark)
+            flat = np.ones((16, 16))
+            flat[9, 1] = 0.05  # dead
+            pyfits.writeto(tmp + "flat_K.fits", flat)
+
+            masks, _ = bp.find_bad_pixels(tmp, tmp, config, inst)
+            self.assertTrue(masks["hot"][2, 3])
+            self.assertTrue(masks["unstable"][7, 7])
+            self.assertTrue(masks["dead"][9, 1])
+            self.assertFalse(masks["static"].any())
+
+            bp.mask_driver(tmp, tmp, config, inst)
+            mask = bp.load_mask(tmp, (16, 16))
+            expected = masks["hot"] | masks["unstable"] | masks["dead"]
+            self.assertTrue(np.array_equal(mask, expected))
+            self.assertIsNone(bp.load_mask(tmp, (8, 8)))
+
+
+class TestParallel(unittest.TestCase):
+    """
+    Tasks should run after their dependencies, in or out of process, and
+    errors should reach the caller.
+    """
+
+    tasks = {
+        "a": (operator.add, (1, 2), []),
+        "b": (operator.mul, (3, 4), ["c"]),
+        "c": (operator.sub, (9, 5), ["a"]),
+    }
+
+    def test_serial(self):
+        results = par.run_graph(self.tasks, max_workers=1)
+        self.assertEqual(results, {"a": 3, "b": 12, "c": 4})
+
+    def test_processes(self):
+        results = par.run_graph(self.tasks, max_workers=2)
+        self.assertEqual(results, {"a": 3, "b": 12, "c": 4})
+
+    def test_errors(self):
+        tasks = dict(self.tasks)
+        tasks["d"] = (operator.truediv, (1, 0), ["a"])
+        with self.assertRaises(ZeroDivisionError):
+            par.run_graph(tasks, max_workers=2)
+
+    def test_cycle(self):
+        tasks = {
+            "a": (operator.add, (1, 2), ["b"]),
+            "b": (operator.add, (1, 2), ["a"]),
+        }
+        with self.assertRaises(ValueError):
+            par.run_graph(tasks, max_workers=1)
+
+
+class TestDrizzle(unittest.TestCase):
+    """
+    Shift-and-add onto an oversampled grid should conserve surface
+    brightness and line up shifted frames.
+    """
+
+    def gaussian(self, center, shape=(41, 41), sigma=2.0):
+        rows, cols = np.indices(shape)
+        return np.exp(
+            -((rows - center[0]) ** 2 + (cols - center[1]) ** 2)
+            / (2 * sigma ** 2)
+        )
+
+    def test_constant_frame(self):
+        frames = np.full((2, 10, 10), 5.0)
+        frames[1, 3, 3] = np.nan  # ignored, covered by the other frame
+        combined, weights = dz.shift_and_add(
+            frames, [(0, 0), (0, 0)], oversample=2
+        )
+        self.assertEqual(combined.shape, (20, 20))
+        self.assertTrue(np.allclose(combined, 5.0))
+        self.assertAlmostEqual(weights.sum(), 4 * 200 - 4)
+
+    def test_aligns_shifted_frames(self):
+        offsets = [(0.0, 0.0), (1.5, -0.5), (-0.5, 2.0)]
+        frames = np.array(
+            [self.gaussian((20 + dy, 20 + dx)) for dy, dx in offsets]
+        )
+        shifts = [(-dy, -dx) for dy, dx in offsets]
+        combined, _ = dz.shift_and_add(frames, shifts, oversample=2)
+        peak = np.unravel_index(np.nanargmax(combined), combined.shape)
+        # input pixel 20 maps onto output pixels 40 and 41
+        self.assertTrue(peak[0] in [40, 41] and peak[1] in [40, 41])
+
+    def test_invalid_pixfrac(self):
+        with self.assertRaises(ValueError):
+            dz.shift_and_add(np.zeros((1, 4, 4)), [(0, 0)], pixfrac=0)
+
+
 class TestCreation(unittest.TestCase):
 
     inst = i.ShARCS()
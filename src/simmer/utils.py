@@ -2,9 +2,15 @@
 This module provides utility functions for the reduction pipeline.
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
 import astropy.io.fits as pyfits
 import numpy as np
 
+from . import night_store as ns
+
 
 def find_angle(loc1, loc2):
     """
@@ -21,8 +27,14 @@ def find_angle(loc1, loc2):
     return angle
 
 
+# raw frames may be archived gzipped or fpacked (tile-compressed)
+fits_extensions = [".fits", ".fits.gz", ".fits.fz"]
+
+
 def make_filelist(directory, numlist, inst):
     """Turn a list of numbers into a list of properly formatted filenames.
+    Each file is looked for as .fits, then .fits.gz and .fits.fz, and
+    named .fits if none of them exist.
 
     Inputs:
         :directory: (string) path leading to directory of interest.
@@ -33,12 +45,28 @@ def make_filelist(directory, numlist, inst):
         :filelist: (list) list of strings pertaining to files of interest
     """
 
-    filelist = [
-        directory + inst.file_prefix + "{:04d}.fits".format(d) for d in numlist
-    ]
+    filelist = []
+    for d in numlist:
+        base = directory + inst.file_prefix + "{:04d}".format(d)
+        found = [base + ext for ext in fits_extensions if os.path.exists(base + ext)]
+        filelist.append(found[0] if found else base + ".fits")
     return filelist
 
 
+def find_fits(pattern):
+    """Finds FITS files, compressed or not, matching a glob pattern.
+
+    Inputs:
+        :pattern: (string) glob pattern without the extension, e.g.
+                raw_dir + "*".
+
+    Outputs:
+        :filelist: (list) paths of the matching .fits, .fits.gz and
+                .fits.fz files.
+    """
+    return [file for ext in fits_extensions for file in glob(pattern + ext)]
+
+
 def read_imcube(filelist):
     """Reads a stack of fits files into an image cube of dimensions (nims, xpix, ypix).
 
@@ -50,11 +78,222 @@ def read_imcube(filelist):
 
     """
 
-    im_array = np.array([pyfits.getdata(file, 0) for file in filelist])
+    im_array = np.array([pyfits.getdata(file) for file in filelist])
 
     return im_array
 
 
+def read_frames(filelist, inst, max_workers=None):
+    """Reads a stack of raw frames into an image cube, as read_imcube followed
+    by inst.adjust_array would, but reading files concurrently and decoding
+    only the part of each frame the instrument keeps (inst.raw_section).
+    Frames are read with inst.raw_frame, which also assembles PHARO's raw
+    quadrant cubes, into one cube of the instrument's precision. Gzipped
+    and tile-compressed files are decompressed in memory by the reading
+    threads. Frames held by a night pack in use (see night_store) are read
+    from it instead.
+
+    Inputs:
+        :filelist: (list) list of strings pertaining to files of interest.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :max_workers: (int) number of reading threads. None uses the default
+                of concurrent.futures.ThreadPoolExecutor.
+
+    Outputs:
+        :im_array: (3D array) adjusted frames, shape (nims, xpix, ypix).
+        :headers: (list) copy of the image header of each file.
+    """
+    if len(filelist) == 0:
+        raise ValueError("No frames to read.")
+    packed = ns.read_frames(filelist, inst)
+    if packed is not None:
+        return packed
+    section = inst.raw_section()
+    headers = [None] * len(filelist)
+
+    def read(k):
+        with pyfits.open(filelist[k]) as hdul:
+            hdu = image_hdu(hdul)
+            headers[k] = hdu.header.copy()
+            return inst.raw_frame(hdu, section)
+
+    first = read(0)
+    im_array = np.empty((len(filelist),) + first.shape, dtype=inst.dtype)
+    im_array[0] = first
+
+    def read_into(k):
+        im_array[k] = read(k)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # list() re-raises any reading error here
+        list(pool.map(read_into, range(1, len(filelist))))
+    return im_array, headers
+
+
+def as_float(array):
+    """Returns a floating point copy of an array, keeping single precision
+    arrays in single precision and converting anything else to double.
+
+    Inputs:
+        :array: (array) array of any numeric type.
+
+    Outputs:
+        :float_array: (array) copy of array, as float32 or float64.
+    """
+    array = np.asarray(array)
+    if array.dtype.kind == "f" and array.dtype.itemsize == 4:
+        return array.astype(np.float32)
+    return array.astype(np.float64)
+
+
+def image_hdus(data, header=None, compression=None, quantize_level=None):
+    """Makes the HDUs of a FITS file holding one image: a primary HDU, or,
+    if a compression is given, an empty primary HDU followed by a
+    tile-compressed image HDU. Read them back with pyfits.getdata(filename)
+    and read_header, which find the image either way.
+
+    Inputs:
+        :data: (array) the image.
+        :header: (astropy.io.fits Header) header of the image.
+        :compression: (string) tile compression algorithm, e.g. "GZIP_2" or
+                "RICE_1". None writes the image uncompressed.
+        :quantize_level: (float) noise level that floating point images are
+                quantized to before compression, as in
+                astropy.io.fits.CompImageHDU. None compresses them
+                losslessly, which only GZIP can do.
+
+    Outputs:
+        :hdus: (list) HDUs to write, as a list for pyfits.HDUList.
+    """
+    if compression is None:
+        return [pyfits.PrimaryHDU(data, header=header)]
+    if quantize_level is None:
+        if not compression.startswith("GZIP"):
+            raise ValueError(
+                f"{compression} can't compress floating point images "
+                "losslessly; give a quantize_level or use GZIP."
+            )
+        quantize_level = 0.0
+    return [
+        pyfits.PrimaryHDU(),
+        pyfits.CompImageHDU(
+            data,
+            header=header,
+            compression_type=compression,
+            quantize_level=quantize_level,
+            # seed the dithering from the image, so that files are reproducible
+            dither_seed=-1,
+        ),
+    ]
+
+
+def image_hdu(hdul):
+    """Returns the HDU holding the image of a file written with image_hdus.
+
+    Inputs:
+        :hdul: (astropy.io.fits HDUList) the open file.
+
+    Outputs:
+        :hdu: (astropy.io.fits HDU) the primary HDU, or the compressed image
+                HDU after an empty primary HDU.
+    """
+    if hdul[0].header.get("NAXIS", 0) == 0 and len(hdul) > 1 and hdul[1].is_image:
+        return hdul[1]
+    return hdul[0]
+
+
+def read_header(filename):
+    """Reads the header of the image in a FITS file, whether or not it is
+    tile-compressed. Headers of raw files held by a night pack in use (see
+    night_store) are read from it instead.
+
+    Inputs:
+        :filename: (string) path to a FITS file.
+
+    Outputs:
+        :header: (astropy.io.fits Header) header of the image.
+    """
+    packed = ns.header(filename)
+    if packed is not None:
+        return packed
+    with pyfits.open(filename) as hdul:
+        return image_hdu(hdul).header.copy()
+
+
+def write_frame_cube(filename, frames, headers, compression=None, quantize_level=None):
+    """Writes a stack of frames as a single FITS cube. The header of each frame
+    is kept, as text, in a row of a "HEADERS" table extension.
+
+    Inputs:
+        :filename: (string) path of the cube file.
+        :frames: (3D array) array of 2D frames.
+        :headers: (list) FITS header of each frame.
+        :compression: (string) tile compression of the cube. See image_hdus.
+        :quantize_level: (float) quantization of the cube. See image_hdus.
+    """
+    hdus = image_hdus(
+        frames, headers[0].copy(), compression=compression,
+        quantize_level=quantize_level,
+    )
+    header_strings = np.array([head.tostring() for head in headers])
+    table = pyfits.BinTableHDU.from_columns(
+        [
+            pyfits.Column(
+                name="FRAME", format="J", array=np.arange(len(headers))
+            ),
+            pyfits.Column(
+                name="HEADER",
+                format=f"{max(len(h) for h in header_strings)}A",
+                array=header_strings,
+            ),
+        ],
+        name="HEADERS",
+    )
+    pyfits.HDUList(hdus + [table]).writeto(
+        filename, overwrite=True, output_verify="ignore"
+    )
+
+
+def read_shifted_headers(sf_dir):
+    """Reads the headers of the frames written by image.create_imstack, which
+    are either one sh##.fits file per frame or a single sh_cube.fits.
+
+    Inputs:
+        :sf_dir: (string) directory for a specific star and filter.
+
+    Outputs:
+        :headers: (dict) FITS header of each frame, keyed by frame index.
+    """
+    cubefile = sf_dir + "sh_cube.fits"
+    if os.path.exists(cubefile):
+        table = pyfits.getdata(cubefile, "HEADERS")
+        return {
+            int(frame): pyfits.Header.fromstring(head)
+            for frame, head in zip(table["FRAME"], table["HEADER"])
+        }
+    return {
+        int(os.path.basename(file)[2:-5]): read_header(file)
+        for file in glob(sf_dir + "sh[0-9]*.fits")
+    }
+
+
+def read_shifted(sf_dir, indices):
+    """Reads frames written by image.create_imstack, in either layout.
+
+    Inputs:
+        :sf_dir: (string) directory for a specific star and filter.
+        :indices: (list) indices of the frames to read.
+
+    Outputs:
+        :im_array: (3D array) the requested frames, in the order of indices.
+    """
+    cubefile = sf_dir + "sh_cube.fits"
+    if os.path.exists(cubefile):
+        with pyfits.open(cubefile, memmap=True) as hdul:
+            return np.array(image_hdu(hdul).data[list(indices)])
+    return read_imcube([sf_dir + "sh{:02d}.fits".format(i) for i in indices])
+
+
 def image_subsection(input_image, npix, center):
     """reads in a full image array, selects the relevant subsection of the array,
     and returns the new array, transposed for use with Python.
@@ -78,17 +317,86 @@ def image_subsection(input_image, npix, center):
 
     )"""
 
+    subsection = input_image[subsection_slices(npix, center)]
+
+    return subsection
+
+
+def subsection_slices(npix, center):
+    """Returns the slices that image_subsection takes from an image.
+
+    Inputs:
+        :npix: (float) value for size of return image. If non-square image desired, enter as list.
+        :center: (tuple) center of image, with format (x, y)
+
+    Outputs:
+        :slices: (tuple) row and column slices of the subsection.
+    """
     npix = np.array(npix)
     if np.size(npix) == 1:
         npix = [npix, npix]
     half = [int(n / 2) for n in npix]
 
-    subsection = input_image[
-        center[0] - half[0] : center[0] + half[0],
-        center[1] - half[1] : center[1] + half[1],
-    ]
+    return (
+        slice(center[0] - half[0], center[0] + half[0]),
+        slice(center[1] - half[1], center[1] + half[1]),
+    )
 
-    return subsection
+
+def final_corner(shape, final_size, corner=None):
+    """Finds the corner of the final image footprint in a coarsely centered
+    frame, i.e. one whose star has been moved to the center of the array.
+
+    Inputs:
+        :shape: (tuple) shape of the full frame, with format (rows, cols).
+        :final_size: (int) side length of the final image, in pixels.
+        :corner: (tuple) row, col of the footprint corner. If None, the
+                footprint is centered on the star.
+
+    Outputs:
+        :corner: (tuple) row, col of the footprint corner.
+    """
+    if corner is not None:
+        return (int(corner[0]), int(corner[1]))
+    cent = (int(shape[0] / 2), int(shape[1] / 2))
+    half = int(final_size / 2)
+    return (cent[0] - half, cent[1] - half)
+
+
+def roi_bounds(shape, final_size, corner=None, margin=0):
+    """Finds the region of a coarsely centered frame that has to be kept so
+    that the final image footprint, plus a margin for registration, survives.
+    The region is kept symmetric about the center of the frame so that the
+    star is still at the center of the cropped array.
+
+    The savings depend on where the footprint is. With the default
+    Instrument.final_corner of (100, 100), the footprint is off-center:
+    a 600 pixel footprint in a 1000x1000 frame runs from 100 to 700, so
+    even a margin of 20 keeps 840x840 pixels, about 70% of the frame. A
+    footprint centered on the star (final_corner=None) keeps
+    (final_size + 2 * margin) pixels on a side.
+
+    Inputs:
+        :shape: (tuple) shape of the full frame, with format (rows, cols).
+        :final_size: (int) side length of the final image, in pixels.
+        :corner: (tuple) row, col of the footprint corner. If None, the
+                footprint is centered on the star.
+        :margin: (int) extra pixels kept on every side of the footprint.
+
+    Outputs:
+        :bounds: (tuple) row_start, row_end, col_start, col_end of the region.
+    """
+    cent = (int(shape[0] / 2), int(shape[1] / 2))
+    corner = final_corner(shape, final_size, corner)
+    half = max(
+        cent[0] - corner[0],
+        corner[0] + final_size - cent[0],
+        cent[1] - corner[1],
+        corner[1] + final_size - cent[1],
+    ) + int(margin)
+    # can't extend past the frame without moving the star off-center
+    half = min(half, cent[0], shape[0] - cent[0], cent[1], shape[1] - cent[1])
+    return (cent[0] - half, cent[0] + half, cent[1] - half, cent[1] + half)
 
 
 def header_subsection(input_image_file, npix, center):
@@ -105,7 +413,7 @@ def header_subsection(input_image_file, npix, center):
 
 
     """
-    header = pyfits.getheader(input_image_file)
+    header = read_header(input_image_file)
     # hdulist = fits.open(input_image_file)
     # header = wcs.WCS(hdulist[0].header)
 
@@ -9,10 +9,10 @@ Confirm that the values listed in a configuration file match the values in the F
 
 import numpy as np
 import pandas as pd
-import astropy.io.fits as pyfits
 import os as os
 
 
+from . import header_catalog as hc
 from . import utils as u
 
 import logging
@@ -26,6 +26,8 @@ def validate_config(config, raw_dir, inst, verbose=False):
 
     logger.debug("inspecting directory: %s", raw_dir)
 
+    catalog = hc.load_catalog(raw_dir)
+
     objissues = 0
     expissues = 0
     filtissues = 0
@@ -35,7 +37,7 @@ def validate_config(config, raw_dir, inst, verbose=False):
         flist = u.make_filelist(raw_dir, eval(this.Filenums), inst)
         # print('this line: ', np.array(this))
         for file in flist:
-            head = pyfits.getheader(file)
+            head = hc.header(catalog, file)
             hkeys = np.array(list(head.keys()))
 
             logger.debug(
@@ -0,0 +1,296 @@
+"""
+Module for writing products and diagnostic plots in the background, so
+that the reduction stages don't wait on disk or matplotlib. Once start() is
+called, FITS products are written by a pool of threads and plots are drawn
+by a single thread of their own (pyplot isn't thread safe). The number of
+jobs waiting is bounded, so a stage producing output faster than it can be
+written is held back rather than filling memory. Stages call flush() before
+anything reads what they wrote, which also re-raises the first error that a
+job hit. Until start() is called, every job runs immediately, in the
+calling thread.
+
+Intermediate products (shifted frames, master darks, flats and skies) are
+written according to a storage policy set with set_storage: by default as
+plain FITS in the precision they were made in, or else tile-compressed and
+optionally in single precision or quantized. Final images are always
+written losslessly.
+
+Arrays and headers handed to a job belong to it: they must not be modified
+after they are submitted.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from . import calib_cache as cc
+from . import manifest as mf
+from . import utils as u
+
+import logging
+logger = logging.getLogger('simmer')
+
+_fits_pool = None
+_plot_pool = None
+_slots = None
+_pending = []
+_lock = threading.Lock()
+
+compressions = ["GZIP_1", "GZIP_2", "RICE_1", "HCOMPRESS_1"]
+_storage = {"compression": None, "quantize_level": None, "single": False}
+
+
+def set_storage(compression=None, quantize_level=None, single=False):
+    """
+    Sets how intermediate products are written.
+
+    Inputs:
+        :compression: (str) tile compression, one of compressions. None
+                writes uncompressed files.
+        :quantize_level: (float) noise level that images are quantized to
+                before compression (see astropy.io.fits.CompImageHDU).
+                Lower values lose more. None compresses losslessly, which
+                needs a GZIP compression.
+        :single: (bool) if True, floating point intermediates are written
+                in single precision.
+    """
+    if compression is not None and compression not in compressions:
+        raise ValueError(f"compression must be None or one of {compressions}.")
+    if quantize_level is not None and compression is None:
+        raise ValueError("Only compressed images can be quantized.")
+    if compression is not None and quantize_level is None:
+        # fails early if the compression can't be lossless
+        u.image_hdus(np.zeros((1, 1)), compression=compression)
+    _storage.update(
+        compression=compression, quantize_level=quantize_level, single=single
+    )
+
+
+def storage():
+    """
+    Returns the storage policy, as keyword arguments for set_storage.
+    """
+    return dict(_storage)
+
+
+def _stored(data, policy):
+    """
+    Returns data in the precision it is stored in under a policy.
+    """
+    data = np.asarray(data)
+    if policy["single"] and data.dtype.kind == "f" and data.dtype.itemsize > 4:
+        return data.astype(np.float32)
+    return data
+
+
+def image_hdus(data, header=None, intermediate=True):
+    """
+    Makes the HDUs of a FITS file holding an image, following the storage
+    policy if it is an intermediate product. See utils.image_hdus.
+
+    Inputs:
+        :data: (array) the image.
+        :header: (astropy.io.fits Header) header of the image.
+        :intermediate: (bool) whether the image is an intermediate product.
+                Other images are always written uncompressed.
+
+    Outputs:
+        :hdus: (list) HDUs to write.
+    """
+    return _image_hdus(data, header, _storage if intermediate else None)
+
+
+def _image_hdus(data, header, policy):
+    if policy is None:
+        return u.image_hdus(data, header)
+    return u.image_hdus(
+        _stored(data, policy),
+        header,
+        compression=policy["compression"],
+        quantize_level=policy["quantize_level"],
+    )
+
+
+def start(workers=2, max_pending=16):
+    """
+    Starts writing in the background.
+
+    Inputs:
+        :workers: (int) number of threads writing FITS files.
+        :max_pending: (int) number of jobs that may wait to be written
+                before submitting another one blocks.
+    """
+    global _fits_pool, _plot_pool, _slots
+    if workers < 1 or max_pending < 1:
+        raise ValueError("The writer needs at least one thread and one slot.")
+    stop()
+    _slots = threading.BoundedSemaphore(max_pending)
+    _fits_pool = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="simmer-fits"
+    )
+    _plot_pool = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="simmer-plot"
+    )
+
+
+def stop():
+    """
+    Waits for every job, then goes back to writing in the calling thread.
+    Re-raises the first error that a job hit.
+    """
+    global _fits_pool, _plot_pool
+    try:
+        flush()
+    finally:
+        for pool in [_fits_pool, _plot_pool]:
+            if pool is not None:
+                pool.shutdown(wait=True)
+        _fits_pool = None
+        _plot_pool = None
+
+
+def running():
+    """
+    Returns whether jobs are being run in the background.
+    """
+    return _fits_pool is not None
+
+
+def flush():
+    """
+    Waits until every job submitted so far is done. Should be called at the
+    end of each stage, before its products are read.
+    Re-raises the first error that a job hit.
+    """
+    with _lock:
+        pending = list(_pending)
+        _pending.clear()
+    error = None
+    for future in pending:
+        exc = future.exception()
+        if exc is not None and error is None:
+            error = exc
+    if error is not None:
+        raise error
+
+
+def _submit(pool, func, args, kwargs):
+    """
+    Runs func(*args, **kwargs) on a pool, waiting for a free slot first.
+    """
+    if pool is None:
+        return func(*args, **kwargs)
+    _slots.acquire()
+
+    def job():
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Background job {func.__name__} failed.")
+            raise
+        finally:
+            _slots.release()
+
+    future = pool.submit(job)
+    with _lock:
+        _pending.append(future)
+    return None
+
+
+def submit(func, *args, **kwargs):
+    """
+    Runs a function that writes output, in the background if the writer is
+    running.
+
+    Inputs:
+        :func: (function) function to run.
+        :args, kwargs: its arguments.
+    """
+    return _submit(_fits_pool, func, args, kwargs)
+
+
+def plot(func, *args, **kwargs):
+    """
+    Runs a plotting function, such as plotting.plot_array, in the plotting
+    thread if the writer is running.
+
+    Inputs:
+        :func: (function) function to run.
+        :args, kwargs: its arguments.
+    """
+    return _submit(_plot_pool, func, args, kwargs)
+
+
+def _write_fits(filename, data, header, policy):
+    pyfits.HDUList(_image_hdus(data, header, policy)).writeto(
+        filename, overwrite=True, output_verify="ignore"
+    )
+
+
+def write_fits(filename, data, header=None, intermediate=False):
+    """
+    Writes an image to a FITS file, in the background if the writer is
+    running.
+
+    Inputs:
+        :filename: (str) path to write to.
+        :data: (array) the image.
+        :header: (astropy.io.fits Header) header of the image.
+        :intermediate: (bool) if True, the file is written following the
+                storage policy. Otherwise it is written as it is.
+    """
+    policy = storage() if intermediate else None
+    submit(_write_fits, filename, data, header, policy)
+
+
+def _write_product(filename, data, header, inputs, inst, policy):
+    _write_fits(filename, data, header, policy)
+    if policy is None or policy["quantize_level"] is None:
+        cc.put(filename, data if policy is None else _stored(data, policy))
+    mf.record(filename, inputs, inst)
+
+
+def write_product(filename, data, header, inputs, inst, intermediate=True):
+    """
+    Writes a calibration product, then puts it in the calibration cache and
+    records its manifest, in the background if the writer is running. The
+    manifest is only written once the product is complete. Quantized
+    products aren't cached, so that they are read back as they were stored.
+
+    Inputs:
+        :filename: (str) path to write to.
+        :data: (array) the product.
+        :header: (astropy.io.fits Header) header of the product.
+        :inputs: (list of str) paths to every file the product is made from.
+        :inst: (Instrument object) instrument for which data is being reduced.
+        :intermediate: (bool) if True, the product is written following the
+                storage policy. Otherwise it is written as it is.
+    """
+    policy = storage() if intermediate else None
+    submit(_write_product, filename, data, header, inputs, inst, policy)
+
+
+def _write_cube(filename, frames, headers, policy):
+    u.write_frame_cube(
+        filename,
+        _stored(frames, policy),
+        headers,
+        compression=policy["compression"],
+        quantize_level=policy["quantize_level"],
+    )
+
+
+def write_cube(filename, frames, headers):
+    """
+    Writes intermediate frames as a single cube with utils.write_frame_cube,
+    following the storage policy, in the background if the writer is
+    running.
+
+    Inputs:
+        :filename: (str) path of the cube file.
+        :frames: (3D array) array of 2D frames.
+        :headers: (list) FITS header of each frame.
+    """
+    submit(_write_cube, filename, frames, headers, storage())